@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import json
+import logging
+import os
+import pathlib
+import random
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+from typing import Callable, Dict, List, Tuple
+
+import lib
+import memory
+import metrics  # shared with dsp56k, made importable by lib
+import synth_flash
+import words  # shared codec, made importable by lib
+
+sys.path.append(str(pathlib.Path(__file__).resolve().parent / "virus_ti"))
+import firmware  # noqa: E402
+import validate  # noqa: E402
+import vti  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+"""
+Benchmark harness for the Access Virus and DSP56k tools.
+
+Usage: python3 benchmark.py [--save-baseline] [--filter NAME ...]
+
+Generates a synthetic flash image (see `synth_flash.py`), the files
+derived from it and a synthetic Virus TI firmware file (holding a vti file
+with random ROM data), then runs every benchmark in a separate process and
+reports its throughput in words per second and its peak RSS. Each
+benchmark is run `--repeat` times and the best run is reported.
+
+Results are compared against the stored baseline (`benchmark_baseline.json`
+next to this script, or `--baseline`). A benchmark that is slower or uses
+more memory than the baseline by more than `--tolerance` is a regression
+and fails the run. Use `--save-baseline` to store the current results.
+
+Baselines depend on the machine, record them on the machine that runs
+the comparison.
+"""
+
+TOOLS = pathlib.Path(__file__).resolve().parent
+DSP56K = TOOLS.parent / "dsp56k"
+DEFAULT_BASELINE = TOOLS / "benchmark_baseline.json"
+DEFAULT_TOLERANCE = 0.25
+
+DEFAULT_SPEC = synth_flash.FlashSpec(model_type=lib.AccessVirusType.TI, commands=300, overlap=0.1)
+
+
+def word_count(path: pathlib.Path) -> int:
+    return path.stat().st_size // words.WORD_SIZE
+
+
+def run_tool(script: pathlib.Path, *args) -> None:
+    """ Run a tool as if it was started from the command line. """
+    argv = sys.argv
+    sys.argv = [str(script)] + [str(a) for a in args]
+    try:
+        runpy.run_path(str(script), run_name="__main__")
+    except SystemExit as e:
+        if e.code:
+            raise RuntimeError("%s exited with %s" % (script.name, e.code))
+    finally:
+        sys.argv = argv
+
+
+def chunk_file(file_id: str, chunks: List[Tuple[str, bytes]]) -> bytes:
+    """ A Virus TI install file (firmware or vti) with the given chunks. """
+    body = b''.join(name.encode('ascii') + len(data).to_bytes(4, 'big') + data for name, data in chunks)
+    return file_id.encode('ascii') + (8 + len(body)).to_bytes(4, 'big') + body
+
+
+def record_chunk(data: bytes) -> bytes:
+    """ A vti ROM chunk holding the data in records, with a 16-bit byte sum of the records as trailer. """
+    records = b''.join(b'\0' + offset.to_bytes(2, 'big') + data[offset:offset + vti.RECORD_DATA_SIZE]
+                       for offset in range(0, len(data), vti.RECORD_DATA_SIZE))
+    return records + (sum(records) & 0xFFFF).to_bytes(vti.TRAILER_SIZE, 'big')
+
+
+def synth_firmware(seed: int, rom_chunks: int = 8) -> bytes:
+    """ A firmware file with a vti file, of which each ROM has `rom_chunks` chunks of random records. """
+    rng = random.Random(seed)
+    chunk_data = 0x800 * vti.RECORD_DATA_SIZE  # the most records the 2 byte offsets address
+    chunks = [("%s%03d" % (rom, i), record_chunk(rng.randbytes(chunk_data)))
+              for rom in "FSP" for i in range(rom_chunks)]
+    table = bytes([1]) + b"vti.bin\0"
+    return chunk_file("FWBN", [("TABL", table), ("FILE", chunk_file("VTI ", chunks))])
+
+
+def prepare(work: pathlib.Path, spec: synth_flash.FlashSpec):
+    """ Write the synthetic flash image and the files derived from it. """
+    with open(work / "flash.bin", "wb") as fp:
+        fp.write(synth_flash.generate_flash(spec))
+
+    with lib.map_flash(work / "flash.bin") as flash:
+        bank_data = lib.get_dsp_bank_data(flash, spec.model_type)
+        chunk_data = lib.get_dsp_chunk_data(bank_data)
+        with open(work / "dsp.command_stream.be.bin", "wb") as out:
+            out.write(chunk_data.data.tobytes())
+        image = memory.DSPMemoryImage().replay(lib.iter_dsp_commands(chunk_data.data))
+        with open(work / "meta.json", "w") as out:
+            json.dump({'stream_words': len(bank_data.data)}, out)
+        del bank_data, chunk_data  # release the views on the flash image
+
+    for name, region in image.regions.items():
+        region.tofile(work / ("dsp.%s.be.bin" % name))
+    run_tool(DSP56K / "bin2lod.py", work / "dsp.p.be.bin", work / "dsp.p.lod")
+
+    # A later version of the P image for memdiff: a block moved to the end and a few words changed
+    rng = random.Random(spec.seed)
+    original = (work / "dsp.p.be.bin").read_bytes()
+    data = bytearray(original)
+    start = rng.randrange(len(data) // 2) // words.WORD_SIZE * words.WORD_SIZE
+    data += data[start:start + 0x400 * words.WORD_SIZE]
+    del data[start:start + 0x400 * words.WORD_SIZE]
+    for _ in range(100):
+        pos = rng.randrange(len(data) // words.WORD_SIZE) * words.WORD_SIZE
+        data[pos:pos + words.WORD_SIZE] = rng.randbytes(words.WORD_SIZE)
+    (work / "dsp2.p.be.bin").write_bytes(data)
+
+    # An index of the images for wordindex queries, of the first four non-zero words of the P image
+    run_tool(DSP56K / "wordindex.py", work / "index.sqlite", "add", work / "dsp.p.be.bin", work / "dsp.x.be.bin",
+             work / "dsp.y.be.bin")
+    values = words.decode(original)
+    first = next((i for i in range(len(values) - 3) if all(values[i:i + 4])), 0)
+    pattern = values[first:first + 4]
+    with open(work / "meta.json", "r+") as fp:
+        meta = json.load(fp)
+        meta['pattern'] = "%06x * %04x?? %06x" % (pattern[0], pattern[2] >> 8, pattern[3])
+        fp.seek(0)
+        json.dump(meta, fp)
+
+    with open(work / "firmware_bin", "wb") as fp:
+        fp.write(synth_firmware(spec.seed))
+    firmware.extract_entries(str(work / "firmware_bin"), str(work), ["vti.bin"])
+
+
+def _stream_words(work: pathlib.Path) -> int:
+    with open(work / "meta.json") as fp:
+        return json.load(fp)['stream_words']
+
+
+def bench_bank_data(work: pathlib.Path, spec: synth_flash.FlashSpec) -> int:
+    with lib.map_flash(work / "flash.bin") as flash:
+        return len(lib.get_dsp_bank_data(flash, spec.model_type).data)
+
+
+def bench_iter_commands(work: pathlib.Path, spec: synth_flash.FlashSpec) -> int:
+    stream = words.map_words(work / "dsp.command_stream.be.bin")
+    for _ in lib.iter_dsp_commands(stream):
+        pass
+    return len(stream)
+
+
+def bench_command_index(work: pathlib.Path, spec: synth_flash.FlashSpec) -> int:
+    stream = words.map_words(work / "dsp.command_stream.be.bin")
+    lib.DSPCommandIndex(stream)
+    return len(stream)
+
+
+def bench_replay(work: pathlib.Path, spec: synth_flash.FlashSpec) -> int:
+    stream = words.map_words(work / "dsp.command_stream.be.bin")
+    memory.DSPMemoryImage().replay(lib.iter_dsp_commands(stream))
+    return len(stream)
+
+
+def _region_bench(func: Callable[[bytes], object]) -> Callable[[pathlib.Path, synth_flash.FlashSpec], int]:
+    def bench(work: pathlib.Path, spec: synth_flash.FlashSpec) -> int:
+        with words.map_file(work / "dsp.p.be.bin") as data:
+            func(data)
+            return len(data) // words.WORD_SIZE
+    return bench
+
+
+def _output_folder(work: pathlib.Path) -> pathlib.Path:
+    """ A new, empty folder for the output of a single run. """
+    return pathlib.Path(tempfile.mkdtemp(prefix="out-", dir=work))
+
+
+def _tool_bench(script: pathlib.Path, *args: str, words_of: str = None):
+    """
+    Benchmark a tool, `{work}` in the arguments is replaced by the work folder.
+
+    `{out}` is replaced by a new, empty folder for every run.
+    """
+    def bench(work: pathlib.Path, spec: synth_flash.FlashSpec) -> int:
+        out = _output_folder(work)
+        run_tool(script, *[a.format(work=work, out=out) for a in args])
+        return word_count(work / words_of) if words_of else _stream_words(work)
+    return bench
+
+
+def bench_wordindex_query(work: pathlib.Path, spec: synth_flash.FlashSpec) -> int:
+    with open(work / "meta.json") as fp:
+        pattern = json.load(fp)['pattern']
+    run_tool(DSP56K / "wordindex.py", work / "index.sqlite", "query", pattern)
+    return sum(word_count(work / ("dsp.%s.be.bin" % region)) for region in memory.REGIONS)
+
+
+def bench_firmware(work: pathlib.Path, spec: synth_flash.FlashSpec) -> int:
+    firmware.extract_entries(str(work / "firmware_bin"), str(_output_folder(work)))
+    return word_count(work / "firmware_bin")
+
+
+def bench_vti(work: pathlib.Path, spec: synth_flash.FlashSpec) -> int:
+    vti.extract_roms(str(work / "vti.bin"), str(_output_folder(work)), ['F', 'S', 'P'])
+    return word_count(work / "vti.bin")
+
+
+def bench_validate(work: pathlib.Path, spec: synth_flash.FlashSpec) -> int:
+    report = validate.validate_file(work / "firmware_bin")
+    if report['status'] != 'ok':
+        raise RuntimeError("Synthetic firmware file is corrupt: %s" % report['errors'])
+    return word_count(work / "firmware_bin")
+
+
+def bench_generate(work: pathlib.Path, spec: synth_flash.FlashSpec) -> int:
+    return len(synth_flash.generate_stream(spec)) // words.WORD_SIZE
+
+
+BENCHMARKS: Dict[str, Callable[[pathlib.Path, synth_flash.FlashSpec], int]] = {
+    'synth_flash.generate_stream': bench_generate,
+    'lib.get_dsp_bank_data': bench_bank_data,
+    'lib.iter_dsp_commands': bench_iter_commands,
+    'lib.DSPCommandIndex': bench_command_index,
+    'memory.DSPMemoryImage.replay': bench_replay,
+    'memory.split_12bit': _region_bench(memory.split_12bit),
+    'words.decode': _region_bench(words.decode),
+    'words.encode': _region_bench(lambda data: words.encode(words.decode(data))),
+    'words.swap': _region_bench(words.swap),
+    'words.format_hex': _region_bench(words.format_hex),
+    'dump_bootstrap': _tool_bench(TOOLS / "dump_bootstrap.py", "{work}/flash.bin", "{work}/out"),
+    'dump_dsp_memory': _tool_bench(TOOLS / "dump_dsp_memory.py", "{work}/dsp.command_stream.be.bin", "{work}/out",
+                                   words_of="dsp.command_stream.be.bin"),
+    'extract_corpus': _tool_bench(TOOLS / "extract_corpus.py", "{work}/flash.bin", "{work}/corpus",
+                                  "--workers", "1", "--no-cache"),
+    'be2le': _tool_bench(DSP56K / "be2le.py", "{work}/dsp.p.be.bin", "{work}/out.p.le.bin", words_of="dsp.p.be.bin"),
+    'bin2io': _tool_bench(DSP56K / "bin2io.py", "{work}/dsp.command_stream.be.bin", "{work}/out.io", "2",
+                          words_of="dsp.command_stream.be.bin"),
+    'bin2lod': _tool_bench(DSP56K / "bin2lod.py", "{work}/dsp.p.be.bin", "{out}/dsp.p.lod", words_of="dsp.p.be.bin"),
+    'lod2bin': _tool_bench(DSP56K / "lod2bin.py", "{work}/dsp.p.lod", "{out}/dsp", words_of="dsp.p.be.bin"),
+    'patch_omr_sr': _tool_bench(DSP56K / "patch_omr_sr.py", "{work}/dsp.command_stream.be.bin",
+                                "{work}/out.patched.be.bin", words_of="dsp.command_stream.be.bin"),
+    'patch': _tool_bench(DSP56K / "patch.py", str(DSP56K / "omr_sr.json"), "{work}/dsp.command_stream.be.bin",
+                         "{work}/out.patched.be.bin", words_of="dsp.command_stream.be.bin"),
+    'pipeline': _tool_bench(TOOLS / "pipeline.py", "{work}/flash.bin", "{out}/dsp"),
+    'memdiff': _tool_bench(DSP56K / "memdiff.py", "{work}/dsp.p.be.bin", "{work}/dsp2.p.be.bin",
+                           words_of="dsp.p.be.bin"),
+    'wordindex.add': _tool_bench(DSP56K / "wordindex.py", "{out}/index.sqlite", "add", "{work}/dsp.p.be.bin",
+                                 words_of="dsp.p.be.bin"),
+    'wordindex.query': bench_wordindex_query,
+    'xrefs': _tool_bench(TOOLS / "xrefs.py", "{work}/dsp", "--csv", "{out}/xrefs.csv", words_of="dsp.p.be.bin"),
+    'repack': _tool_bench(TOOLS / "repack.py", "{work}/flash.bin", "{out}/flash.bin", "--images", "{work}/dsp"),
+    'virus_ti.firmware': bench_firmware,
+    'virus_ti.vti': bench_vti,
+    'virus_ti.validate': bench_validate,
+}
+
+
+def run_child(name: str, work: pathlib.Path, spec: synth_flash.FlashSpec):
+    """ Run a single benchmark in this process and print the result. """
+    logging.disable(logging.CRITICAL)  # the tools log every step
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):  # and some print their results
+        started = time.perf_counter()
+        count = BENCHMARKS[name](work, spec)
+        elapsed = time.perf_counter() - started
+    print(json.dumps({'words': count, 'seconds': elapsed, 'peak_rss_kb': metrics.peak_rss_kb()}))
+
+
+def measure(name: str, work: pathlib.Path, spec_args: List[str]) -> dict:
+    """ Run a benchmark in a new process, returning its time and peak RSS. """
+    proc = subprocess.run([sys.executable, __file__, "--child", name, str(work)] + spec_args,
+                          stdout=subprocess.PIPE)
+    if proc.returncode:
+        raise RuntimeError("Benchmark %s failed" % name)
+    return json.loads(proc.stdout)
+
+
+def run_benchmarks(names: List[str], spec: synth_flash.FlashSpec, spec_args: List[str], repeat: int) -> Dict[str, dict]:
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="dsp563c-bench-") as tmp:
+        work = pathlib.Path(tmp)
+        logging.disable(logging.INFO)
+        prepare(work, spec)
+        logging.disable(logging.NOTSET)
+
+        for name in names:
+            runs = [measure(name, work, spec_args) for _ in range(repeat)]
+            best = min(runs, key=lambda r: r['seconds'])
+            results[name] = {
+                'words': best['words'],
+                'seconds': round(best['seconds'], 6),
+                'words_per_second': round(best['words'] / best['seconds']) if best['seconds'] else 0,
+                'peak_rss_kb': min(r['peak_rss_kb'] for r in runs),
+            }
+            logger.info("%-30s %12d words/s %10d KB", name, results[name]['words_per_second'],
+                        results[name]['peak_rss_kb'])
+    return results
+
+
+def find_regressions(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """ Compare the results against the baseline, returning a message per regression. """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        if result['words_per_second'] < base['words_per_second'] * (1 - tolerance):
+            regressions.append("%s: %d words/s, baseline %d words/s" %
+                               (name, result['words_per_second'], base['words_per_second']))
+        if result['peak_rss_kb'] > base['peak_rss_kb'] * (1 + tolerance):
+            regressions.append("%s: peak RSS %d KB, baseline %d KB" %
+                               (name, result['peak_rss_kb'], base['peak_rss_kb']))
+    return regressions
+
+
+def spec_to_dict(spec: synth_flash.FlashSpec) -> dict:
+    spec_dict = asdict(spec)
+    spec_dict['model_type'] = spec.model_type.name
+    spec_dict['mix'] = {str(k): v for k, v in spec.mix.items()}
+    return spec_dict
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the tools on a synthetic flash image.")
+    parser.add_argument("--model", choices=[t.name for t in lib.AccessVirusType], default=DEFAULT_SPEC.model_type.name)
+    parser.add_argument("--commands", type=int, default=DEFAULT_SPEC.commands, help="number of write commands")
+    parser.add_argument("--overlap", type=float, default=DEFAULT_SPEC.overlap,
+                        help="fraction of commands that overwrite an earlier command")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SPEC.seed)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark (default: %(default)s)")
+    parser.add_argument("--filter", nargs="+", default=None, metavar="NAME", help="only run these benchmarks")
+    parser.add_argument("--baseline", default=str(DEFAULT_BASELINE), help="baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="allowed slowdown or memory growth (default: %(default)s)")
+    parser.add_argument("--output", default=None, help="write the results as JSON to this file")
+    parser.add_argument("--child", nargs=2, metavar=("NAME", "WORK"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    spec = synth_flash.FlashSpec(model_type=lib.AccessVirusType[args.model], commands=args.commands,
+                                 overlap=args.overlap, seed=args.seed)
+    if args.child:
+        run_child(args.child[0], pathlib.Path(args.child[1]), spec)
+        return
+
+    logging.basicConfig(level=logging.INFO)
+
+    names = args.filter or list(BENCHMARKS)
+    unknown = [n for n in names if n not in BENCHMARKS]
+    if unknown:
+        parser.error("unknown benchmarks: %s" % ", ".join(unknown))
+
+    spec_args = ["--model", args.model, "--commands", str(args.commands), "--overlap", str(args.overlap),
+                 "--seed", str(args.seed)]
+    results = run_benchmarks(names, spec, spec_args, args.repeat)
+    report = {'spec': spec_to_dict(spec), 'results': results}
+
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
+
+    baseline_path = pathlib.Path(args.baseline)
+    if args.save_baseline:
+        # Keep the baseline of benchmarks that were not run
+        if baseline_path.exists():
+            with open(baseline_path) as fp:
+                stored = json.load(fp)
+            if stored['spec'] == report['spec']:
+                report['results'] = {**stored['results'], **results}
+        with open(baseline_path, "w") as fp:
+            json.dump(report, fp, indent=2)
+        logger.info("Saved baseline to %s", baseline_path)
+        return
+
+    if not baseline_path.exists():
+        logger.warning("No baseline found at %s, use --save-baseline to store one", baseline_path)
+        return
+
+    with open(baseline_path) as fp:
+        baseline = json.load(fp)
+    if baseline['spec'] != report['spec']:
+        logger.error("Baseline %s was recorded for a different flash image spec", baseline_path)
+        sys.exit(-1)
+
+    regressions = find_regressions(results, baseline['results'], args.tolerance)
+    for regression in regressions:
+        logger.error("Regression: %s", regression)
+    if regressions:
+        sys.exit(1)
+    logger.info("No regressions against %s", baseline_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import json
+import logging
+import pathlib
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import cache
+import dump_bootstrap
+import dump_dsp_memory
+import extract_corpus
+import lib
+import memory
+import be2le  # shared with dsp56k, made importable by lib
+import bin2io  # shared with dsp56k, made importable by lib
+import bin2lod  # shared with dsp56k, made importable by lib
+import metrics  # shared with dsp56k, made importable by lib
+import words  # shared codec, made importable by lib
+
+logger = logging.getLogger(__name__)
+
+"""
+Incremental builds of the extraction outputs of a directory of flash dumps.
+
+Usage: python3 build.py <input_dir_or_glob> <output_folder> [--workers N] [--watch]
+
+Every dump `<name>` is built through the following stages, each stage
+only depends on the files written by the stages before it:
+
+ bootstrap: <name>.bootrom.be.bin, <name>.bootrom_stream.be.bin,
+            <name>.command_stream.be.bin (see `dump_bootstrap.py`)
+ regions: <name>.p.be.bin, <name>.x.be.bin, <name>.y.be.bin
+          (see `dump_dsp_memory.py`)
+ le.<region>: <name>.<region>.le.bin (see `be2le.py`)
+ lod: <name>.lod, the P, X and Y memory with the entrypoint (see `bin2lod.py`)
+ io.<stream>: <name>.bootrom_stream.be.io and <name>.command_stream.be.io
+              (see `bin2io.py`)
+
+`build.json` in the output folder records the SHA-256 of the inputs and
+outputs of every stage, along with a version of the tool: a hash of the
+source of the modules the stage runs. A stage only runs again when an
+input, an output or the tool changed. A stage that writes the same files
+as before does not trigger the stages that depend on it.
+
+Stages that do not depend on each other (the stages of different dumps,
+the little endian conversions, the LOD and the IO files) run in parallel
+on a pool of worker processes.
+
+With `--watch`, the input is polled for new or modified dumps every
+`--interval` seconds, and the outputs are rebuilt when anything changed.
+"""
+
+STATE_NAME = "build.json"
+STATE_VERSION = 1
+DEFAULT_INTERVAL = 2.0
+
+BOOTSTRAP_STREAMS = list(dump_bootstrap.ARTIFACT_NAMES)
+IO_STREAMS = ['bootrom_stream', 'command_stream']
+
+
+def _bootstrap(inputs: List[pathlib.Path], outputs: List[pathlib.Path], stats: metrics.Metrics):
+    _, bank_data = dump_bootstrap.read_bank_data(inputs[0], stats)
+    chunk_data = dump_bootstrap.split_chunk_data(bank_data, stats)
+    artifacts = dump_bootstrap.bootstrap_artifacts(chunk_data, stats)
+    for name, file_path in zip(BOOTSTRAP_STREAMS, outputs):
+        dump_bootstrap.write_file(file_path, artifacts[name], stats)
+
+
+def _regions(inputs: List[pathlib.Path], outputs: List[pathlib.Path], stats: metrics.Metrics):
+    image = dump_dsp_memory.replay_stream(words.map_words(inputs[0]), stats)
+    for name, file_path in zip(memory.REGIONS, outputs):
+        dump_dsp_memory.write_region(image.regions[name], file_path, stats=stats)
+
+
+def _le(inputs: List[pathlib.Path], outputs: List[pathlib.Path], stats: metrics.Metrics):
+    be2le.be2le(inputs[0], outputs[0], stats)
+
+
+def _lod(inputs: List[pathlib.Path], outputs: List[pathlib.Path], stats: metrics.Metrics):
+    stream, *images = inputs
+    entry = dump_dsp_memory.parse_commands(words.map_words(stream), stats)[-1].addr
+    bin2lod.bin2lod([(name.upper(), 0, src) for name, src in zip(memory.REGIONS, images)], outputs[0],
+                    entry=entry, stats=stats)
+
+
+def _io(inputs: List[pathlib.Path], outputs: List[pathlib.Path], stats: metrics.Metrics):
+    with open(outputs[0], "wb") as fp:
+        bin2io.bin2io(inputs[0], fp, stats=stats)
+
+
+# Stage kinds: the function that builds the outputs and the modules it runs
+STAGES: Dict[str, Tuple[Callable, list]] = {
+    'bootstrap': (_bootstrap, [lib, words, dump_bootstrap]),
+    'regions': (_regions, [lib, words, memory, dump_dsp_memory]),
+    'le': (_le, [words, be2le]),
+    'lod': (_lod, [lib, words, dump_dsp_memory, bin2lod]),
+    'io': (_io, [words, bin2io]),
+}
+
+
+def tool_version(kind: str) -> str:
+    """ Hash of the source of all modules a stage kind runs. """
+    return cache.source_version(STAGES[kind][1])
+
+
+@dataclass
+class Target:
+    name: str  # <dump>:<stage>
+    kind: str
+    inputs: List[pathlib.Path]
+    outputs: List[pathlib.Path]
+    deps: List[str] = field(default_factory=list)
+
+
+def dump_targets(src: pathlib.Path, prefix: pathlib.Path) -> List[Target]:
+    """ The stages of a single dump, writing to `<prefix>.*`. """
+    name = prefix.name
+    streams = {s: pathlib.Path("%s.%s.be.bin" % (prefix, s)) for s in BOOTSTRAP_STREAMS}
+    images = {r: pathlib.Path("%s.%s.be.bin" % (prefix, r)) for r in memory.REGIONS}
+    bootstrap = Target("%s:bootstrap" % name, 'bootstrap', [src], list(streams.values()))
+    regions = Target("%s:regions" % name, 'regions', [streams['command_stream']], list(images.values()),
+                     [bootstrap.name])
+    targets = [bootstrap, regions]
+    for region, image in images.items():
+        targets.append(Target("%s:le.%s" % (name, region), 'le', [image],
+                              [pathlib.Path("%s.%s.le.bin" % (prefix, region))], [regions.name]))
+    targets.append(Target("%s:lod" % name, 'lod', [streams['command_stream']] + list(images.values()),
+                          [pathlib.Path("%s.lod" % prefix)], [bootstrap.name, regions.name]))
+    for stream in IO_STREAMS:
+        targets.append(Target("%s:io.%s" % (name, stream), 'io', [streams[stream]],
+                              [pathlib.Path("%s.%s.be.io" % (prefix, stream))], [bootstrap.name]))
+    return targets
+
+
+class FileHashes:
+    """ SHA-256 of files, only hashed again when their size or modification time changed. """
+
+    def __init__(self, entries: Dict[str, list] = None):
+        self.entries = entries or {}
+
+    def get(self, path: pathlib.Path) -> Optional[str]:
+        """ Hash of the file, or None when it does not exist. """
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            return None
+        entry = self.entries.get(str(path))
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        digest = cache.hash_file(path)
+        self.entries[str(path)] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def update(self, entries: Dict[str, list]):
+        self.entries.update(entries)
+
+
+def run_target(kind: str, inputs: List[pathlib.Path], outputs: List[pathlib.Path]) -> Tuple[Dict[str, list], dict]:
+    """ Run a stage in a worker process, returning the hash entries of its outputs and its timings. """
+    stats = metrics.Metrics()
+    STAGES[kind][0](inputs, outputs, stats)
+    hashes = FileHashes()
+    for path in outputs:
+        hashes.get(path)
+    return hashes.entries, stats.timings()
+
+
+class BuildGraph:
+    """
+    Stages of all dumps in an output folder, along with the state of the last build.
+
+    The state is saved after every build, and kept for the stages of
+    dumps that are not part of the current build.
+    """
+
+    def __init__(self, output: pathlib.Path):
+        self.output = output
+        self.state_path = output / STATE_NAME
+        state = {}
+        if self.state_path.exists():
+            with open(self.state_path) as fp:
+                state = json.load(fp)
+            if state.get('version') != STATE_VERSION:
+                state = {}
+        self.hashes = FileHashes(state.get('hashes'))
+        self.records: Dict[str, dict] = state.get('stages', {})
+        self.tools = {kind: tool_version(kind) for kind in STAGES}
+
+    def save(self):
+        # Only keep the hashes of files that are part of a recorded stage
+        paths = {p for r in self.records.values() for p in list(r['inputs']) + list(r['outputs'])}
+        self.hashes.entries = {p: e for p, e in self.hashes.entries.items() if p in paths}
+        tmp = self.state_path.with_suffix(".tmp")
+        with open(tmp, "w") as fp:
+            json.dump({'version': STATE_VERSION, 'hashes': self.hashes.entries, 'stages': self.records}, fp, indent=2)
+        tmp.replace(self.state_path)
+
+    def is_current(self, target: Target) -> bool:
+        """ Whether the inputs, outputs and tool of a stage are the same as in its last build. """
+        record = self.records.get(target.name)
+        if not record or record['tool'] != self.tools[target.kind]:
+            return False
+        if record['inputs'] != {str(p): self.hashes.get(p) for p in target.inputs}:
+            return False
+        return all(self.hashes.get(p) == record['outputs'].get(str(p)) for p in target.outputs)
+
+    def build(self, targets: List[Target], workers: int = None) -> Dict[str, str]:
+        """
+        Run all stages that are not current, returning the status of each stage.
+
+        A stage is `built`, `current`, `failed` or `skipped` (when a stage it
+        depends on failed). Independent stages run in parallel.
+        """
+        by_name = {t.name: t for t in targets}
+        status: Dict[str, str] = {}
+        pending = list(targets)
+        running: Dict[concurrent.futures.Future, Tuple[Target, Dict[str, str]]] = {}
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            while pending or running:
+                # Check every stage whose dependencies are done, and submit the ones that are not current
+                waiting = []
+                for target in pending:
+                    dep_status = [status.get(d) for d in target.deps if d in by_name]
+                    if any(s is None for s in dep_status):
+                        waiting.append(target)
+                    elif any(s in ('failed', 'skipped') for s in dep_status):
+                        status[target.name] = 'skipped'
+                    elif self.is_current(target):
+                        status[target.name] = 'current'
+                    else:
+                        inputs = {str(p): self.hashes.get(p) for p in target.inputs}
+                        future = pool.submit(run_target, target.kind, target.inputs, target.outputs)
+                        running[future] = target, inputs
+                if len(waiting) == len(pending) and not running:
+                    raise ValueError("Stages with unresolved dependencies: %s"
+                                     % ", ".join(t.name for t in waiting))
+                pending = waiting
+                if not running:
+                    continue
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    target, inputs = running.pop(future)
+                    try:
+                        entries, timings = future.result()
+                    except Exception as e:
+                        status[target.name] = 'failed'
+                        self.records.pop(target.name, None)
+                        logger.error("Failed to build %s: %s: %s", target.name, type(e).__name__, e)
+                        continue
+                    self.hashes.update(entries)
+                    self.records[target.name] = {
+                        'tool': self.tools[target.kind],
+                        'inputs': inputs,
+                        'outputs': {path: entry[2] for path, entry in entries.items()},
+                        'timings': timings,
+                    }
+                    status[target.name] = 'built'
+                    logger.info("Built %s", target.name)
+        self.save()
+        return status
+
+
+def find_targets(pattern: str, output: pathlib.Path) -> List[Target]:
+    dumps = extract_corpus.find_dumps(pattern)
+    prefixes = extract_corpus.output_prefixes(dumps)
+    return [t for src, prefix in zip(dumps, prefixes) for t in dump_targets(src, output / prefix)]
+
+
+def snapshot(pattern: str) -> Set[Tuple[str, int, int]]:
+    """ Path, size and modification time of every dump, to detect changes while watching. """
+    snap = set()
+    for path in extract_corpus.find_dumps(pattern):
+        try:
+            st = path.stat()
+        except FileNotFoundError:  # removed while listing
+            continue
+        snap.add((str(path), st.st_size, st.st_mtime_ns))
+    return snap
+
+
+def build_once(pattern: str, output: pathlib.Path, workers: int = None) -> bool:
+    """ Build all dumps, returns whether all stages succeeded. """
+    targets = find_targets(pattern, output)
+    if not targets:
+        logger.warning("No flash dumps found for %s", pattern)
+        return True
+    started = time.perf_counter()
+    status = BuildGraph(output).build(targets, workers)
+    counts = {s: sum(1 for v in status.values() if v == s) for s in ('built', 'current', 'failed', 'skipped')}
+    logger.info("%d stages built, %d current, %d failed, %d skipped in %.2fs",
+                counts['built'], counts['current'], counts['failed'], counts['skipped'],
+                time.perf_counter() - started)
+    return not counts['failed'] and not counts['skipped']
+
+
+def watch(pattern: str, output: pathlib.Path, workers: int = None, interval: float = DEFAULT_INTERVAL):
+    """ Build, then poll the input for new or modified dumps and build again, until interrupted. """
+    last = None
+    while True:
+        snap = snapshot(pattern)
+        if snap != last:
+            if last is not None:
+                logger.info("Input changed, rebuilding")
+            build_once(pattern, output, workers)
+            last = snap
+        time.sleep(interval)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Incrementally build the extraction outputs of flash dumps.")
+    parser.add_argument("input", help="directory or glob pattern of flash dumps")
+    parser.add_argument("output", help="output folder")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument("--watch", action="store_true", help="keep polling the input for changes")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL,
+                        help="seconds between polls in watch mode (default: %(default)s)")
+    args = parser.parse_args()
+
+    output = pathlib.Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+
+    try:
+        if args.watch:
+            watch(args.input, output, args.workers, args.interval)
+        elif not build_once(args.input, output, args.workers):
+            sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+    except ValueError as e:
+        logger.error("%s", e)
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
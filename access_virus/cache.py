@@ -0,0 +1,175 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+from dataclasses import dataclass
+from types import ModuleType
+from typing import Dict, Iterable, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 1 << 30  # 1G
+META_FILE = "meta.json"
+
+
+def default_cache_dir() -> pathlib.Path:
+    """ Cache folder, following the XDG base directory specification. """
+    root = os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache"
+    return pathlib.Path(root) / "dsp563c-tools"
+
+
+def hash_file(path: pathlib.Path, chunk_size: int = 1 << 20) -> str:
+    """ SHA-256 of the file contents. """
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        while chunk := fp.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_version(modules: Iterable[ModuleType]) -> str:
+    """ Hash of the source of the given modules, any change to them results in a new version. """
+    digest = hashlib.sha256()
+    for module in modules:
+        digest.update(pathlib.Path(module.__file__).read_bytes())
+    return digest.hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+
+    def report(self) -> str:
+        total = self.hits + self.misses
+        ratio = self.hits / total * 100 if total else 0
+        return "%d hits, %d misses (%.1f%% hit rate)" % (self.hits, self.misses, ratio)
+
+
+class ArtifactCache:
+    """
+    Content-addressed on-disk cache of extraction artifacts.
+
+    Entries are keyed by a hash of the input image, the tool name and
+    the tool version (the `source_version` of the modules that produce
+    the artifacts, so entries of older code are never used). Each entry
+    is a folder with one file per artifact plus a metadata file. The
+    folder modification time tracks the last use, which `evict` uses to
+    remove the least recently used entries once the cache exceeds
+    `max_size` bytes.
+
+    A disabled cache never hits and never stores anything.
+    """
+
+    def __init__(self, root: pathlib.Path = None, max_size: int = DEFAULT_MAX_SIZE, enabled: bool = True):
+        self.root = pathlib.Path(root) if root else default_cache_dir()
+        self.max_size = max_size
+        self.enabled = enabled
+        self.stats = CacheStats()
+
+    def key(self, src: pathlib.Path, tool: str, version: str) -> str:
+        """ Cache key for the output of version `version` of `tool` on the input file `src`. """
+        digest = hashlib.sha256()
+        digest.update(hash_file(src).encode())
+        digest.update(("%s:%s" % (tool, version)).encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> pathlib.Path:
+        return self.root / key[:2] / key
+
+    def get(self, key: str) -> Optional[dict]:
+        """ Get the metadata of a cached entry and mark it as used, or None on a miss. """
+        path = self._path(key)
+        if not self.enabled or not (path / META_FILE).exists():
+            self.stats.misses += 1
+            return None
+
+        os.utime(path)  # mark as recently used
+        self.stats.hits += 1
+        with open(path / META_FILE) as fp:
+            return json.load(fp)
+
+    def artifact(self, key: str, name: str) -> pathlib.Path:
+        """ Path of a single artifact of a cached entry. """
+        return self._path(key) / name
+
+    def read(self, key: str, name: str) -> bytes:
+        with open(self.artifact(key, name), "rb") as fp:
+            return fp.read()
+
+    def put(self, key: str, meta: dict, artifacts: Dict[str, Union[bytes, pathlib.Path]]):
+        """
+        Store artifacts (as data or as the path of a file to copy) under the given key.
+
+        The entry is written to a temporary folder and renamed into place,
+        so concurrent writers and readers never see a partial entry.
+        """
+        if not self.enabled:
+            return
+
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = pathlib.Path(tempfile.mkdtemp(prefix=".tmp-", dir=path.parent))
+        try:
+            for name, artifact in artifacts.items():
+                if isinstance(artifact, (bytes, bytearray, memoryview)):
+                    with open(tmp / name, "wb") as fp:
+                        fp.write(artifact)
+                else:
+                    shutil.copyfile(artifact, tmp / name)
+            with open(tmp / META_FILE, "w") as fp:
+                json.dump(meta, fp)
+            os.replace(tmp, path)
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not (path / META_FILE).exists():
+                raise
+
+    def entries(self) -> Dict[pathlib.Path, os.stat_result]:
+        """ All cached entries with the stat result of their folder. """
+        if not self.root.exists():
+            return {}
+        return {p: p.stat() for p in self.root.glob("??/*") if p.is_dir() and not p.name.startswith(".tmp-")}
+
+    @staticmethod
+    def _size(path: pathlib.Path) -> int:
+        return sum(f.stat().st_size for f in path.iterdir())
+
+    def size(self) -> int:
+        """ Total size of all cached entries in bytes. """
+        return sum(self._size(p) for p in self.entries())
+
+    def evict(self) -> int:
+        """ Remove the least recently used entries until the cache fits in `max_size`, returns the count. """
+        entries = sorted(self.entries().items(), key=lambda e: e[1].st_mtime)
+        sizes = {path: self._size(path) for path, _ in entries}
+        total = sum(sizes.values())
+        evicted = 0
+        for path, _ in entries:
+            if total <= self.max_size:
+                break
+            logger.debug("Evicting cache entry %s", path.name)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= sizes[path]
+            evicted += 1
+        return evicted
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def report(self) -> dict:
+        """ Hit/miss counters and the current size of the cache. """
+        entries = self.entries()
+        return {
+            'enabled': self.enabled,
+            'root': str(self.root),
+            'hits': self.stats.hits,
+            'misses': self.stats.misses,
+            'entries': len(entries),
+            'size': sum(self._size(p) for p in entries),
+            'max_size': self.max_size,
+        }
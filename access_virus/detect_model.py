@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+import argparse
+import dataclasses
+import json
+import logging
+import pathlib
+import shutil
+import sys
+from typing import List
+
+import extract_corpus
+import lib
+import metrics  # shared with dsp56k, made importable by lib
+
+logger = logging.getLogger(__name__)
+
+"""
+Detects the model and dsp banks of Access Virus flash dumps by their contents.
+
+Usage: python3 detect_model.py <input_dir_or_glob> [--json FILE] [--sort DIR]
+
+Unlike the file size, the contents also identify trimmed or padded dumps.
+Every 32K bank boundary of a dump is scanned for a run of dsp bank headers
+counting down to 0, followed by the version string (see
+`lib.detect_dsp_layout`). Prints the first dsp bank, the number of dsp banks,
+the BootROM size and offset, and the version of every dump.
+
+`--sort DIR` copies every dump to `DIR/<model>/`, or `DIR/unknown/` when
+no dsp banks were found.
+"""
+
+UNKNOWN = "unknown"
+
+
+def detect(dumps: List[pathlib.Path], stats: metrics.Metrics = None) -> List[dict]:
+    """ Detect the dsp layout of every dump, returning an entry per dump. """
+    stats = stats or metrics.Metrics()
+    entries = []
+    for src in dumps:
+        entry = {'file': str(src)}
+        try:
+            with stats.stage('detect') as stage, lib.map_flash(src) as flash:
+                entry['size'] = len(flash)
+                layout = lib.detect_dsp_layout(flash)
+                stage.add(len(flash))
+            entry['model'] = layout.model_type.name if layout else UNKNOWN
+            if layout:
+                entry.update(dataclasses.asdict(layout), dsp_bank=layout.dsp_bank)
+                del entry['flash_size']  # same as the size
+        except (ValueError, OSError) as e:
+            entry['model'] = UNKNOWN
+            entry['error'] = "%s: %s" % (type(e).__name__, e)
+        entries.append(entry)
+    return entries
+
+
+def sort_dumps(entries: List[dict], output: pathlib.Path):
+    """ Copy every dump to a folder named after its model. """
+    for entry in entries:
+        folder = output / entry['model'].lower()
+        folder.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(entry['file'], folder)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Detect the model of Access Virus flash dumps by their contents.")
+    parser.add_argument("input", help="directory or glob pattern of flash dumps")
+    parser.add_argument("--json", help="write the detected layout of every dump to this file")
+    parser.add_argument("--sort", help="copy every dump to a folder per model in this directory")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    dumps = extract_corpus.find_dumps(args.input)
+    if not dumps:
+        logger.error("No flash dumps found for %s", args.input)
+        sys.exit(-1)
+
+    with metrics.session(args) as stats:
+        entries = detect(dumps, stats)
+
+    for entry in entries:
+        if 'error' in entry:
+            logger.error("%s: %s", entry['file'], entry['error'])
+        elif 'dsp_bank' not in entry:
+            print("%s: 0x%x bytes, no dsp banks found" % (entry['file'], entry['size']))
+        else:
+            print("%s: 0x%x bytes, %s, dsp banks %d - %d, BootROM 0x%x words at 0x%x, score %d, version %r" % (
+                entry['file'], entry['size'], entry['model'], entry['dsp_bank'],
+                entry['dsp_bank'] + entry['bank_count'] - 1, entry['bootrom_size'], entry['bootrom_offset'],
+                entry['score'], entry['version']))
+
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump(entries, fp, indent=2)
+        logger.info("Successfully wrote %s", args.json)
+    if args.sort:
+        sort_dumps(entries, pathlib.Path(args.sort))
+        logger.info("Sorted %d dumps into %s", len(entries), args.sort)
+
+
+if __name__ == "__main__":
+    main()
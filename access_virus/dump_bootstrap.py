@@ -1,11 +1,14 @@
 #!/usr/bin/env python3
+import argparse
 import logging
 import pathlib
 import sys
+from typing import Dict, Tuple
 
 import lib
+import metrics  # shared with dsp56k, made importable by lib
+import words  # shared codec, made importable by lib
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 """
@@ -31,62 +34,105 @@ The last file can be used as input for `dump_dsp_memory.py`.
 All files will be written in big endian. Use `be2le.py` to convert to 
 little endian for loading in IDA Pro.
 
+The steps are also available as functions, see `pipeline.py` for a
+tool that chains them with `dump_dsp_memory.py` in a single process.
+
 Note: This command will overwrite existing output files.
 
 Requires python version 3.8+.
 """
 
-if len(sys.argv) != 3:
-    logger.info("Usage: python3 %s <flash_file> <output_file_prefix>", sys.argv[0])
-    sys.exit(-1)
-
-# Make sure the input file exists
-src = pathlib.Path(sys.argv[1])
-if not src.exists():
-    logger.error("Input file %s does not exist!", src)
-    sys.exit(-1)
-
-# Find the model type based on the file size
-file_size = src.stat().st_size
-model_type = lib.AccessVirusType.from_size(file_size)
-if not model_type:
-    logger.error("Could not determine Access Virus model type for file size %sK", file_size // 1024)
-    sys.exit(-1)
-
-# Parse the banks that contain DSP code/data
-with open(src, "rb") as fp:
-    bank_data = lib.get_dsp_bank_data(fp, model_type)
-
-logger.info("Flash version: %s, Size: 0x%x", bank_data.version, len(bank_data.data))
-
-# Parse the bank data into BootROM and CommandStream
-chunk_data = lib.get_dsp_chunk_data(bank_data)
-logger.info("BootROM size: 0x%x", chunk_data.bootrom_size)
-logger.info("BootROM offset: 0x%x", chunk_data.bootrom_offset)
-logger.info("CommandStream size: 0x%x", len(chunk_data.data))
-
-# Write BootROM
-file_path = "%s.bootrom.be.bin" % sys.argv[2]
-with open(file_path, "wb") as fp:
-    for word in chunk_data.bootrom_data:
-        fp.write(word.to_bytes(3, 'big'))
-
-logger.info("Successfully wrote BootROM to %s", file_path)
-
-# Write BootROMStream
-file_path = "%s.bootrom_stream.be.bin" % sys.argv[2]
-with open(file_path, "wb") as fp:
-    fp.write(chunk_data.bootrom_size.to_bytes(3, 'big'))
-    fp.write(chunk_data.bootrom_offset.to_bytes(3, 'big'))
-    for word in chunk_data.bootrom_data:
-        fp.write(word.to_bytes(3, 'big'))
-
-logger.info("Successfully wrote BootROMStream to %s", file_path)
-
-# Write CommandStream
-file_path = "%s.command_stream.be.bin" % sys.argv[2]
-with open(file_path, "wb") as fp:
-    for word in chunk_data.data:
-        fp.write(word.to_bytes(3, 'big'))  # BootROM expects data in big endian
-
-logger.info("Successfully wrote CommandStream to %s", file_path)
+ARTIFACT_NAMES = {'bootrom': "BootROM", 'bootrom_stream': "BootROMStream", 'command_stream': "CommandStream"}
+
+
+def read_bank_data(src: pathlib.Path,
+                   stats: metrics.Metrics = None) -> Tuple[lib.AccessVirusType, lib.DSPBankData]:
+    """
+    Find the model type and parse the banks that contain DSP code/data.
+
+    The dsp banks are found by their contents (see `lib.find_dsp_banks`),
+    so trimmed and padded dumps can be read as well. The flash image is
+    mapped once, the dsp banks are copied out of the map in one go so it
+    is closed on return.
+    """
+    stats = stats or metrics.Metrics()
+    with stats.stage('bank_data') as stage, lib.map_flash(src) as flash:
+        model_type, dsp_offset = lib.find_dsp_banks(flash)
+        bank_data = lib.get_dsp_bank_data(flash, model_type, dsp_offset)
+        bank_data = lib.DSPBankData(bank_data.version, words.WordBuffer([bank_data.data.tobytes()]))
+        stage.add(len(bank_data.data) * words.WORD_SIZE)
+    return model_type, bank_data
+
+
+def bootstrap_artifacts(chunk_data: lib.DSPChunkData, stats: metrics.Metrics = None) -> Dict[str, bytes]:
+    """ Encode the BootROM, BootROMStream and CommandStream (all big endian). """
+    stats = stats or metrics.Metrics()
+    with stats.stage('encode') as stage:
+        bootrom = words.encode(chunk_data.bootrom_data)
+        artifacts = {
+            'bootrom': bootrom,
+            'bootrom_stream': words.encode([chunk_data.bootrom_size, chunk_data.bootrom_offset]) + bootrom,
+            'command_stream': words.encode(chunk_data.data),  # BootROM expects data in big endian
+        }
+        stage.add(sum(len(data) for data in artifacts.values()))
+    return artifacts
+
+
+def split_chunk_data(bank_data: lib.DSPBankData, stats: metrics.Metrics = None) -> lib.DSPChunkData:
+    """ Parse the bank data into BootROM and CommandStream. """
+    stats = stats or metrics.Metrics()
+    with stats.stage('chunk_data') as stage:
+        chunk_data = lib.get_dsp_chunk_data(bank_data)
+        stage.add(len(bank_data.data) * words.WORD_SIZE)
+    return chunk_data
+
+
+def write_file(file_path: str, data: bytes, stats: metrics.Metrics = None):
+    stats = stats or metrics.Metrics()
+    with stats.stage('write') as stage, open(file_path, "wb") as fp:
+        fp.write(data)
+        stage.add(len(data))
+
+
+def dump_bootstrap(src: pathlib.Path, prefix: str, stats: metrics.Metrics = None) -> lib.DSPChunkData:
+    """ Write the BootROM, BootROMStream and CommandStream of a flash dump to `<prefix>.<name>.be.bin`. """
+    _, bank_data = read_bank_data(src, stats)
+    logger.info("Flash version: %s, Size: 0x%x", bank_data.version, len(bank_data.data))
+
+    chunk_data = split_chunk_data(bank_data, stats)
+    logger.info("BootROM size: 0x%x", chunk_data.bootrom_size)
+    logger.info("BootROM offset: 0x%x", chunk_data.bootrom_offset)
+    logger.info("CommandStream size: 0x%x", len(chunk_data.data))
+
+    for name, data in bootstrap_artifacts(chunk_data, stats).items():
+        file_path = "%s.%s.be.bin" % (prefix, name)
+        write_file(file_path, data, stats)
+        logger.info("Successfully wrote %s to %s", ARTIFACT_NAMES[name], file_path)
+    return chunk_data
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Extract the BootROM and CommandStream from a flash dump.")
+    parser.add_argument("input", help="flash dump")
+    parser.add_argument("output", help="output file prefix")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    # Make sure the input file exists
+    src = pathlib.Path(args.input)
+    if not src.exists():
+        logger.error("Input file %s does not exist!", src)
+        sys.exit(-1)
+
+    try:
+        with metrics.session(args) as stats:
+            dump_bootstrap(src, args.output, stats)
+    except ValueError as e:
+        logger.error("%s", e)
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,17 @@
 #!/usr/bin/env python3
-import io
+import argparse
 import logging
 import pathlib
 import sys
-from dataclasses import dataclass
-from typing import Callable, List, Optional
+from typing import List, Sequence
 
 import lib
+import memory
+import metrics  # shared with dsp56k, made importable by lib
+import words  # shared codec, made importable by lib
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-PAD_CHAR = b'\0'  # padding used between non-consecutive sections in one region
-
 """
 DSP memory dump utility for all Access Virus DSP command streams.
 
@@ -31,90 +30,96 @@ export the following files:
 All files will be written in big endian. Use `be2le.py` to convert to 
 little endian for loading in IDA Pro.
 
+Commands are replayed in stream order, so when commands overlap the last
+one wins (like on the DSP), and the overlaps are reported (each overwritten
+range is logged at debug level). Unwritten memory reads as zeroes; it is
+skipped with seeks instead of being padded.
+
 Note: This command will overwrite existing output files.
 
 Requires python version 3.8+.
 """
 
-if len(sys.argv) != 3:
-    logger.info("Usage: python3 %s <cmd_stream_file> <output_file_prefix>", sys.argv[0])
-    sys.exit(-1)
-
-
-@dataclass
-class CommandHandler:
-    region: str
-    converter: Optional[Callable] = None
-
-    def convert(self, value) -> List[int]:
-        if self.converter:
-            return self.converter(value)
-        return [value]
-
-
-def split_12bit(value) -> List[int]:
-    val1 = value & 0xFFF000
-    val2 = value << 0xC & 0xFFF000
-    return [val1, val2]
-
-
-# Make sure the input file exists
-src = pathlib.Path(sys.argv[1])
-if not src.exists():
-    logger.error("Input file %s does not exist!", src)
-    sys.exit(-1)
-
-# Check if the file contains 24bit words
-file_size = src.stat().st_size
-if file_size % 3 != 0:
-    logger.error("Expected a binary file with 24bit words!")
-    sys.exit(-1)
-
-# Read the 24bit words
-with open(src, "rb") as fp:
-    words = []
-    for i in range(file_size // 3):
-        words.append(int.from_bytes(fp.read(3), 'big'))
-
-# Command handlers
-handlers = {
-    0: CommandHandler(region='p'),
-    1: CommandHandler(region='x'),
-    2: CommandHandler(region='y'),
-    3: CommandHandler(region='y', converter=split_12bit),
-}
-
-commands = lib.get_dsp_commands(words)
-
-# The last command should be 4, representing a jmp to the entrypoint
-jump = commands.pop()
-assert jump.cmd == 4, "Did you provide a valid command stream file?"
-logger.info("Discovered entrypoint (command = 4) @ 0x%x", jump.addr)
-
-# Sort the remaining commands by address to allow writing consecutively
-commands = sorted(commands, key=lambda c: c.addr)
-
-# Create a memory buffer for each region
-buffers = {}
-for region in ['p', 'x', 'y']:
-    buffers[region] = io.BytesIO()
-
-# Parse the commands
-for cmd in commands:
-    logger.debug("Writing command %d, addr=0x%06x, size=0x%06x", cmd.cmd, cmd.addr, cmd.size)
-    handler = handlers.get(cmd.cmd)
-    buffer = buffers.get(handler.region)
-    buffer.write(PAD_CHAR * ((cmd.addr * 3) - buffer.tell()))  # write padding
-    for word in cmd.data:
-        values = handler.convert(word)
-        for value in values:
-            buffer.write(value.to_bytes(3, 'big'))
-
-# Write the output files
-for region, buffer in buffers.items():
-    file_path = "%s.%s.be.bin" % (sys.argv[2], region)
-    logger.info("Writing region %s to %s", region, file_path)
-    buffer.seek(0)
-    with open(file_path, "wb") as fp:
-        fp.write(buffer.read())
-    buffer.close()
+
+def parse_commands(stream: Sequence[int], stats: metrics.Metrics = None) -> List[lib.DSPCommandData]:
+    """ Parse the command stream, the last command should be 4, representing a jmp to the entrypoint. """
+    stats = stats or metrics.Metrics()
+    with stats.stage('commands') as stage:
+        commands = list(lib.iter_dsp_commands(stream))
+        stage.add(len(stream) * words.WORD_SIZE)
+    if not commands or commands[-1].cmd != lib.CMD_JUMP:
+        raise ValueError("CommandStream does not end with a jump (command = 4), "
+                         "did you provide a valid command stream file?")
+    return commands
+
+
+def render_memory(commands: List[lib.DSPCommandData], stats: metrics.Metrics = None) -> memory.DSPMemoryImage:
+    """ Replay the commands on a sparse memory image. """
+    stats = stats or metrics.Metrics()
+    with stats.stage('render') as stage:
+        image = memory.DSPMemoryImage().replay(commands)
+        written = sum(c.word_count for c in commands)
+        stage.add(written * words.WORD_SIZE, written)
+    return image
+
+
+def replay_stream(stream: Sequence[int], stats: metrics.Metrics = None) -> memory.DSPMemoryImage:
+    """ Replay the commands on a sparse memory image, reporting overlapping commands. """
+    image = render_memory(parse_commands(stream, stats), stats)
+    logger.info("Discovered entrypoint (command = 4) @ 0x%x", image.entrypoint)
+
+    if image.overlaps:
+        logger.warning("%d ranges were overwritten by later commands (use debug logging for details)",
+                       len(image.overlaps))
+    return image
+
+
+def write_region(region: memory.SparseRegion, file_path: str, byteorder: str = 'big', stats: metrics.Metrics = None):
+    """ Write a region image, converting it to little endian on the fly (recorded as a `swap` stage). """
+    stats = stats or metrics.Metrics()
+    with stats.stage('write' if byteorder == 'big' else 'swap') as stage:
+        region.tofile(file_path, byteorder)
+        stage.add(region.word_count * words.WORD_SIZE)
+
+
+def dump_dsp_memory(src: pathlib.Path, prefix: str, stats: metrics.Metrics = None) -> memory.DSPMemoryImage:
+    """ Write the P, X and Y memory of a command stream file to `<prefix>.<region>.be.bin`. """
+    image = replay_stream(words.map_words(src), stats)
+    for name, region in image.regions.items():
+        file_path = "%s.%s.be.bin" % (prefix, name)
+        logger.info("Writing region %s to %s", name, file_path)
+        write_region(region, file_path, stats=stats)
+    return image
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Extract P, X and Y memory from a command stream.")
+    parser.add_argument("input", help="command stream file")
+    parser.add_argument("output", help="output file prefix")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    # Make sure the input file exists
+    src = pathlib.Path(args.input)
+    if not src.exists():
+        logger.error("Input file %s does not exist!", src)
+        sys.exit(-1)
+
+    # Check if the file contains 24bit words
+    file_size = src.stat().st_size
+    if not words.is_aligned(file_size):
+        logger.error("Expected a binary file with 24bit words!")
+        sys.exit(-1)
+
+    try:
+        with metrics.session(args) as stats:
+            dump_dsp_memory(src, args.output, stats)
+    except ValueError as e:
+        logger.error("%s", e)
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import glob
+import json
+import logging
+import os
+import pathlib
+import shutil
+import sys
+import time
+from typing import Dict, List
+
+import cache
+import dump_bootstrap
+import dump_dsp_memory
+import lib
+import memory
+import metrics  # shared with dsp56k, made importable by lib
+import words  # shared codec, made importable by lib
+
+logger = logging.getLogger(__name__)
+
+"""
+Batch extraction utility for directories of Access Virus flash dumps.
+
+Usage: python3 extract_corpus.py <input_dir_or_glob> <output_folder> [--workers N]
+
+Runs the same steps as `dump_bootstrap.py` followed by `dump_dsp_memory.py`
+for every dump, without intermediate files, on a pool of worker processes.
+For each dump `<name>` the following files are written to the output folder:
+
+ <name>.bootrom.be.bin: BootROM only
+ <name>.bootrom_stream.be.bin: BootROMStream (including size,offset header)
+ <name>.command_stream.be.bin: CommandStream
+ <name>.p.be.bin, <name>.x.be.bin, <name>.y.be.bin: P, X and Y memory
+
+A `manifest.json` describes every dump: the model type, version string,
+BootROM details, region sizes, entrypoint and the time spent per stage.
+A dump that fails to extract is recorded with its error and does not
+affect the other dumps.
+
+Results are cached by the hash of each dump (see `cache.py`), so dumps
+that were extracted before are copied from the cache instead. Use
+`--no-cache` to bypass the cache.
+
+Note: This command will overwrite existing output files.
+
+Requires python version 3.8+.
+"""
+
+
+def find_dumps(pattern: str) -> List[pathlib.Path]:
+    """ Get all files in a directory, or all files matching a glob pattern. """
+    path = pathlib.Path(pattern)
+    if path.is_dir():
+        return sorted(p for p in path.iterdir() if p.is_file())
+    return sorted(pathlib.Path(p) for p in glob.glob(pattern, recursive=True) if os.path.isfile(p))
+
+
+TOOL_NAME = "extract_corpus"
+# The modules that produce the artifacts, cached artifacts of other versions of them are not used
+TOOL_VERSION = cache.source_version([sys.modules[__name__], dump_bootstrap, dump_dsp_memory, lib, memory, words])
+OUTPUTS = [
+    "bootrom.be.bin",
+    "bootrom_stream.be.bin",
+    "command_stream.be.bin",
+    "p.be.bin",
+    "x.be.bin",
+    "y.be.bin",
+]
+
+
+def output_prefixes(dumps: List[pathlib.Path]) -> List[str]:
+    """ Use the file name of each dump as output prefix, made unique when names collide. """
+    prefixes = []
+    seen: Dict[str, int] = {}
+    for dump in dumps:
+        count = seen.get(dump.stem, 0)
+        seen[dump.stem] = count + 1
+        prefixes.append(dump.stem if not count else "%s_%d" % (dump.stem, count))
+    return prefixes
+
+
+def extract(src: pathlib.Path, prefix: pathlib.Path, artifacts: cache.ArtifactCache = None, key: str = None) -> dict:
+    """
+    Extract BootROM, CommandStream and P, X, Y memory from a single flash dump.
+
+    When a cache is given, the bank data and all written files are stored under `key`.
+    """
+    stats = metrics.Metrics()
+    model_type, bank_data = dump_bootstrap.read_bank_data(src, stats)
+    chunk_data = dump_bootstrap.split_chunk_data(bank_data, stats)
+    commands = dump_dsp_memory.parse_commands(chunk_data.data, stats)
+    image = dump_dsp_memory.render_memory(commands, stats)
+
+    for name, data in dump_bootstrap.bootstrap_artifacts(chunk_data, stats).items():
+        dump_bootstrap.write_file("%s.%s.be.bin" % (prefix, name), data, stats)
+    for name, region in image.regions.items():
+        dump_dsp_memory.write_region(region, "%s.%s.be.bin" % (prefix, name), stats=stats)
+
+    meta = {
+        'model': model_type.name,
+        'version': bank_data.version.rstrip('\0'),
+        'bootrom_size': chunk_data.bootrom_size,
+        'bootrom_offset': chunk_data.bootrom_offset,
+        'command_stream_size': len(chunk_data.data),
+        'command_count': len(commands),
+        'entrypoint': image.entrypoint,
+        'regions': {name: {'size': region.size, 'words': region.word_count}
+                    for name, region in image.regions.items()},
+        'overlaps': len(image.overlaps),
+        'timings': stats.timings(),
+    }
+
+    if artifacts and key:
+        files = {name: pathlib.Path("%s.%s" % (prefix, name)) for name in OUTPUTS}
+        with stats.stage('cache'):
+            artifacts.put(key, meta, {'bank_data.be.bin': words.encode(bank_data.data), **files})
+        meta['timings'] = stats.timings()
+
+    return meta
+
+
+def copy_cached(artifacts: cache.ArtifactCache, key: str, prefix: pathlib.Path):
+    """ Copy the files of a cached extraction to the output folder. """
+    for name in OUTPUTS:
+        shutil.copyfile(artifacts.artifact(key, name), "%s.%s" % (prefix, name))
+
+
+def extract_entry(src: pathlib.Path, prefix: pathlib.Path, artifacts: cache.ArtifactCache) -> dict:
+    """ Extract a dump or copy it from the cache, turning any failure into an error entry for the manifest. """
+    entry = {'file': str(src), 'prefix': prefix.name, 'cache': 'bypass'}
+    started = time.perf_counter()
+    try:
+        key = artifacts.key(src, TOOL_NAME, TOOL_VERSION) if artifacts.enabled else None
+        meta = artifacts.get(key) if key else None
+        if meta is not None:
+            entry['cache'] = 'hit'
+            copy_cached(artifacts, key, prefix)
+        else:
+            entry['cache'] = 'miss' if key else 'bypass'
+            meta = extract(src, prefix, artifacts, key)
+        entry.update(meta)
+        entry['status'] = 'ok'
+    except Exception as e:
+        entry['status'] = 'error'
+        entry['error'] = "%s: %s" % (type(e).__name__, e)
+    entry['elapsed'] = round(time.perf_counter() - started, 6)
+    return entry
+
+
+def extract_corpus(dumps: List[pathlib.Path], output: pathlib.Path, workers: int = None,
+                   artifacts: cache.ArtifactCache = None) -> List[dict]:
+    """ Extract all dumps on a pool of worker processes, returning the manifest entries in input order. """
+    artifacts = artifacts or cache.ArtifactCache(enabled=False)
+    prefixes = [output / prefix for prefix in output_prefixes(dumps)]
+    entries = [None] * len(dumps)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(extract_entry, src, prefix, artifacts): idx
+                   for idx, (src, prefix) in enumerate(zip(dumps, prefixes))}
+        for future in concurrent.futures.as_completed(futures):
+            idx = futures[future]
+            try:
+                entries[idx] = future.result()
+            except Exception as e:  # the worker process itself died
+                entries[idx] = {'file': str(dumps[idx]), 'prefix': prefixes[idx].name, 'cache': 'bypass',
+                                'status': 'error', 'error': "%s: %s" % (type(e).__name__, e)}
+
+            entry = entries[idx]
+            if entry['cache'] == 'hit':
+                artifacts.stats.hits += 1
+            elif entry['cache'] == 'miss':
+                artifacts.stats.misses += 1
+
+            if entry['status'] == 'ok':
+                logger.info("Extracted %s (%s, %s, cache %s)", entry['file'], entry['model'], entry['version'],
+                            entry['cache'])
+            else:
+                logger.error("Failed to extract %s: %s", entry['file'], entry['error'])
+    return entries
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Extract DSP memory from a corpus of Access Virus flash dumps.")
+    parser.add_argument("input", help="directory or glob pattern of flash dumps")
+    parser.add_argument("output", help="output folder")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument("--manifest", default=None, help="manifest path (default: <output>/manifest.json)")
+    parser.add_argument("--cache-dir", default=None, help="cache folder (default: %s)" % cache.default_cache_dir())
+    parser.add_argument("--cache-size", type=int, default=cache.DEFAULT_MAX_SIZE // (1 << 20),
+                        help="maximum cache size in MB (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the cache")
+    args = parser.parse_args()
+
+    dumps = find_dumps(args.input)
+    if not dumps:
+        logger.error("No flash dumps found for %s", args.input)
+        sys.exit(-1)
+
+    output = pathlib.Path(args.output)
+    output.mkdir(parents=True, exist_ok=True)
+
+    artifacts = cache.ArtifactCache(args.cache_dir, args.cache_size << 20, enabled=not args.no_cache)
+
+    started = time.perf_counter()
+    entries = extract_corpus(dumps, output, args.workers, artifacts)
+    elapsed = time.perf_counter() - started
+
+    if artifacts.enabled:
+        evicted = artifacts.evict()
+        logger.info("Cache: %s, evicted %d entries", artifacts.stats.report(), evicted)
+
+    manifest_path = pathlib.Path(args.manifest) if args.manifest else output / "manifest.json"
+    with open(manifest_path, "w") as fp:
+        json.dump({'elapsed': round(elapsed, 6), 'cache': artifacts.report(), 'dumps': entries}, fp, indent=2)
+
+    failed = sum(1 for e in entries if e['status'] != 'ok')
+    logger.info("Extracted %d of %d dumps in %.2fs, wrote manifest to %s",
+                len(entries) - failed, len(entries), elapsed, manifest_path)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
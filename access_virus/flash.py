@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+import argparse
+import contextlib
+import enum
+import hashlib
+import json
+import logging
+import pathlib
+import sys
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Set
+
+import extract_corpus
+import lib
+import metrics  # shared with dsp56k, made importable by lib
+
+logger = logging.getLogger(__name__)
+
+"""
+Catalogue of the banks of an Access Virus flash image.
+
+Usage: python3 flash.py banks <flash_file>
+       python3 flash.py export-presets <input_dir_or_glob> <output_folder>
+
+Splits a flash image in banks of 32K (`0x8000`) and classifies each bank
+by its role, following the layout described in the top level README:
+
+ os: i8051 operating system code (banks 0 - 2)
+ dsp: DSP563xx BootROM and chunks (the banks walked from the dsp offset)
+ flash_routines: i8051 flash programming routines (bank 7)
+ presets: preset data (banks 8 - 15)
+ unknown: anything else
+
+Only the layout of the legacy (512K) models is known. Of the TI models,
+only the operating system and dsp banks are classified. The dsp banks
+take precedence, so bank 7 is a dsp bank when the dsp data reaches it.
+The model and dsp banks are found by their contents, so trimmed and
+padded dumps are classified as well (see `lib.find_dsp_banks`).
+
+`banks` lists every bank of a flash image with its role and SHA-256.
+`export-presets` writes every preset bank of a corpus of flash dumps to
+the output folder, once per distinct bank: each bank is named after its
+SHA-256, and `presets.json` lists the banks of every dump. Erased banks
+(all `0xFF`) are not exported.
+"""
+
+ERASED_BANK = b'\xFF' * lib.BANK_SIZE
+MANIFEST_NAME = "presets.json"
+
+
+class BankRole(enum.Enum):
+    OS = 'os'
+    DSP = 'dsp'
+    FLASH_ROUTINES = 'flash_routines'
+    PRESETS = 'presets'
+    UNKNOWN = 'unknown'
+
+
+# Bank numbers of each role, the dsp banks are found by walking the bank headers
+LAYOUTS: Dict[lib.AccessVirusType, Dict[BankRole, range]] = {
+    lib.AccessVirusType.LEGACY: {
+        BankRole.OS: range(0, 3),
+        BankRole.FLASH_ROUTINES: range(7, 8),
+        BankRole.PRESETS: range(8, 16),
+    },
+    lib.AccessVirusType.TI: {
+        BankRole.OS: range(0, 3),
+    },
+}
+
+
+def layout_roles(model_type: lib.AccessVirusType, dsp_offset: int, bank_count: int) -> List[BankRole]:
+    """ Role of every bank by the layout of the model, without the dsp banks. """
+    # Banks are numbered from the start of the image, which is shifted for dumps trimmed at the front
+    shift = (dsp_offset - model_type.value.dsp_offset) // lib.BANK_SIZE
+    roles = [BankRole.UNKNOWN] * bank_count
+    for role, numbers in LAYOUTS[model_type].items():
+        for number in numbers:
+            if 0 <= number + shift < bank_count:
+                roles[number + shift] = role
+    return roles
+
+
+@dataclass
+class FlashBank:
+    number: int
+    role: BankRole
+    data: memoryview  # view into the memory-mapped flash image
+
+    @property
+    def offset(self) -> int:
+        return self.number * lib.BANK_SIZE
+
+    @property
+    def erased(self) -> bool:
+        return self.data.tobytes() == ERASED_BANK
+
+    def digest(self) -> str:
+        """ SHA-256 of the bank contents. """
+        return hashlib.sha256(self.data).hexdigest()
+
+
+class FlashCatalogue:
+    """
+    Banks of a memory-mapped flash image, classified by role.
+
+    Banks are created on access and reference the mapped image, nothing
+    is copied. Release all banks before closing the catalogue.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = pathlib.Path(path)
+        self._stack = contextlib.ExitStack()
+        self._view = memoryview(self._stack.enter_context(lib.map_flash(self.path)))
+        try:
+            self.model_type, self.dsp_offset = lib.find_dsp_banks(self._view)
+        except ValueError as e:
+            self.close()
+            raise ValueError("%s: %s" % (self.path, e))
+
+        self.roles = layout_roles(self.model_type, self.dsp_offset, len(self._view) // lib.BANK_SIZE)
+        try:
+            for offset, _, _ in lib.iter_dsp_banks(self._view, self.model_type, self.dsp_offset):
+                self.roles[offset // lib.BANK_SIZE] = BankRole.DSP
+        except ValueError as e:
+            logger.warning("%s: %s, dsp banks are not classified", self.path, e)
+
+    def __len__(self) -> int:
+        return len(self.roles)
+
+    def __getitem__(self, number: int) -> FlashBank:
+        if not 0 <= number < len(self.roles):
+            raise IndexError("bank %d out of range" % number)
+        offset = number * lib.BANK_SIZE
+        return FlashBank(number, self.roles[number], self._view[offset:offset + lib.BANK_SIZE])
+
+    def __iter__(self) -> Iterator[FlashBank]:
+        return (self[number] for number in range(len(self)))
+
+    def by_role(self, role: BankRole) -> Iterator[FlashBank]:
+        """ Get all banks of the given role, in flash order. """
+        return (self[number] for number, r in enumerate(self.roles) if r == role)
+
+    def close(self):
+        self._view.release()
+        self._stack.close()
+
+    def __enter__(self) -> 'FlashCatalogue':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def export_presets(dumps: List[pathlib.Path], output: pathlib.Path, stats: metrics.Metrics = None) -> List[dict]:
+    """
+    Write the distinct preset banks of all dumps to the output folder, returning an entry per dump.
+
+    Banks that are already in the output folder (from an earlier export)
+    are not written again. A dump that cannot be read is recorded with its
+    error and does not affect the other dumps.
+    """
+    stats = stats or metrics.Metrics()
+    written: Set[str] = set()
+    entries = []
+    for src in dumps:
+        entry = {'file': str(src)}
+        try:
+            with stats.stage('catalogue'):
+                catalogue = FlashCatalogue(src)
+            with catalogue:
+                entry['model'] = catalogue.model_type.name
+                entry['banks'] = banks = {}
+                for bank in catalogue.by_role(BankRole.PRESETS):
+                    try:
+                        with stats.stage('hash') as stage:
+                            digest = None if bank.erased else bank.digest()
+                            stage.add(len(bank.data))
+                        banks[bank.number] = digest
+                        path = output / ("%s.bin" % digest)
+                        if digest and digest not in written and not path.exists():
+                            with stats.stage('write') as stage:
+                                path.write_bytes(bank.data)
+                                stage.add(len(bank.data))
+                        if digest:
+                            written.add(digest)
+                    finally:
+                        bank.data.release()
+            entry['status'] = 'ok'
+        except (ValueError, OSError) as e:
+            entry['status'] = 'error'
+            entry['error'] = "%s: %s" % (type(e).__name__, e)
+        entries.append(entry)
+    return entries
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Classify the banks of Access Virus flash dumps.")
+    instrumentation = argparse.ArgumentParser(add_help=False)
+    metrics.add_arguments(instrumentation)
+    commands = parser.add_subparsers(dest="command", required=True)
+    banks = commands.add_parser("banks", parents=[instrumentation], help="list the banks of a flash dump")
+    banks.add_argument("flash", help="flash dump")
+    export = commands.add_parser("export-presets", parents=[instrumentation],
+                                 help="export the distinct preset banks of a corpus of flash dumps")
+    export.add_argument("input", help="directory or glob pattern of flash dumps")
+    export.add_argument("output", help="output folder")
+    export.add_argument("--manifest", default=None, help="manifest path (default: <output>/%s)" % MANIFEST_NAME)
+    args = parser.parse_args()
+
+    try:
+        with metrics.session(args) as stats:
+            if args.command == "banks":
+                with FlashCatalogue(args.flash) as catalogue:
+                    logger.info("%s: %s, %d banks", args.flash, catalogue.model_type.name, len(catalogue))
+                    for bank in catalogue:
+                        try:
+                            print("%2d 0x%06x %-14s %s" % (bank.number, bank.offset, bank.role.value,
+                                                          "erased" if bank.erased else bank.digest()))
+                        finally:
+                            bank.data.release()
+                return
+
+            dumps = extract_corpus.find_dumps(args.input)
+            if not dumps:
+                raise ValueError("No flash dumps found for %s" % args.input)
+            output = pathlib.Path(args.output)
+            output.mkdir(parents=True, exist_ok=True)
+            entries = export_presets(dumps, output, stats)
+    except (ValueError, OSError) as e:
+        logger.error("%s", e)
+        sys.exit(-1)
+
+    manifest_path = pathlib.Path(args.manifest) if args.manifest else output / MANIFEST_NAME
+    with open(manifest_path, "w") as fp:
+        json.dump({'dumps': entries}, fp, indent=2)
+
+    digests = {d for e in entries for d in e.get('banks', {}).values() if d}
+    exported = sum(1 for e in entries for d in e.get('banks', {}).values() if d)
+    failed = sum(1 for e in entries if e['status'] != 'ok')
+    logger.info("Exported %d distinct of %d preset banks from %d dumps, wrote manifest to %s",
+                len(digests), exported, len(entries) - failed, manifest_path)
+    for entry in entries:
+        if entry['status'] != 'ok':
+            logger.error("Failed to read %s: %s", entry['file'], entry['error'])
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
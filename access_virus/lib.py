@@ -1,23 +1,49 @@
+import array
+import bisect
+import contextlib
 import enum
 import logging
+import mmap
+import os
+import pathlib
+import sys
 from dataclasses import dataclass
-from typing import BinaryIO, List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+# Make the shared modules in `dsp56k` (word codec, metrics, DSP56300 decoder) importable for all tools
+sys.path.append(str(pathlib.Path(__file__).resolve().parent.parent / "dsp56k"))
+import words  # noqa: E402
 
 logger = logging.getLogger(__name__)
 
 
+BANK_SIZE = 0x8000  # flash memory is split up in banks of 32K
+BANK_HEADER_SIZE = 3  # [ index ] [ size1 ] [ size2 ]
+BANK_WORDS = (BANK_SIZE - BANK_HEADER_SIZE) // words.WORD_SIZE  # maximum number of words in a bank
+VERSION_TERMINATOR = b'\xFF'  # erased flash follows the version string
+BOOTROM_OFFSET = 0x100  # P memory address the BootROM is usually loaded to
+
+CMD_JUMP = 4  # jump to address (start execution)
+COMMAND_REGIONS = {
+    0: 'p',  # write to P memory
+    1: 'x',  # write to X memory
+    2: 'y',  # write to Y memory
+    3: 'y',  # write to Y memory (split up each word in two 12-bit values)
+}
+
+
 @dataclass
 class DSPBankData:
     version: str
-    data: List[int]
+    data: words.WordBuffer  # concatenated views of the words in each bank
 
 
 @dataclass
 class DSPChunkData:
     bootrom_size: int
     bootrom_offset: int
-    bootrom_data: List[int]
-    data: List[int]
+    bootrom_data: words.WordBuffer
+    data: words.WordBuffer
 
 
 @dataclass
@@ -25,7 +51,19 @@ class DSPCommandData:
     cmd: int
     addr: int
     size: Optional[int]
-    data: Optional[List[int]]
+    data: Optional[Sequence[int]]  # view into the command stream
+    offset: int = 0  # word offset of the command in the command stream
+
+    @property
+    def region(self) -> Optional[str]:
+        return COMMAND_REGIONS.get(self.cmd)
+
+    @property
+    def word_count(self) -> int:
+        """ Number of words this command writes to memory. """
+        if self.cmd not in COMMAND_REGIONS:
+            return 0
+        return self.size * 2 if self.cmd == 3 else self.size
 
 
 @dataclass
@@ -46,42 +84,249 @@ class AccessVirusType(enum.Enum):
         """ Get either LEGACY or TI based on the given file size. """
         return next((t for t in cls if t.value.matches_size(size)), None)
 
+    @classmethod
+    def from_dsp_offset(cls, offset: int, size: int) -> 'AccessVirusType':
+        """
+        Get the likely model type based on the offset of the first dsp bank in a flash image of the given size.
+
+        The offset identifies the model unless the image is trimmed at the
+        front, in which case the distance from the dsp banks to the end of
+        the image does. Otherwise the model with the nearest offset is used.
+        """
+        return next((t for t in cls if t.value.dsp_offset == offset), None) or \
+            next((t for t in cls if t.value.size - t.value.dsp_offset == size - offset), None) or \
+            min(cls, key=lambda t: abs(t.value.dsp_offset - offset))
+
+
+@dataclass
+class DSPLayout:
+    dsp_offset: int
+    bank_count: int
+    bootrom_size: int
+    bootrom_offset: int
+    version: str
+    score: int  # number of plausibility checks passed, see `detect_dsp_layout`
+    flash_size: int
 
-def read_until(fp: BinaryIO, c: bytes):
-    """ Read from the binary stream until the given character is encountered. """
-    buf = b''
-    while (match := fp.read(1)) != c:
-        buf += match
-    return buf
+    @property
+    def dsp_bank(self) -> int:
+        return self.dsp_offset // BANK_SIZE
 
+    @property
+    def model_type(self) -> AccessVirusType:
+        return AccessVirusType.from_dsp_offset(self.dsp_offset, self.flash_size)
 
-def get_dsp_bank_data(fp: BinaryIO, model_type: AccessVirusType) -> DSPBankData:
+
+@contextlib.contextmanager
+def map_flash(path: pathlib.Path) -> Iterator[words.Buffer]:
     """
-    Retrieve the dsp related data from the flash memory banks.
+    Memory-map a flash image read-only.
+
+    Views on the map (e.g. the dsp bank data) must be released before
+    the map is closed. When they are still referenced on exit (e.g. by
+    a traceback), the map is only closed once they are released.
+    """
+    with open(path, "rb") as fp:
+        if not os.fstat(fp.fileno()).st_size:
+            yield b''
+            return
+        flash = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            yield flash
+        finally:
+            try:
+                flash.close()
+            except BufferError:
+                pass
+
+
+def iter_dsp_banks(flash: words.Buffer, model_type: Optional[AccessVirusType],
+                   dsp_offset: Optional[int] = None) -> Iterator[Tuple[int, int, int]]:
+    """
+    Walk the dsp banks of a flash image, from the dsp offset down to the bank with index 0.
+
+    Yields the offset of each bank along with the start and end offset of
+    its words. The dsp offset defaults to the one of the model type.
     """
-    data = []
+    view = memoryview(flash)
     idx = 0xff
-    offset = model_type.value.dsp_offset
+    offset = model_type.value.dsp_offset if dsp_offset is None else dsp_offset
     while idx > 0:
-        logger.debug("Seeking to 0x%x", offset)
-        fp.seek(offset)
+        logger.debug("Reading bank at 0x%x", offset)
+        if offset + BANK_HEADER_SIZE > len(view):
+            raise ValueError("Bank at 0x%x exceeds the flash image" % offset)
 
-        idx = int.from_bytes(fp.read(1), 'big')
-        size1 = int.from_bytes(fp.read(1), 'big')
-        size2 = int.from_bytes(fp.read(1), 'big')
+        idx, size1, size2 = view[offset:offset + BANK_HEADER_SIZE]
         word_count = (size1 - 1) << 8 | size2
 
         logger.debug("Index: %d, size=0x%x", idx, word_count)
-        for i in range(word_count):
-            data.append(int.from_bytes(fp.read(3), 'big'))
+        start = offset + BANK_HEADER_SIZE
+        end = start + word_count * words.WORD_SIZE
+        if end > len(view):
+            raise ValueError("Bank at 0x%x exceeds the flash image" % offset)
+        yield offset, start, end
+
+        offset += BANK_SIZE
+
 
-        offset += 0x8000
+def get_dsp_bank_data(flash: words.Buffer, model_type: Optional[AccessVirusType],
+                      dsp_offset: Optional[int] = None) -> DSPBankData:
+    """
+    Retrieve the dsp related data from the flash memory banks.
 
-    # Read version
-    version = read_until(fp, b'\xFF').decode('ascii')
+    The words are not copied: the returned data references each bank
+    of the flash image (e.g. a map from `map_flash`).
+    """
+    view = memoryview(flash)
+    banks = []
+    end = 0
+    for _, start, end in iter_dsp_banks(view, model_type, dsp_offset):
+        banks.append(view[start:end])
+
+    # Read version, located right after the words of the last bank
+    terminator = flash.find(VERSION_TERMINATOR, end)
+    if terminator == -1:
+        terminator = len(flash)
+    version = flash[end:terminator].decode('ascii')
     logger.debug("Version: %s", version)
 
-    return DSPBankData(version, data)
+    return DSPBankData(version, words.WordBuffer(banks))
+
+
+def _read_version(flash: words.Buffer, start: int) -> Optional[str]:
+    """ The version string at the given offset, if it is ascii and terminated. """
+    data = bytes(flash[start:start + BANK_SIZE])
+    end = data.find(VERSION_TERMINATOR)
+    if end <= 0 or not data[:end].isascii():
+        return None
+    return data[:end].decode('ascii')
+
+
+def detect_dsp_layout(flash: words.Buffer) -> Optional[DSPLayout]:
+    """
+    Find the dsp banks of a flash image by their contents, regardless of its size.
+
+    Every 32K bank boundary can start the dsp banks: a run of banks whose
+    indices count down to 0, each with a valid word count, followed by a
+    terminated version string. The headers of all banks are read at once
+    (one byte out of every bank). Each run is scored on a BootROM size that
+    fits the data, a BootROM loaded to BOOTROM_OFFSET, a first command that
+    exists and a printable version string. The run with the highest score
+    wins (the first one on a tie).
+    """
+    view = memoryview(flash)
+    indices = bytes(view[0::BANK_SIZE])
+    sizes = bytes(view[1::BANK_SIZE])
+    best = None
+    for bank, count in enumerate(indices):
+        last = bank + count
+        if last >= len(indices) or indices[bank:last + 1] != bytes(range(count, -1, -1)):
+            continue
+        if not all(1 <= size1 <= (BANK_WORDS >> 8) + 1 for size1 in sizes[bank:last + 1]):
+            continue
+        offset = bank * BANK_SIZE
+        try:
+            banks = list(iter_dsp_banks(view, None, offset))
+        except ValueError:
+            continue  # truncated
+        version = _read_version(view, banks[-1][2])
+        data = words.WordBuffer([view[start:end] for _, start, end in banks])
+        if version is None or len(data) < 2:
+            continue
+
+        bootrom_size, bootrom_offset = data[0], data[1]
+        score = 0
+        if 0 < bootrom_size < len(data) - 2:
+            score += 1
+            if data[2 + bootrom_size] in COMMAND_REGIONS or data[2 + bootrom_size] == CMD_JUMP:
+                score += 1
+        if bootrom_offset == BOOTROM_OFFSET:
+            score += 1
+        if version.rstrip('\0').isprintable():
+            score += 1
+        if best is None or score > best.score:
+            best = DSPLayout(offset, len(banks), bootrom_size, bootrom_offset, version, score, len(view))
+    return best
+
+
+def find_dsp_banks(flash: words.Buffer) -> Tuple[AccessVirusType, int]:
+    """
+    Get the likely model type and the dsp offset of a flash image.
+
+    The dsp banks are found by their contents, so trimmed and padded images
+    are supported. The file size is only used when no dsp banks are found.
+    """
+    layout = detect_dsp_layout(flash)
+    if layout:
+        logger.debug("Found %d dsp banks at bank %d", layout.bank_count, layout.dsp_bank)
+        return layout.model_type, layout.dsp_offset
+    model_type = AccessVirusType.from_size(len(flash))
+    if not model_type:
+        raise ValueError("Could not determine Access Virus model type for file size %sK" % (len(flash) // 1024))
+    return model_type, model_type.value.dsp_offset
+
+
+def pack_dsp_bank_data(data: words.Buffer, version: str, model_type: Optional[AccessVirusType],
+                       flash: Optional[bytearray] = None, bank_words: Sequence[int] = (),
+                       dsp_offset: Optional[int] = None, allow_grow: bool = False) -> bytearray:
+    """
+    Pack big endian words into flash banks, the inverse of `get_dsp_bank_data`.
+
+    The banks are written to `flash` (or to an erased flash image of the
+    model's size when omitted). The version string and its terminator
+    are written right after the words of the last bank.
+
+    Banks are filled up to BANK_WORDS, or up to the given number of words
+    per bank in `bank_words` (e.g. the word counts of an existing image),
+    except for the last of them.
+    The data must fit in as many banks as `bank_words` has, unless
+    `allow_grow` is set. Banks after those must be erased, they are never
+    overwritten. The dsp offset defaults to the one of the model type.
+    """
+    if flash is None:
+        flash = bytearray(b'\xFF' * model_type.value.size)
+    data = memoryview(data).cast('B')
+    version = version.encode('ascii') + VERSION_TERMINATOR
+    if len(version) > BANK_WORDS * words.WORD_SIZE:
+        raise ValueError("Version string does not fit in a bank")
+
+    # The last bank also holds the version string
+    word_count = len(data) // words.WORD_SIZE
+    last_words = (BANK_SIZE - BANK_HEADER_SIZE - len(version)) // words.WORD_SIZE
+    counts = []
+    remaining = word_count
+    while True:
+        # The last of the given banks is filled as far as it goes, like the banks after it
+        capacity = min(bank_words[len(counts)] if len(counts) < len(bank_words) - 1 else BANK_WORDS, BANK_WORDS)
+        if remaining <= min(capacity, last_words):
+            counts.append(remaining)
+            break
+        counts.append(min(capacity or BANK_WORDS, remaining))
+        remaining -= counts[-1]
+
+    offset = model_type.value.dsp_offset if dsp_offset is None else dsp_offset
+    if offset + len(counts) * BANK_SIZE > len(flash):
+        raise ValueError("%d words do not fit in the flash image" % word_count)
+    if bank_words and len(counts) > len(bank_words) and not allow_grow:
+        raise ValueError("%d words need %d banks, the image has %d dsp banks"
+                         % (word_count, len(counts), len(bank_words)))
+    for idx in range(len(bank_words), len(counts)):
+        bank = offset + idx * BANK_SIZE
+        if flash[bank:bank + BANK_SIZE] != b'\xFF' * BANK_SIZE:
+            raise ValueError("%d words need the bank at 0x%x, which is not erased" % (word_count, bank))
+
+    start = 0
+    for idx, count in zip(reversed(range(len(counts))), counts):
+        end = start + count * words.WORD_SIZE
+        flash[offset:offset + BANK_HEADER_SIZE] = bytes([idx, (count >> 8) + 1, count & 0xFF])
+        flash[offset + BANK_HEADER_SIZE:offset + BANK_HEADER_SIZE + end - start] = data[start:end]
+        logger.debug("Packed bank %d at 0x%x, size=0x%x", idx, offset, count)
+        start = end
+        offset += BANK_SIZE
+
+    end = offset - BANK_SIZE + BANK_HEADER_SIZE + count * words.WORD_SIZE
+    flash[end:end + len(version)] = version
+    return flash
 
 
 def get_dsp_chunk_data(bank_data: DSPBankData) -> DSPChunkData:
@@ -97,19 +342,118 @@ def get_dsp_chunk_data(bank_data: DSPBankData) -> DSPChunkData:
     return DSPChunkData(bootrom_size, bootrom_offset, bootrom_data, chunk_data)
 
 
-def get_dsp_commands(chunk_data: List[int]) -> List[DSPCommandData]:
+def _read_command(chunk_data: Sequence[int], idx: int) -> DSPCommandData:
+    cmd = chunk_data[idx]
+    addr = chunk_data[idx+1]
+    size = chunk_data[idx+2] if idx + 2 < len(chunk_data) else 0  # size can be empty for cmd = 4
+    data = chunk_data[idx+3:idx+3+size]
+    return DSPCommandData(cmd, addr, size, data, idx)
+
+
+def iter_dsp_commands(chunk_data: Sequence[int], verbose: bool = False) -> Iterator[DSPCommandData]:
     """
-    Parse the command stream into individual command entries.
+    Lazily parse the command stream into individual command entries.
+
+    The data of each command is a slice of `chunk_data`, which does not
+    copy anything when the stream is a WordBuffer. Each command is only
+    logged at INFO level when `verbose` is set.
     """
-    commands = []
+    level = logging.INFO if verbose else logging.DEBUG
+    log = logger.isEnabledFor(level)  # checked once, logging is slow on large streams
     idx = 0
     while idx < len(chunk_data):
-        cmd = chunk_data[idx]
-        addr = chunk_data[idx+1]
-        size = next(iter(chunk_data[idx+2:idx+3]), 0)  # size can be empty for cmd = 4
-        data = chunk_data[idx+3:idx+3+size]
-        logger.info("Command %d, addr=0x%06x, size=0x%06x", cmd, addr, size)
-        commands.append(DSPCommandData(cmd, addr, size, data))
-        idx += 3 + size
-
-    return commands
+        command = _read_command(chunk_data, idx)
+        if log:
+            logger.log(level, "Command %d, addr=0x%06x, size=0x%06x", command.cmd, command.addr, command.size)
+        yield command
+        idx += 3 + command.size
+
+
+def encode_dsp_commands(commands: Iterable[DSPCommandData]) -> bytes:
+    """
+    Encode commands into a big endian command stream, the inverse of `iter_dsp_commands`.
+    """
+    stream = []
+    for command in commands:
+        stream.append(words.encode([command.cmd, command.addr, command.size or 0]))
+        if command.size:
+            stream.append(words.encode(command.data))
+    return b''.join(stream)
+
+
+def get_dsp_commands(chunk_data: Sequence[int], verbose: bool = False) -> List[DSPCommandData]:
+    """
+    Parse the command stream into individual command entries.
+    """
+    return list(iter_dsp_commands(chunk_data, verbose))
+
+
+class DSPCommandIndex:
+    """
+    Index of the command headers in a command stream.
+
+    Only the offset, command, address and size of each command are
+    stored, so commands can be looked up by position, region or
+    address without walking the stream again.
+    """
+
+    def __init__(self, chunk_data: Sequence[int]):
+        self.chunk_data = chunk_data
+        self.offsets = array.array('Q')
+        self.cmds = array.array('I')
+        self.addrs = array.array('I')
+        self.sizes = array.array('I')
+        for command in iter_dsp_commands(chunk_data):
+            self.offsets.append(command.offset)
+            self.cmds.append(command.cmd)
+            self.addrs.append(command.addr)
+            self.sizes.append(command.size)
+
+        # Per region: positions sorted by address, to find the commands covering an address
+        self._by_region: Dict[str, List[int]] = {}
+        for pos in sorted(range(len(self.cmds)), key=self.addrs.__getitem__):
+            region = COMMAND_REGIONS.get(self.cmds[pos])
+            if region:
+                self._by_region.setdefault(region, []).append(pos)
+        self._region_addrs = {r: [self.addrs[p] for p in ps] for r, ps in self._by_region.items()}
+        self._region_span = {r: max(self._extent(p) for p in ps) for r, ps in self._by_region.items()}
+
+    def _extent(self, pos: int) -> int:
+        return self.sizes[pos] * 2 if self.cmds[pos] == 3 else self.sizes[pos]
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, pos: int) -> DSPCommandData:
+        """ Get the command at the given position in the stream. """
+        return _read_command(self.chunk_data, self.offsets[pos])
+
+    def __iter__(self) -> Iterator[DSPCommandData]:
+        return (self[pos] for pos in range(len(self)))
+
+    def by_cmd(self, cmd: int) -> Iterator[DSPCommandData]:
+        """ Get all commands of the given type, in stream order. """
+        return (self[pos] for pos in range(len(self)) if self.cmds[pos] == cmd)
+
+    def by_region(self, region: str) -> Iterator[DSPCommandData]:
+        """ Get all commands that write to the given region (p, x or y), in stream order. """
+        return (self[pos] for pos in sorted(self._by_region.get(region, [])))
+
+    def at(self, region: str, addr: int) -> List[DSPCommandData]:
+        """ Get all commands that write to the given address of a region, in stream order. """
+        positions = self._by_region.get(region, [])
+        addrs = self._region_addrs.get(region, [])
+        hits = []
+        i = bisect.bisect_right(addrs, addr) - 1
+        lowest = addr - self._region_span.get(region, 0)
+        while i >= 0 and addrs[i] >= lowest:
+            pos = positions[i]
+            if addr < addrs[i] + self._extent(pos):
+                hits.append(pos)
+            i -= 1
+        return [self[pos] for pos in sorted(hits)]
+
+    def entrypoint(self) -> Optional[int]:
+        """ Get the jump address of the last command 4, if any. """
+        jumps = [pos for pos in range(len(self)) if self.cmds[pos] == CMD_JUMP]
+        return self.addrs[jumps[-1]] if jumps else None
@@ -0,0 +1,195 @@
+import bisect
+import logging
+import pathlib
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import lib
+import words  # shared codec, made importable by lib
+
+logger = logging.getLogger(__name__)
+
+REGIONS = ['p', 'x', 'y']
+
+# Lookup tables to split the nibbles of a byte (used by split_12bit)
+HIGH_NIBBLE = bytes(b & 0xF0 for b in range(256))
+LOW_NIBBLE_UP = bytes((b & 0x0F) << 4 for b in range(256))
+HIGH_NIBBLE_DOWN = bytes(b >> 4 for b in range(256))
+LOW_NIBBLE = bytes(b & 0x0F for b in range(256))
+
+
+@dataclass
+class Segment:
+    start: int  # word address
+    data: bytes  # big endian 24-bit words
+
+    @property
+    def end(self) -> int:
+        return self.start + len(self.data) // words.WORD_SIZE
+
+
+@dataclass
+class Overlap:
+    region: str
+    start: int  # first overwritten word address
+    end: int  # word address after the last overwritten word
+    offset: int  # offset of the overwriting command in the command stream
+
+
+def _bitwise_or(a: bytes, b: bytes) -> bytes:
+    return (int.from_bytes(a, 'big') | int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+
+
+def split_12bit(data: bytes) -> bytes:
+    """
+    Split up each 24-bit word in two words holding 12 bits each (command 3).
+
+    For each word, the high 12 bits are written as the first word and the
+    low 12 bits as the second word, both aligned to the top of the word.
+    """
+    count = len(data) // words.WORD_SIZE
+    high, mid, low = data[0::3], data[1::3], data[2::3]
+    out = bytearray(count * 6)
+    out[0::6] = high
+    out[1::6] = mid.translate(HIGH_NIBBLE)
+    out[3::6] = _bitwise_or(mid.translate(LOW_NIBBLE_UP), low.translate(HIGH_NIBBLE_DOWN))
+    out[4::6] = low.translate(LOW_NIBBLE_UP)
+    return bytes(out)
+
+
+def join_12bit(data: bytes) -> Optional[bytes]:
+    """
+    Join pairs of words holding 12 bits each into 24-bit words, the inverse of `split_12bit`.
+
+    Returns None when the low 12 bits of any word are set, those words
+    can't be written with command 3.
+    """
+    count = len(data) // (2 * words.WORD_SIZE)
+    zeros = bytes(count)
+    if (data[2::6] != zeros or data[5::6] != zeros
+            or data[1::6].translate(LOW_NIBBLE) != zeros or data[4::6].translate(LOW_NIBBLE) != zeros):
+        return None
+    out = bytearray(count * words.WORD_SIZE)
+    out[0::3] = data[0::6]
+    out[1::3] = _bitwise_or(data[1::6], data[3::6].translate(HIGH_NIBBLE_DOWN))
+    out[2::3] = _bitwise_or(data[3::6].translate(LOW_NIBBLE_UP), data[4::6].translate(HIGH_NIBBLE_DOWN))
+    return bytes(out)
+
+
+class SparseRegion:
+    """
+    Interval map of the words written to one memory region.
+
+    Only written segments are stored. A write replaces any data it
+    overlaps (last writer wins) and returns the overwritten ranges.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._starts: List[int] = []
+        self._segments: List[Segment] = []
+
+    def write(self, addr: int, data: bytes) -> List[range]:
+        """ Write big endian words at the given word address. """
+        new = Segment(addr, bytes(data))
+        if addr == new.end:
+            return []
+
+        # Find the first segment that ends after the new one starts
+        i = bisect.bisect_right(self._starts, addr) - 1
+        if i < 0 or self._segments[i].end <= addr:
+            i += 1
+
+        j = i
+        while j < len(self._segments) and self._segments[j].start < new.end:
+            j += 1
+        overwritten = self._segments[i:j]
+
+        # Keep the parts of the overwritten segments outside of the new one
+        replacement = [new]
+        if overwritten and overwritten[0].start < addr:
+            first = overwritten[0]
+            replacement.insert(0, Segment(first.start, first.data[:(addr - first.start) * words.WORD_SIZE]))
+        if overwritten and overwritten[-1].end > new.end:
+            last = overwritten[-1]
+            replacement.append(Segment(new.end, last.data[(new.end - last.start) * words.WORD_SIZE:]))
+
+        self._segments[i:j] = replacement
+        self._starts[i:j] = [s.start for s in replacement]
+        return [range(max(s.start, addr), min(s.end, new.end)) for s in overwritten]
+
+    def __iter__(self) -> Iterator[Segment]:
+        return iter(self._segments)
+
+    def __len__(self) -> int:
+        return len(self._segments)
+
+    @property
+    def size(self) -> int:
+        """ Size of the region in words, up to the highest written address. """
+        return self._segments[-1].end if self._segments else 0
+
+    @property
+    def word_count(self) -> int:
+        """ Number of words actually written. """
+        return sum(s.end - s.start for s in self._segments)
+
+    def read(self, addr: int, count: int, pad: bytes = b'\0') -> bytes:
+        """ Read words from the region, unwritten words are filled with `pad`. """
+        out = bytearray(pad * (count * words.WORD_SIZE))
+        end = addr + count
+        i = max(bisect.bisect_right(self._starts, addr) - 1, 0)
+        while i < len(self._segments) and self._segments[i].start < end:
+            seg = self._segments[i]
+            lo, hi = max(seg.start, addr), min(seg.end, end)
+            if lo < hi:
+                out[(lo - addr) * words.WORD_SIZE:(hi - addr) * words.WORD_SIZE] = \
+                    seg.data[(lo - seg.start) * words.WORD_SIZE:(hi - seg.start) * words.WORD_SIZE]
+            i += 1
+        return bytes(out)
+
+    def tofile(self, file_path: pathlib.Path, byteorder: str = 'big'):
+        """
+        Write the region as a flat image, seeking over unwritten words.
+
+        On file systems that support it, the gaps become holes that
+        read as zeroes without taking up disk space.
+        """
+        with open(file_path, "wb") as fp:
+            for seg in self._segments:
+                fp.seek(seg.start * words.WORD_SIZE)
+                fp.write(seg.data if byteorder == 'big' else words.swap(seg.data))
+            fp.truncate(self.size * words.WORD_SIZE)
+
+
+@dataclass
+class DSPMemoryImage:
+    """ P, X and Y memory as written by replaying a command stream. """
+    regions: Dict[str, SparseRegion] = field(default_factory=lambda: {r: SparseRegion(r) for r in REGIONS})
+    overlaps: List[Overlap] = field(default_factory=list)
+    entrypoint: Optional[int] = None
+
+    def apply(self, command: lib.DSPCommandData):
+        """ Apply a single command, in the same way the BootROM would. """
+        if command.cmd == lib.CMD_JUMP:
+            self.entrypoint = command.addr
+            return
+
+        region = command.region
+        if region is None:
+            raise ValueError("Unknown command %d at offset 0x%x" % (command.cmd, command.offset))
+
+        data = words.encode(command.data)
+        if command.cmd == 3:
+            data = split_12bit(data)
+
+        for overwritten in self.regions[region].write(command.addr, data):
+            logger.debug("Command at offset 0x%x overwrites %s:0x%06x-0x%06x",
+                         command.offset, region, overwritten.start, overwritten.stop)
+            self.overlaps.append(Overlap(region, overwritten.start, overwritten.stop, command.offset))
+
+    def replay(self, commands: Iterable[lib.DSPCommandData]) -> 'DSPMemoryImage':
+        """ Apply all commands in stream order. """
+        for command in commands:
+            self.apply(command)
+        return self
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import pathlib
+import sys
+from typing import Dict, List, Sequence
+
+import dump_bootstrap
+import dump_dsp_memory
+import lib
+import container  # shared with dsp56k, made importable by lib
+import metrics  # shared with dsp56k, made importable by lib
+
+logger = logging.getLogger(__name__)
+
+"""
+Single process extraction pipeline for Access Virus flash dumps.
+
+Usage: python3 pipeline.py <flash_file> <output_file_prefix> [--artifacts NAME ...]
+
+Runs `dump_bootstrap.py`, `dump_dsp_memory.py` and `be2le.py` in one go:
+the stages are chained in memory, without writing and reading back
+intermediate files. The selected artifacts are written at the end:
+
+ bootrom: output.bootrom.be.bin
+ bootrom_stream: output.bootrom_stream.be.bin
+ command_stream: output.command_stream.be.bin
+ be: output.p.be.bin, output.x.be.bin, output.y.be.bin
+ le: output.p.le.bin, output.x.le.bin, output.y.le.bin
+ container: output.dspc, all of the above (in big endian) in a single file,
+            see `dsp56k/container.py`
+
+By default, all artifacts except the container are written. Use `--metrics json` to report
+the time, throughput and memory of each stage.
+
+Note: This command will overwrite existing output files.
+"""
+
+ARTIFACTS = ['bootrom', 'bootrom_stream', 'command_stream', 'be', 'le', 'container']
+DEFAULT_ARTIFACTS = ARTIFACTS[:-1]
+REGION_BYTEORDERS = {'be': 'big', 'le': 'little'}
+
+
+def run_pipeline(src: pathlib.Path, prefix: str, artifacts: Sequence[str] = DEFAULT_ARTIFACTS,
+                 stats: metrics.Metrics = None) -> List[str]:
+    """ Extract the selected artifacts from a flash dump, returning the written paths. """
+    unknown = [a for a in artifacts if a not in ARTIFACTS]
+    if unknown:
+        raise ValueError("Unknown artifacts: %s" % ", ".join(unknown))
+    stats = stats or metrics.Metrics()
+
+    _, bank_data = dump_bootstrap.read_bank_data(src, stats)
+    logger.info("Flash version: %s, Size: 0x%x", bank_data.version, len(bank_data.data))
+
+    chunk_data = dump_bootstrap.split_chunk_data(bank_data, stats)
+    logger.info("BootROM size: 0x%x, offset: 0x%x", chunk_data.bootrom_size, chunk_data.bootrom_offset)
+    logger.info("CommandStream size: 0x%x", len(chunk_data.data))
+
+    image = None
+    if any(a in REGION_BYTEORDERS or a == 'container' for a in artifacts):
+        image = dump_dsp_memory.replay_stream(chunk_data.data, stats)
+
+    # Write all selected artifacts at the end
+    outputs: Dict[str, bytes] = {}
+    streams: Dict[str, bytes] = {}
+    if any(a in dump_bootstrap.ARTIFACT_NAMES or a == 'container' for a in artifacts):
+        streams = dump_bootstrap.bootstrap_artifacts(chunk_data, stats)
+        outputs = {"%s.%s.be.bin" % (prefix, a): streams[a] for a in artifacts if a in streams}
+
+    written = []
+    for file_path, data in outputs.items():
+        dump_bootstrap.write_file(file_path, data, stats)
+        written.append(file_path)
+
+    for artifact in artifacts:
+        if artifact not in REGION_BYTEORDERS:
+            continue
+        for name, region in image.regions.items():
+            file_path = "%s.%s.%s.bin" % (prefix, name, artifact)
+            dump_dsp_memory.write_region(region, file_path, REGION_BYTEORDERS[artifact], stats)
+            written.append(file_path)
+
+    if 'container' in artifacts:
+        file_path = "%s.dspc" % prefix
+        segments = [(name, seg.start, seg.data) for name, region in image.regions.items() for seg in region]
+        segments += [(name, 0, data) for name, data in streams.items()]
+        with open(file_path, "wb") as fp:
+            container.write_container(fp, segments, stats=stats)
+        written.append(file_path)
+
+    for file_path in written:
+        logger.info("Successfully wrote %s", file_path)
+    return written
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Extract BootROM, CommandStream and DSP memory from a flash dump.")
+    parser.add_argument("input", help="flash dump")
+    parser.add_argument("output", help="output file prefix")
+    parser.add_argument("--artifacts", nargs="+", choices=ARTIFACTS, default=DEFAULT_ARTIFACTS,
+                        help="artifacts to write (default: all but the container)")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    # Make sure the input file exists
+    src = pathlib.Path(args.input)
+    if not src.exists():
+        logger.error("Input file %s does not exist!", src)
+        sys.exit(-1)
+
+    try:
+        with metrics.session(args) as stats:
+            run_pipeline(src, args.output, args.artifacts, stats)
+    except ValueError as e:
+        logger.error("%s", e)
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
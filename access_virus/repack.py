@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+import argparse
+import bisect
+import logging
+import pathlib
+import shutil
+import sys
+from typing import Dict, Iterator, List, Tuple
+
+import dump_dsp_memory
+import flash as flash_banks
+import lib
+import memory
+import bin2lod  # shared with dsp56k, made importable by lib
+import metrics  # shared with dsp56k, made importable by lib
+import words  # shared codec, made importable by lib
+
+logger = logging.getLogger(__name__)
+
+"""
+Repack modified DSP memory into an Access Virus flash image, the inverse of `pipeline.py`.
+
+Usage: python3 repack.py <original_flash> <output_flash> (--images PREFIX | --commands FILE)
+
+Builds a new command stream and packs it, after the BootROM stream, into
+the dsp banks of a copy of the original flash image:
+
+ --images PREFIX: P, X and Y memory from `<prefix>.p.be.bin`, `<prefix>.x.be.bin`
+                  and `<prefix>.y.be.bin` (as written by `dump_dsp_memory.py`)
+ --commands FILE: a command stream, such as a patched `.command_stream.be.bin`
+
+Images are written with the commands of the original command stream: each
+command writes the words it wrote before, now read from the images. This
+includes command 3, unless the low 12 bits of a word are set, in which case
+command 2 is used instead. Words that no original command writes are only
+written when they are not zero, with extra commands before the final jump.
+An unmodified image therefore packs into the original flash image.
+
+The BootROM stream, the version string and the entrypoint are taken from the
+original flash image, unless `--bootrom-stream`, `--version` or `--entry`
+is given. Each bank is filled with as many words as the original bank.
+When the new stream does not fit in the original dsp banks, the banks after
+them are not overwritten unless `--allow-grow` is given, and even then only
+when they are erased and not part of the model's layout (e.g. presets).
+
+The output is a copy of the original flash image, and only the banks that
+differ from the output file are written. Repacking after a small change
+rewrites only the banks that changed.
+"""
+
+REGION_COMMANDS = {'p': 0, 'x': 1, 'y': 2}
+
+
+class Intervals:
+    """ Sorted, disjoint [start, end) word ranges. """
+
+    def __init__(self):
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+
+    def gaps(self, start: int, end: int) -> Iterator[Tuple[int, int]]:
+        """ The parts of [start, end) that are not covered. """
+        i = bisect.bisect_right(self.ends, start)
+        pos = start
+        while i < len(self.starts) and self.starts[i] < end:
+            if self.starts[i] > pos:
+                yield pos, self.starts[i]
+            pos = max(pos, self.ends[i])
+            i += 1
+        if pos < end:
+            yield pos, end
+
+    def add(self, start: int, end: int):
+        """ Cover [start, end), merging it with the ranges it touches. """
+        lo = bisect.bisect_left(self.ends, start)
+        hi = bisect.bisect_right(self.starts, end)
+        if lo < hi:
+            start = min(start, self.starts[lo])
+            end = max(end, self.ends[hi - 1])
+        self.starts[lo:hi] = [start]
+        self.ends[lo:hi] = [end]
+
+
+def read_words(image: bytes, start: int, end: int) -> bytes:
+    """ Words [start, end) of an image, zero beyond its end. """
+    data = image[start * words.WORD_SIZE:end * words.WORD_SIZE]
+    return data + bytes((end - start) * words.WORD_SIZE - len(data))
+
+
+def _command(cmd: int, addr: int, data: bytes) -> lib.DSPCommandData:
+    return lib.DSPCommandData(cmd, addr, len(data) // words.WORD_SIZE, words.WordBuffer([data]))
+
+
+def nonzero_sections(data: bytes) -> Iterator[Tuple[int, int]]:
+    """ Word ranges of the data that are not zero, split up around runs of zero words. """
+    for start, end in bin2lod.iter_sections(data, bin2lod.DEFAULT_MIN_ZERO_RUN):
+        section = data[start * words.WORD_SIZE:end * words.WORD_SIZE]
+        stripped = section.lstrip(b'\0')
+        if not stripped:
+            continue
+        first = (len(section) - len(stripped)) // words.WORD_SIZE
+        last = -(-len(section.rstrip(b'\0')) // words.WORD_SIZE)
+        yield start + first, start + last
+
+
+def image_commands(template: List[lib.DSPCommandData], images: Dict[str, bytes],
+                   stats: metrics.Metrics = None) -> List[lib.DSPCommandData]:
+    """
+    Rewrite the commands of a command stream with the words of the given images.
+
+    A command only takes the words that no later command overwrites from
+    the images, and keeps its original data for the others, so the stream
+    is the same as before when the images did not change.
+    """
+    stats = stats or metrics.Metrics()
+    with stats.stage('rewrite') as stage:
+        covered = {region: Intervals() for region in images}
+        commands = []
+        for command in reversed(template):
+            region = command.region
+            if region is None:
+                commands.append(command)
+                continue
+
+            start, end = command.addr, command.addr + command.word_count
+            data = words.encode(command.data)
+            if command.cmd == 3:
+                data = memory.split_12bit(data)
+            data = bytearray(data)
+            for lo, hi in covered[region].gaps(start, end):
+                data[(lo - start) * words.WORD_SIZE:(hi - start) * words.WORD_SIZE] = \
+                    read_words(images[region], lo, hi)
+            covered[region].add(start, end)
+
+            if command.cmd == 3:
+                joined = memory.join_12bit(bytes(data))
+                if joined is None:
+                    logger.debug("Command 3 at 0x%06x writes the low 12 bits, using command 2", start)
+                    commands.append(_command(2, start, bytes(data)))
+                else:
+                    commands.append(_command(3, start, joined))
+            else:
+                commands.append(_command(command.cmd, start, bytes(data)))
+        commands.reverse()
+
+        # Words no command writes, before the final jump
+        extra = []
+        for region, image in images.items():
+            for lo, hi in covered[region].gaps(0, len(image) // words.WORD_SIZE):
+                data = image[lo * words.WORD_SIZE:hi * words.WORD_SIZE]
+                for start, end in nonzero_sections(data):
+                    extra.append(_command(REGION_COMMANDS[region], lo + start,
+                                          data[start * words.WORD_SIZE:end * words.WORD_SIZE]))
+        if extra:
+            logger.info("Writing %d ranges that were not written before with extra commands", len(extra))
+        commands[-1:-1] = extra
+        stage.add(sum(c.word_count for c in commands) * words.WORD_SIZE)
+    return commands
+
+
+def read_images(prefix: str) -> Dict[str, bytes]:
+    images = {}
+    for region in memory.REGIONS:
+        file_path = pathlib.Path("%s.%s.be.bin" % (prefix, region))
+        if not file_path.exists():
+            raise ValueError("Image %s does not exist" % file_path)
+        images[region] = file_path.read_bytes()
+        if not words.is_aligned(len(images[region])):
+            raise ValueError("Expected a multiple of 24-bit words in %s" % file_path)
+    return images
+
+
+def read_flash(original: bytes,
+               stats: metrics.Metrics = None) -> Tuple[lib.AccessVirusType, int, lib.DSPBankData]:
+    """ Find the model type and dsp offset of the original flash image, and parse its dsp banks. """
+    stats = stats or metrics.Metrics()
+    with stats.stage('bank_data') as stage:
+        model_type, dsp_offset = lib.find_dsp_banks(original)
+        bank_data = lib.get_dsp_bank_data(original, model_type, dsp_offset)
+        stage.add(len(bank_data.data) * words.WORD_SIZE)
+    return model_type, dsp_offset, bank_data
+
+
+def pack_flash(original: bytes, model_type: lib.AccessVirusType, dsp_offset: int, data: bytes, version: str,
+               allow_grow: bool = False, stats: metrics.Metrics = None) -> bytearray:
+    """
+    Pack the dsp data (BootROM stream and command stream) into the dsp banks of a copy of the original flash image.
+
+    The original dsp banks and version string are erased first, the banks
+    are filled with the same number of words as the original banks. Data
+    that needs more banks is refused, unless `allow_grow` is set and the
+    banks after the dsp banks are erased and have no role in the layout.
+    """
+    stats = stats or metrics.Metrics()
+    with stats.stage('pack') as stage:
+        flash = bytearray(original)
+        banks = list(lib.iter_dsp_banks(original, model_type, dsp_offset))
+        for offset, _, end in banks:
+            flash[offset:end] = b'\xFF' * (end - offset)
+        end = banks[-1][2]
+        terminator = original.find(lib.VERSION_TERMINATOR, end)
+        bank_end = banks[-1][0] + lib.BANK_SIZE
+        version_end = bank_end if terminator == -1 else min(terminator + len(lib.VERSION_TERMINATOR), bank_end)
+        flash[end:version_end] = b'\xFF' * (version_end - end)
+
+        bank_words = [(end - start) // words.WORD_SIZE for _, start, end in banks]
+        lib.pack_dsp_bank_data(data, version, model_type, flash, bank_words, dsp_offset, allow_grow)
+        roles = flash_banks.layout_roles(model_type, dsp_offset, len(flash) // lib.BANK_SIZE)
+        for number in range(end // lib.BANK_SIZE + 1, len(roles)):
+            offset = number * lib.BANK_SIZE
+            if roles[number] != flash_banks.BankRole.UNKNOWN and \
+                    flash[offset:offset + lib.BANK_SIZE] != original[offset:offset + lib.BANK_SIZE]:
+                raise ValueError("The dsp banks would grow into %s bank %d" % (roles[number].value, number))
+        stage.add(len(data))
+    return flash
+
+
+def write_changed_banks(flash: bytes, original: pathlib.Path, output: pathlib.Path,
+                        stats: metrics.Metrics = None) -> List[int]:
+    """
+    Write the flash image to a copy of the original, returning the numbers of the banks that were written.
+
+    Only the banks that differ from the output file are written, the
+    output starts out as a copy of the original flash image.
+    """
+    stats = stats or metrics.Metrics()
+    with stats.stage('write') as stage:
+        if not output.exists() or output.stat().st_size != len(flash):
+            shutil.copyfile(original, output)
+        changed = []
+        with open(output, "r+b") as fp:
+            current = fp.read()
+            for offset in range(0, len(flash), lib.BANK_SIZE):
+                bank = flash[offset:offset + lib.BANK_SIZE]
+                if current[offset:offset + lib.BANK_SIZE] != bank:
+                    fp.seek(offset)
+                    fp.write(bank)
+                    changed.append(offset // lib.BANK_SIZE)
+                    stage.add(len(bank))
+    return changed
+
+
+def repack(original_path: pathlib.Path, output_path: pathlib.Path, images: Dict[str, bytes] = None,
+           stream: bytes = None, bootrom_stream: bytes = None, version: str = None, entry: int = None,
+           allow_grow: bool = False, stats: metrics.Metrics = None) -> List[int]:
+    """
+    Repack images or a command stream into a copy of the original flash, returning the written banks.
+
+    Either `images` (by region) or a big endian command `stream` must be given.
+    """
+    stats = stats or metrics.Metrics()
+    original = original_path.read_bytes()
+    model_type, dsp_offset, bank_data = read_flash(original, stats)
+    chunk_data = lib.get_dsp_chunk_data(bank_data)
+    if bootrom_stream is None:
+        bootrom_stream = words.encode([chunk_data.bootrom_size, chunk_data.bootrom_offset]) + \
+            words.encode(chunk_data.bootrom_data)
+
+    if images is not None:
+        template = dump_dsp_memory.parse_commands(chunk_data.data, stats)
+        commands = image_commands(template, images, stats)
+        with stats.stage('encode') as stage:
+            stream = lib.encode_dsp_commands(commands)
+            if template[-1].offset + 2 == len(chunk_data.data):
+                stream = stream[:-words.WORD_SIZE]  # the original stream ends without the size of the jump
+            stage.add(len(stream))
+    commands = dump_dsp_memory.parse_commands(words.WordBuffer([stream]), stats)
+
+    if entry is not None:
+        # Replace the address of the final jump
+        offset = (commands[-1].offset + 1) * words.WORD_SIZE
+        stream = stream[:offset] + words.encode([entry]) + stream[offset + words.WORD_SIZE:]
+
+    flash = pack_flash(original, model_type, dsp_offset, bootrom_stream + stream,
+                       bank_data.version if version is None else version, allow_grow, stats)
+    return write_changed_banks(flash, original_path, output_path, stats)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Repack DSP memory into an Access Virus flash image.")
+    parser.add_argument("original", help="original flash dump")
+    parser.add_argument("output", help="output flash image, a copy of the original with the new dsp banks")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--images", metavar="PREFIX", help="P, X and Y memory (reads <prefix>.<region>.be.bin)")
+    source.add_argument("--commands", metavar="FILE", help="command stream (big endian)")
+    parser.add_argument("--bootrom-stream", help="BootROM stream (default: from the original flash)")
+    parser.add_argument("--version", help="firmware version string (default: from the original flash)")
+    parser.add_argument("--entry", type=lambda s: int(s, 16), help="entrypoint (hex, default: unchanged)")
+    parser.add_argument("--allow-grow", action="store_true",
+                        help="use erased banks after the dsp banks when the stream does not fit in them")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    original = pathlib.Path(args.original)
+    inputs = [original] + [pathlib.Path(p) for p in (args.commands, args.bootrom_stream) if p]
+    for path in inputs:
+        if not path.exists():
+            logger.error("Input file %s does not exist!", path)
+            sys.exit(-1)
+
+    output = pathlib.Path(args.output)
+    existed = output.exists()
+    try:
+        with metrics.session(args) as stats:
+            images = read_images(args.images) if args.images else None
+            stream = pathlib.Path(args.commands).read_bytes() if args.commands else None
+            bootrom_stream = pathlib.Path(args.bootrom_stream).read_bytes() if args.bootrom_stream else None
+            for name, data in (("command stream", stream), ("BootROM stream", bootrom_stream)):
+                if data is not None and not words.is_aligned(len(data)):
+                    raise ValueError("Expected a %s of 24-bit words" % name)
+            changed = repack(original, output, images, stream, bootrom_stream, args.version, args.entry,
+                             args.allow_grow, stats)
+    except ValueError as e:
+        logger.error("%s", e)
+        sys.exit(-1)
+
+    if not existed:
+        logger.info("Wrote %s, %d banks differ from the original", args.output, len(changed))
+    elif changed:
+        logger.info("Rewrote %d banks of %s (%s)", len(changed), args.output, ", ".join(map(str, changed)))
+    else:
+        logger.info("%s is up to date", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import pathlib
+import random
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+import lib
+import words  # shared codec, made importable by lib
+
+logger = logging.getLogger(__name__)
+
+"""
+Synthetic flash image generator for Access Virus models.
+
+Usage: python3 synth_flash.py <output_file> [options]
+
+Writes a LEGACY (512K) or TI (1M) flash image with random DSP data
+in the bank format that `dump_bootstrap.py` reads, so the tools can be
+tested and benchmarked without sharing real flash dumps:
+
+ [ bootrom_size ] [ bootrom_offset ] [ bootrom_data ... ]
+ [ cmd ] [ addr ] [ size ] [ words ... ] ... [ 4 ] [ entrypoint ] [ 0 ]
+
+Commands are picked from the weighted command mix (commands 0-3, where
+3 writes each word as two 12-bit words), and the stream always ends with
+command 4. The commands of a region are laid out in address order, with
+random gaps of up to `--spread` words. With `--overlap`, that fraction
+of the commands writes into the range of an earlier command instead.
+
+The same seed always generates the same image.
+"""
+
+DEFAULT_MIX = {0: 4, 1: 2, 2: 2, 3: 1}
+
+
+@dataclass
+class FlashSpec:
+    model_type: lib.AccessVirusType = lib.AccessVirusType.LEGACY
+    version: str = "synthetic flash image"
+    bootrom_size: int = 0x50
+    bootrom_offset: int = 0x100
+    commands: int = 64
+    mix: Dict[int, int] = field(default_factory=lambda: dict(DEFAULT_MIX))  # command weights
+    max_size: int = 0x400  # maximum number of words per command
+    spread: int = 0x100  # maximum gap between the commands of a region, in words
+    overlap: float = 0.0  # fraction of commands that overwrite an earlier command
+    entrypoint: int = 0x100
+    seed: int = 0
+
+
+def random_words(rng: random.Random, count: int) -> bytes:
+    """ Random big endian 24-bit words. """
+    size = count * words.WORD_SIZE
+    return rng.getrandbits(size * 8).to_bytes(size, 'big') if size else b''
+
+
+def generate_commands(spec: FlashSpec, rng: random.Random) -> List[lib.DSPCommandData]:
+    """ Generate the commands of a command stream, ending with the jump to the entrypoint. """
+    cmds = sorted(spec.mix)
+    weights = [spec.mix[cmd] for cmd in cmds]
+    cursors = {region: 0 for region in set(lib.COMMAND_REGIONS.values())}
+    written: Dict[str, List[lib.DSPCommandData]] = {region: [] for region in cursors}
+
+    commands = []
+    for _ in range(spec.commands):
+        cmd = rng.choices(cmds, weights)[0]
+        region = lib.COMMAND_REGIONS[cmd]
+        size = rng.randint(1, spec.max_size)
+        extent = size * 2 if cmd == 3 else size
+
+        if written[region] and rng.random() < spec.overlap:
+            earlier = rng.choice(written[region])
+            addr = earlier.addr + rng.randrange(earlier.word_count)
+        else:
+            addr = cursors[region] + rng.randint(0, spec.spread)
+        if addr + extent > words.WORD_MASK:
+            raise ValueError("Commands exceed the 24-bit address space, use a smaller spread or size")
+        cursors[region] = max(cursors[region], addr + extent)
+
+        command = lib.DSPCommandData(cmd, addr, size, words.decode(random_words(rng, size)), 0)
+        written[region].append(command)
+        commands.append(command)
+
+    commands.append(lib.DSPCommandData(lib.CMD_JUMP, spec.entrypoint, 0, None))
+    return commands
+
+
+def generate_stream(spec: FlashSpec) -> bytes:
+    """ Generate the DSP data stream: the BootROM stream followed by the command stream. """
+    rng = random.Random(spec.seed)
+    bootrom = random_words(rng, spec.bootrom_size)
+    commands = generate_commands(spec, rng)
+    return words.encode([spec.bootrom_size, spec.bootrom_offset]) + bootrom + lib.encode_dsp_commands(commands)
+
+
+def generate_flash(spec: FlashSpec) -> bytearray:
+    """ Generate a flash image of the spec's model type. """
+    return lib.pack_dsp_bank_data(generate_stream(spec), spec.version, spec.model_type)
+
+
+def parse_mix(value: str) -> Dict[int, int]:
+    """ Parse a command mix like `0=4,1=2,2=2,3=1`. """
+    mix = {}
+    for item in value.split(","):
+        cmd, _, weight = item.partition("=")
+        if int(cmd) not in lib.COMMAND_REGIONS:
+            raise argparse.ArgumentTypeError("command %s does not write to memory" % cmd)
+        mix[int(cmd)] = int(weight or 1)
+    return mix
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Generate a synthetic Access Virus flash image.")
+    parser.add_argument("output", help="output flash image")
+    parser.add_argument("--model", choices=[t.name for t in lib.AccessVirusType], default="LEGACY")
+    parser.add_argument("--version", default=FlashSpec.version, help="firmware version string")
+    parser.add_argument("--bootrom-size", type=lambda v: int(v, 0), default=FlashSpec.bootrom_size)
+    parser.add_argument("--bootrom-offset", type=lambda v: int(v, 0), default=FlashSpec.bootrom_offset)
+    parser.add_argument("--commands", type=int, default=FlashSpec.commands, help="number of write commands")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help="command weights (default: 0=4,1=2,2=2,3=1)")
+    parser.add_argument("--max-size", type=lambda v: int(v, 0), default=FlashSpec.max_size,
+                        help="maximum words per command")
+    parser.add_argument("--spread", type=lambda v: int(v, 0), default=FlashSpec.spread,
+                        help="maximum gap between commands in words")
+    parser.add_argument("--overlap", type=float, default=FlashSpec.overlap,
+                        help="fraction of commands that overwrite an earlier command")
+    parser.add_argument("--entrypoint", type=lambda v: int(v, 0), default=FlashSpec.entrypoint)
+    parser.add_argument("--seed", type=int, default=FlashSpec.seed)
+    args = parser.parse_args()
+
+    spec = FlashSpec(
+        model_type=lib.AccessVirusType[args.model],
+        version=args.version,
+        bootrom_size=args.bootrom_size,
+        bootrom_offset=args.bootrom_offset,
+        commands=args.commands,
+        mix=args.mix,
+        max_size=args.max_size,
+        spread=args.spread,
+        overlap=args.overlap,
+        entrypoint=args.entrypoint,
+        seed=args.seed,
+    )
+    file_path = pathlib.Path(args.output)
+    with open(file_path, "wb") as fp:
+        fp.write(generate_flash(spec))
+
+    logger.info("Successfully wrote %s flash image to %s", spec.model_type.name, file_path)
+
+
+if __name__ == "__main__":
+    main()
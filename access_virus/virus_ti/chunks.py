@@ -1,28 +1,151 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import errno
+import io
 import logging
+import mmap
+import os
+from typing import BinaryIO, Dict, Iterator, List, Optional, Union
 
 logger = logging.getLogger(__name__)
 
+CHUNK_HEADER_SIZE = 8  # [ 4 byte id ] [ 4 byte size ]
+COPY_BUFFER_SIZE = 1 << 20
+
+# Errors that mean a kernel-side copy is not supported for these files
+UNSUPPORTED_COPY_ERRORS = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSOCK, errno.EBADF}
+
+
+def copy_range(src_fd: int, dst_fd: int, offset: int, size: int) -> int:
+    """
+    Copy `size` bytes at `offset` of one file to the current position of another.
+
+    Uses copy_file_range or sendfile so the data does not pass through
+    user space, and falls back to buffered copies where those are not
+    available. Returns the number of bytes copied.
+    """
+    copied = 0
+    for kernel_copy in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+        if kernel_copy is None:
+            continue
+        try:
+            while copied < size:
+                if kernel_copy is os.sendfile:
+                    n = os.sendfile(dst_fd, src_fd, offset + copied, size - copied)
+                else:
+                    n = kernel_copy(src_fd, dst_fd, size - copied, offset + copied)
+                if n == 0:
+                    return copied  # end of file
+                copied += n
+            return copied
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_COPY_ERRORS:
+                raise
+
+    while copied < size:
+        os.lseek(src_fd, offset + copied, os.SEEK_SET)
+        buf = os.read(src_fd, min(COPY_BUFFER_SIZE, size - copied))
+        if not buf:
+            break
+        os.write(dst_fd, buf)
+        copied += len(buf)
+    return copied
+
 
 @dataclass
 class InstallChunk:
     name: str
     size: int
-    data: bytes
+    offset: int = 0  # offset of the chunk data in the file
+    source: Union[mmap.mmap, bytes, None] = field(default=None, repr=False, compare=False)
+
+    @property
+    def data(self) -> bytes:
+        """ The chunk data, only read from the mapped file when accessed. """
+        return self.source[self.offset:self.offset + self.size]
+
+
+class ChunkIndex:
+    """
+    Index of the chunks in an install file.
+
+    The first pass only records the id, offset and size of each chunk.
+    The chunk data is read from a memory map of the file on demand.
+    """
+
+    def __init__(self, fp: BinaryIO):
+        try:
+            self.source = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, io.UnsupportedOperation, ValueError):
+            fp.seek(0)
+            self.source = fp.read()
+        self.fp = fp
+
+        self.file_id = self.source[0:4].decode()
+        self.file_size = file_size = int.from_bytes(self.source[4:8], 'big')
+        logger.debug('Reading %s, size=0x%x', self.file_id, file_size)
+
+        self.chunks: List[InstallChunk] = []
+        self.by_name: Dict[str, InstallChunk] = {}
+        offset = CHUNK_HEADER_SIZE
+        end = min(file_size, len(self.source))
+        while offset < end:
+            chunk_id = self.source[offset:offset + 4].decode()
+            chunk_size = int.from_bytes(self.source[offset + 4:offset + CHUNK_HEADER_SIZE], 'big')
+            logger.debug("Chunk %s, size=0x%x", chunk_id, chunk_size)
+            chunk = InstallChunk(chunk_id, chunk_size, offset + CHUNK_HEADER_SIZE, self.source)
+            self.chunks.append(chunk)
+            self.by_name.setdefault(chunk_id, chunk)
+            offset += CHUNK_HEADER_SIZE + chunk_size
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def __iter__(self) -> Iterator[InstallChunk]:
+        return iter(self.chunks)
+
+    def __getitem__(self, key: Union[int, str]) -> InstallChunk:
+        """ Get a chunk by position or by name. """
+        if isinstance(key, str):
+            return self.by_name[key]
+        return self.chunks[key]
+
+    def get(self, name: str) -> Optional[InstallChunk]:
+        return self.by_name.get(name)
+
+    def copy(self, chunk: InstallChunk, output_path: str):
+        """ Write the chunk data to a file, copying straight from the install file where possible. """
+        with open(output_path, "wb") as fpout:
+            try:
+                fd = self.fp.fileno()
+            except (AttributeError, io.UnsupportedOperation, ValueError):
+                fpout.write(chunk.data)
+                return
+            copied = copy_range(fd, fpout.fileno(), chunk.offset, chunk.size)
+            if copied != chunk.size:
+                raise ValueError("Chunk %s is truncated, copied 0x%x of 0x%x bytes" % (chunk.name, copied, chunk.size))
+
+    def file_table(self) -> Dict[str, InstallChunk]:
+        """
+        Map the file names in the TABL chunk to their chunks.
+
+        The TABL chunk is the first chunk, the files are stored
+        in the chunks that follow it, in the same order.
+        """
+        tabl = self.get("TABL")
+        if tabl is None:
+            return {}
+
+        data = tabl.data
+        count = data[0]
+        entries = [e.decode() for e in data[1:].split(b"\0") if e]
+        first = self.chunks.index(tabl) + 1
+        if len(entries) != count:
+            raise ValueError("TABL lists %d entries, expected %d" % (len(entries), count))
+        if first + count > len(self.chunks):
+            raise ValueError("TABL lists %d entries, but only %d chunks follow it" % (count, len(self.chunks) - first))
+        return dict(zip(entries, self.chunks[first:first + count]))
 
 
-def get_chunks(fp):
+def get_chunks(fp) -> ChunkIndex:
     """ Helper function to deal with the install chunk format. """
-    chunks = []
-    file_id = fp.read(4).decode()
-    file_size = int.from_bytes(fp.read(4), 'big')
-    logger.debug('Reading %s, size=0x%x', file_id, file_size)
-
-    while fp.tell() < file_size:
-        chunk_id = fp.read(4).decode()
-        chunk_size = int.from_bytes(fp.read(4), 'big')
-        data = fp.read(chunk_size)
-        logger.debug("Chunk %s, size=0x%x", chunk_id, chunk_size)
-        chunks.append(InstallChunk(name=chunk_id, size=chunk_size, data=data))
-
-    return chunks
+    return ChunkIndex(fp)
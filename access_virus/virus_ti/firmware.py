@@ -1,56 +1,71 @@
 import logging
 import os
 import sys
+from typing import List, Optional
 
 from chunks import get_chunks
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 """
 Extraction tool for VirusTI firmware files.
 
-Usage: python3 firmware.py <firmware file> <output folder>
+Usage: python3 firmware.py <firmware file> <output folder> [entry ...]
 
 Can be used with firmware_bin and firmware_bin64 from
-Virus TI installation media.
+Virus TI installation media. Extracts all files, or only
+the given entries (e.g. `vti.bin`) when specified.
 """
 
 
-if len(sys.argv) != 3:
-    logger.info("Usage: python3 %s <input firmware> <output folder>", sys.argv[0])
-    sys.exit(-1)
+def extract_entries(src: str, output: str, entries: Optional[List[str]] = None) -> List[str]:
+    """ Extract the given entries (or all of them) of a firmware file into the output folder. """
+    # Index chunks in firmware file, their data is read on demand
+    with open(src, "rb") as fp:
+        chunks = get_chunks(fp)
 
-logger.info("Opening firmware file %s", sys.argv[1])
+        # Get file table
+        table = chunks.file_table()
+        if not table:
+            raise ValueError("TABL not found, did you supply a firmware file?")
 
-# Create output folder
-try:
-    os.mkdir(sys.argv[2])
-except FileExistsError:
-    logger.error("Output folder %s already exists", sys.argv[2])
-    sys.exit(-1)
+        # Select entries
+        entries = entries or list(table)
+        missing = [e for e in entries if e not in table]
+        if missing:
+            raise ValueError("Entries not found in firmware file: %s" % ", ".join(missing))
 
-# Parse chunks from firmware file
-with open(sys.argv[1], "rb") as fp:
-    chunks = get_chunks(fp)
+        # Copy entries to files
+        for entry in entries:
+            logger.info("Writing entry %s", entry)
+            chunks.copy(table[entry], "%s/%s" % (output, entry))
+    return entries
 
-# Get file table
-tables = [c for c in chunks if c.name == "TABL"]
-if not tables:
-    logger.error("TABL not found, did you supply a firmware file?")
-    sys.exit(-1)
 
-# Parse file table
-tabl = tables[0]
-count = tabl.data[0]
-entries = [e.decode() for e in tabl.data[1:].split(b"\0") if e]
-assert len(entries) == count
+def main():
+    logging.basicConfig(level=logging.INFO)
 
-# Write entries to files
-for idx, entry in enumerate(entries):
-    logger.info("Writing entry %s", entry)
-    chunk = chunks[idx+1]
-    with open("%s/%s" % (sys.argv[2], entry), "wb") as fpout:
-        fpout.write(chunk.data)
+    if len(sys.argv) < 3:
+        logger.info("Usage: python3 %s <input firmware> <output folder> [entry ...]", sys.argv[0])
+        sys.exit(-1)
 
-logger.info("Successfully wrote chunks to folder %s", sys.argv[2])
+    logger.info("Opening firmware file %s", sys.argv[1])
+
+    # Create output folder
+    try:
+        os.mkdir(sys.argv[2])
+    except FileExistsError:
+        logger.error("Output folder %s already exists", sys.argv[2])
+        sys.exit(-1)
+
+    try:
+        extract_entries(sys.argv[1], sys.argv[2], sys.argv[3:])
+    except ValueError as e:
+        logger.error("%s", e)
+        sys.exit(-1)
+
+    logger.info("Successfully wrote chunks to folder %s", sys.argv[2])
+
+
+if __name__ == "__main__":
+    main()
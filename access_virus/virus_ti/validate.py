@@ -0,0 +1,267 @@
+import argparse
+import array
+import binascii
+import concurrent.futures
+import io
+import json
+import logging
+import os
+import pathlib
+import re
+import sys
+from typing import BinaryIO, Callable, Dict, List, Optional
+
+import vti
+from chunks import ChunkIndex, get_chunks
+
+logger = logging.getLogger(__name__)
+
+"""
+Integrity scanner for VirusTI installation media.
+
+Usage: python3 validate.py <directory or file ...> [--workers N] [--report FILE]
+
+Checks every firmware file (`firmware_bin`, `firmware_bin64`) and vti
+file (`vti.bin`, `vti_2.bin`, ...) on a pool of worker processes, before
+anything is extracted from them:
+
+ * the chunks fill the file exactly, up to the size in the file header
+ * firmware files: the TABL chunk lists as many entries as there are chunks,
+   and every vti file in the table is checked as well
+ * vti files: every ROM chunk consists of 0x23 byte records plus 2 trailing
+   bytes, and the offsets in the record headers follow each other
+   (ROMs of which no chunk uses the record format are only reported)
+ * the 2 trailing bytes of the record chunks match a checksum
+
+The checksum algorithm is not documented. It is worked out per file by
+trying every candidate in CHECKSUMS on every record chunk: the candidate
+that matches the most chunks is used, as long as it matches at least half
+of them. Record chunks that do not match it are reported as corrupt. When
+no candidate qualifies, the checksum can't be verified, which is only
+reported as a warning.
+
+A report with the result of every file is written as JSON with `--report`.
+Exits with 1 when any file is corrupt.
+"""
+
+ROMS = ['F', 'S', 'P']
+FIRMWARE_NAME = re.compile(r"firmware_bin\w*$")
+VTI_NAME = re.compile(r"vti\w*\.bin$")
+
+
+def _byte_sum16(data: bytes) -> int:
+    return sum(data) & 0xFFFF
+
+
+def _negated_byte_sum16(data: bytes) -> int:
+    return -sum(data) & 0xFFFF
+
+
+def _word_sum16(data: bytes) -> int:
+    values = array.array('H', data[:len(data) & ~1])
+    if sys.byteorder == 'little':
+        values.byteswap()  # big endian 16-bit words
+    return sum(values) & 0xFFFF
+
+
+def _crc16_xmodem(data: bytes) -> int:
+    return binascii.crc_hqx(data, 0)
+
+
+def _crc16_ccitt(data: bytes) -> int:
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+# Checksum candidates for the trailing bytes of a record chunk
+CHECKSUMS: Dict[str, Callable[[bytes], int]] = {
+    'byte_sum16': _byte_sum16,
+    'negated_byte_sum16': _negated_byte_sum16,
+    'word_sum16': _word_sum16,
+    'crc16_xmodem': _crc16_xmodem,
+    'crc16_ccitt': _crc16_ccitt,
+}
+# What the checksum covers: the records including their headers, or only the record data
+COVERAGE: Dict[str, Callable[[bytes], bytes]] = {
+    'records': lambda data: data[:-vti.TRAILER_SIZE],
+    'data': vti.get_record_data,
+}
+
+
+def checksum_candidates(data: bytes) -> Dict[str, bytes]:
+    """ The trailing bytes each candidate expects for a record chunk, by `<checksum>/<coverage>/<byteorder>`. """
+    candidates = {}
+    for coverage, select in COVERAGE.items():
+        covered = select(data)
+        for name, checksum in CHECKSUMS.items():
+            value = checksum(covered)
+            for byteorder in ('big', 'little'):
+                candidates["%s/%s/%s" % (name, coverage, byteorder)] = value.to_bytes(vti.TRAILER_SIZE, byteorder)
+    return candidates
+
+
+def detect_checksum(expected: Dict[int, Dict[str, bytes]], trailers: Dict[int, bytes]) -> Optional[str]:
+    """ The candidate that matches the trailers of the most chunks, when it matches at least half of them. """
+    counts: Dict[str, int] = {}
+    for chunk, candidates in expected.items():
+        for candidate, value in candidates.items():
+            if value == trailers[chunk]:
+                counts[candidate] = counts.get(candidate, 0) + 1
+    if not counts:
+        return None
+    best = max(counts, key=counts.get)  # first candidate in CHECKSUMS order on a tie
+    return best if counts[best] * 2 >= len(trailers) else None
+
+
+def check_chunk_structure(chunks: ChunkIndex, size: int, report: dict):
+    """ The chunks must fill the file up to the size in its header. """
+    report['chunks'] = len(chunks)
+    if chunks.file_size > size:
+        report['errors'].append("file is truncated, header size 0x%x, file size 0x%x" % (chunks.file_size, size))
+    elif chunks.file_size < size:
+        report['warnings'].append("0x%x bytes after the end of the file" % (size - chunks.file_size))
+    if not len(chunks):
+        report['errors'].append("no chunks found")
+    elif chunks[-1].offset + chunks[-1].size > chunks.file_size:
+        report['errors'].append("chunk %s ends at 0x%x, beyond the file size 0x%x"
+                                % (chunks[-1].name, chunks[-1].offset + chunks[-1].size, chunks.file_size))
+
+
+def check_records(name: str, data: bytes) -> str:
+    """ Why a chunk is not a valid record chunk. """
+    return "chunk %s: %s" % (name, vti.record_error(data))
+
+
+def validate_vti(chunks: ChunkIndex, report: dict):
+    roms = report['roms'] = {}
+    # By chunk offset, chunk names are not unique
+    expected: Dict[int, Dict[str, bytes]] = {}
+    trailers: Dict[int, bytes] = {}
+    names: Dict[int, str] = {}
+    for rom in ROMS:
+        parts = [c for c in chunks if c.name.startswith(rom)]
+        if not parts:
+            continue
+        datas = [c.data for c in parts]
+        is_record = [vti.is_record_chunk(data) for data in datas]
+        roms[rom] = {'chunks': len(parts), 'size': sum(map(len, datas)),
+                     'format': 'records' if any(is_record) else 'raw'}
+        if not any(is_record):
+            report['warnings'].append("ROM %s does not use the record format" % rom)
+            continue
+
+        # Either all chunks of a ROM use the record format, or none of them
+        for chunk, data, record in zip(parts, datas, is_record):
+            if record:
+                expected[chunk.offset] = checksum_candidates(data)
+                trailers[chunk.offset] = data[-vti.TRAILER_SIZE:]
+                names[chunk.offset] = chunk.name
+            else:
+                report['errors'].append(check_records(chunk.name, data))
+    if not roms:
+        report['errors'].append("no ROM chunks found")
+
+    checksum = report['checksum'] = detect_checksum(expected, trailers)
+    if checksum is None:
+        if trailers:
+            report['warnings'].append("no checksum matches the trailing bytes of the %d record chunks"
+                                      % len(trailers))
+        return
+    for chunk, trailer in trailers.items():
+        if expected[chunk][checksum] != trailer:
+            report['errors'].append("chunk %s: trailing bytes %s, expected %s (%s)" % (
+                names[chunk], trailer.hex(), expected[chunk][checksum].hex(), checksum))
+
+
+def validate_firmware(chunks: ChunkIndex, report: dict):
+    table = chunks.file_table()
+    if not table:
+        raise ValueError("TABL not found")
+    entries = report['entries'] = {}
+    for name, chunk in table.items():
+        if VTI_NAME.match(name):
+            entries[name] = entry = validate_chunks(name, 'vti', io.BytesIO(chunk.data), chunk.size)
+            if entry['status'] != 'ok':
+                report['errors'].append("entry %s is corrupt" % name)
+
+
+def validate_chunks(name: str, kind: str, fp: BinaryIO, size: int) -> dict:
+    """ Check the chunks of a firmware or vti file. """
+    report = {'file': name, 'type': kind, 'errors': [], 'warnings': []}
+    try:
+        chunks = get_chunks(fp)
+        check_chunk_structure(chunks, size, report)
+        (validate_firmware if kind == 'firmware' else validate_vti)(chunks, report)
+    except (ValueError, IndexError, OverflowError) as e:
+        report['errors'].append("%s: %s" % (type(e).__name__, e))
+    report['status'] = 'corrupt' if report['errors'] else 'ok'
+    return report
+
+
+def validate_file(path: pathlib.Path) -> dict:
+    """ Check a single firmware or vti file, in a worker process. """
+    kind = 'firmware' if FIRMWARE_NAME.match(path.name) else 'vti'
+    try:
+        with open(path, "rb") as fp:
+            return validate_chunks(str(path), kind, fp, os.fstat(fp.fileno()).st_size)
+    except OSError as e:
+        return {'file': str(path), 'type': kind, 'errors': ["%s: %s" % (type(e).__name__, e)], 'warnings': [],
+                'status': 'corrupt'}
+
+
+def find_files(paths: List[str]) -> List[pathlib.Path]:
+    """ The given files, and the firmware and vti files in the given directories (recursively). """
+    files = []
+    for path in map(pathlib.Path, paths):
+        if path.is_dir():
+            files.extend(sorted(p for p in path.rglob("*")
+                                if p.is_file() and (FIRMWARE_NAME.match(p.name) or VTI_NAME.match(p.name))))
+        else:
+            files.append(path)
+    return files
+
+
+def validate_files(files: List[pathlib.Path], workers: int = None) -> List[dict]:
+    """ Check all files on a pool of worker processes, returning the reports in input order. """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(validate_file, files))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Check VirusTI firmware and vti files for corruption.")
+    parser.add_argument("paths", nargs="+", help="files, or directories to search for firmware and vti files")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: CPU count)")
+    parser.add_argument("--report", help="write the report of every file to this file (JSON)")
+    args = parser.parse_args()
+
+    files = find_files(args.paths)
+    if not files:
+        logger.error("No firmware or vti files found")
+        sys.exit(-1)
+
+    reports = validate_files(files, args.workers)
+    for report in reports:
+        for entry in [report] + list(report.get('entries', {}).values()):
+            checksum = entry.get('checksum')
+            if entry['type'] == 'vti' and checksum:
+                logger.info("%s: trailing bytes match %s", entry['file'], checksum)
+            for warning in entry['warnings']:
+                logger.warning("%s: %s", entry['file'], warning)
+            for error in entry['errors']:
+                logger.error("%s: %s", entry['file'], error)
+        logger.info("%s: %s", report['file'], report['status'])
+
+    if args.report:
+        with open(args.report, "w") as fp:
+            json.dump(reports, fp, indent=2)
+        logger.info("Successfully wrote report to %s", args.report)
+
+    corrupt = sum(1 for r in reports if r['status'] != 'ok')
+    logger.info("%d of %d files are ok", len(reports) - corrupt, len(reports))
+    if corrupt:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
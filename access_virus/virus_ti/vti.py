@@ -1,67 +1,156 @@
+import array
 import logging
 import os
 import sys
+from typing import List, Optional
 
 from chunks import get_chunks
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 """
 Extraction tool for VirusTI vti bin files.
 
-Usage: python3 firmware.py <vti file> <output folder>
+Usage: python3 vti.py <vti file> <output folder> [rom ...]
 
 Can be used with vti.bin, vti2.bin and vti_snow.bin which
 can be extracted from the Virus TI installation media
-using firmware.py.
+using firmware.py. Extracts the F, S and P ROMs, or only the
+given ROMs (e.g. `F`) when specified.
 
-Known issue:
-With vti_2.bin, the extraction tool does not work properly
-for the P.bin ROM. It seems that it uses a different format,
-maybe concatenating the files will be sufficient.
-The F.bin and S.bin can still be extracted though.
+ROM chunks consist of 0x23 byte records followed by 2 extra bytes
+(checksum?). Each record is structured like this:
+[ 1 byte id ] [ 2 byte offset ] [ 32 bytes data ]
+
+With vti_2.bin, the P.bin ROM chunks do not use this record format.
+Their format is unknown, so their data is not written as a ROM but
+concatenated as is to P.raw, which is reported with a warning.
+A ROM of which only some chunks use the record format is corrupt, and
+is not extracted.
 """
 
+RECORD_SIZE = 0x23
+RECORD_DATA_OFFSET = 3
+RECORD_DATA_SIZE = 0x20
+TRAILER_SIZE = 2  # 2 bytes extra at the end (checksum?)
+
+
+def record_count(data: bytes) -> int:
+    return (len(data) - TRAILER_SIZE) // RECORD_SIZE
+
+
+def record_offsets(data: bytes) -> array.array:
+    """ The offsets in the header of every record, read at once. """
+    count = record_count(data)
+    end = count * RECORD_SIZE
+    headers = bytearray(count * 2)
+    headers[0::2] = data[1:end:RECORD_SIZE]
+    headers[1::2] = data[2:end:RECORD_SIZE]
+    offsets = array.array('H', headers)
+    if sys.byteorder == 'little':
+        offsets.byteswap()  # headers are big endian
+    return offsets
+
+
+def expected_offsets(count: int) -> array.array:
+    return array.array('H', range(0, count * RECORD_DATA_SIZE, RECORD_DATA_SIZE))
+
+
+def is_record_chunk(data: bytes) -> bool:
+    """ Check the chunk size and the offset in the header of every record at once. """
+    return record_error(data) is None
+
+
+def record_error(data: bytes) -> Optional[str]:
+    """ Why a chunk is not a valid record chunk, or None when it is one. """
+    if len(data) % RECORD_SIZE != TRAILER_SIZE:
+        return "size 0x%x is not a multiple of 0x%x byte records plus %d bytes" % (
+            len(data), RECORD_SIZE, TRAILER_SIZE)
+
+    count = record_count(data)
+    if count * RECORD_DATA_SIZE > 0x10000:
+        return "%d records do not fit in the 2 byte offsets" % count
+    offsets = record_offsets(data)
+    expected = expected_offsets(count)
+    if offsets == expected:
+        return None
+    first = next(i for i, (a, b) in enumerate(zip(offsets, expected)) if a != b)
+    return "record %d has offset 0x%04x, expected 0x%04x" % (first, offsets[first], expected[first])
+
+
+def get_record_data(data: bytes) -> bytearray:
+    """ Concatenate the 32 data bytes of all records, one byte column at a time. """
+    count = record_count(data)
+    end = count * RECORD_SIZE
+    output = bytearray(count * RECORD_DATA_SIZE)
+    for i in range(RECORD_DATA_SIZE):
+        output[i::RECORD_DATA_SIZE] = data[RECORD_DATA_OFFSET + i:end:RECORD_SIZE]
+    return output
+
+
+def extract_roms(src: str, output: str, roms: List[str]) -> List[str]:
+    """ Extract the given ROMs of a vti file into the output folder, returning the written paths. """
+    written = []
+
+    # Index chunks in vti file, their data is read on demand
+    with open(src, "rb") as fp:
+        chunks = get_chunks(fp)
+
+    # Extract the different ROMs
+    for rom_prefix in roms:
+        parts = [c for c in chunks if c.name.startswith(rom_prefix)]
+        if not parts:
+            logger.debug("Skipping not included ROM %s.bin", rom_prefix)
+            continue
+
+        # Either all chunks of a ROM use the record format, or none of them
+        errors = [record_error(chunk.data) for chunk in parts]
+        records = not any(errors)
+        if not records and not all(errors):
+            chunk, error = next((c, e) for c, e in zip(parts, errors) if e)
+            raise ValueError("ROM %s.bin: chunk %s: %s" % (rom_prefix, chunk.name, error))
+        if records:
+            output_path = "%s/%s.bin" % (output, rom_prefix)
+        else:
+            # Not a ROM image as far as we know, keep it apart from the extracted ROMs
+            output_path = "%s/%s.raw" % (output, rom_prefix)
+            logger.warning("ROM %s.bin does not use the record format, writing the raw chunk data to %s",
+                           rom_prefix, output_path)
+
+        with open(output_path, "wb") as fpout:
+            for chunk in parts:
+                logger.debug("Processing chunk %s", chunk.name)
+                fpout.write(get_record_data(chunk.data) if records else chunk.data)
+
+        logger.info("Successfully wrote %s to %s", "ROM" if records else "raw chunk data", output_path)
+        written.append(output_path)
+    return written
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) < 3:
+        logger.info("Usage: python3 %s <input firmware> <output folder> [rom ...]", sys.argv[0])
+        sys.exit(-1)
+
+    roms = sys.argv[3:] or ['F', 'S', 'P']
+
+    logger.info("Opening vti file %s", sys.argv[1])
+
+    # Create output folder
+    try:
+        os.mkdir(sys.argv[2])
+    except FileExistsError:
+        logger.error("Output folder %s already exists", sys.argv[2])
+        sys.exit(-1)
+
+    try:
+        extract_roms(sys.argv[1], sys.argv[2], roms)
+    except ValueError as e:
+        logger.error("%s", e)
+        sys.exit(-1)
+
 
-if len(sys.argv) != 3:
-    logger.info("Usage: python3 %s <input firmware> <output folder>", sys.argv[0])
-    sys.exit(-1)
-
-logger.info("Opening vti file %s", sys.argv[1])
-
-# Create output folder
-try:
-    os.mkdir(sys.argv[2])
-except FileExistsError:
-    logger.error("Output folder %s already exists", sys.argv[2])
-    sys.exit(-1)
-
-# Parse chunks from firmware file
-with open(sys.argv[1], "rb") as fp:
-    chunks = get_chunks(fp)
-
-# Extract the different ROMs
-for rom_prefix in ['F', 'S', 'P']:
-    parts = [c for c in chunks if c.name.startswith(rom_prefix)]
-    if not parts:
-        logger.debug("Skipping not included ROM %s.bin", rom_prefix)
-        continue
-
-    output = b''
-    for chunk in parts:
-        assert chunk.size % 0x23 == 2  # 2 bytes extra at the end (checksum?)
-        logger.debug("Processing chunk %s", chunk.name)
-        idx = 0
-        for i in range(0, chunk.size - 2, 0x23):
-            int.from_bytes(chunk.data[i:i+1], 'big')  # chunk id?
-            header = int.from_bytes(chunk.data[i+1:i+3], 'big')
-            assert idx == header
-            output += chunk.data[i+3:i+0x23]
-            idx += 32
-
-    output_path = "%s/%s.bin" % (sys.argv[2], rom_prefix)
-    with open(output_path, "wb") as fpout:
-        fpout.write(output)
-
-    logger.info("Successfully wrote ROM to %s", output_path)
+if __name__ == "__main__":
+    main()
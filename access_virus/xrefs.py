@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+import argparse
+import csv
+import logging
+import pathlib
+import sys
+from collections import Counter
+from typing import List, TextIO
+
+import dump_dsp_memory
+import lib
+import dsp56300  # shared decoder, made importable by lib
+import metrics  # shared with dsp56k, made importable by lib
+import words  # shared codec, made importable by lib
+
+logger = logging.getLogger(__name__)
+
+"""
+Cross-reference table for the DSP program of an Access Virus.
+
+Usage: python3 xrefs.py <dsp_memory_prefix> [--entry ADDR] [--csv FILE] [--idc FILE]
+
+Decodes `<prefix>.p.be.bin` (as written by `dump_dsp_memory.py`) with a
+linear sweep, starting at the entrypoint of the command stream (command 4,
+read from `<prefix>.command_stream.be.bin` unless `--entry` is given), and
+lists every jump, branch, call and loop with the full 24-bit target
+address. Targets of register indirect jumps are not known and left out.
+
+The table is written as CSV (source, target, flow, instruction), to stdout
+by default. `--idc` writes an IDC script that adds the cross-references
+in IDA, which drops the high address bits of `jclr` targets (and similar)
+on its own. Addresses are word addresses of P memory.
+"""
+
+IDC_FLOW_TYPES = {
+    dsp56300.CALL: "fl_CN",
+    dsp56300.CALL_IF: "fl_CN",
+}
+
+
+def read_entrypoint(stream_path: pathlib.Path, stats: metrics.Metrics = None) -> int:
+    """ The address of the jump (command 4) that ends the command stream. """
+    commands = dump_dsp_memory.parse_commands(words.map_words(stream_path), stats)
+    return commands[-1].addr
+
+
+def find_xrefs(image_path: pathlib.Path, entry: int, stats: metrics.Metrics = None) -> List[dsp56300.Xref]:
+    stats = stats or metrics.Metrics()
+    with stats.stage('read') as stage, words.map_file(image_path) as view:
+        code = words.decode(view)
+        stage.add(len(view))
+    with stats.stage('sweep') as stage:
+        xrefs, word_count = dsp56300.sweep_image(code, entry)
+        stage.add(word_count * words.WORD_SIZE)
+    return xrefs
+
+
+def write_csv(xrefs: List[dsp56300.Xref], fp: TextIO):
+    writer = csv.writer(fp, lineterminator="\n")
+    writer.writerow(["source", "target", "flow", "instruction"])
+    for xref in xrefs:
+        writer.writerow(["0x%06x" % xref.source, "0x%06x" % xref.target, xref.flow, xref.name])
+
+
+def write_idc(xrefs: List[dsp56300.Xref], fp: TextIO):
+    fp.write("#include <idc.idc>\n\nstatic main()\n{\n")
+    for xref in xrefs:
+        fp.write("    add_cref(0x%06x, 0x%06x, %s);  // %s\n" % (
+            xref.source, xref.target, IDC_FLOW_TYPES.get(xref.flow, "fl_JN"), xref.name))
+    fp.write("}\n")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="List the jumps, branches, calls and loops of a DSP program.")
+    parser.add_argument("prefix", help="output prefix of dump_dsp_memory.py (reads <prefix>.p.be.bin)")
+    parser.add_argument("--entry", type=lambda s: int(s, 16),
+                        help="entrypoint (hex), default: read from <prefix>.command_stream.be.bin")
+    parser.add_argument("--csv", help="write the table to this file (default: stdout)")
+    parser.add_argument("--idc", help="write an IDC script adding the cross-references in IDA")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    image_path = pathlib.Path("%s.p.be.bin" % args.prefix)
+    stream_path = pathlib.Path("%s.command_stream.be.bin" % args.prefix)
+    for path in [image_path] + ([] if args.entry is not None else [stream_path]):
+        if not path.exists():
+            logger.error("Input file %s does not exist!", path)
+            sys.exit(-1)
+
+    try:
+        with metrics.session(args) as stats:
+            entry = args.entry if args.entry is not None else read_entrypoint(stream_path, stats)
+            logger.info("Sweeping %s from entrypoint 0x%x", image_path, entry)
+            xrefs = find_xrefs(image_path, entry, stats)
+    except ValueError as e:
+        logger.error("%s", e)
+        sys.exit(-1)
+
+    counts = Counter(x.flow for x in xrefs)
+    logger.info("Found %d cross-references (%s)", len(xrefs),
+                ", ".join("%d %s" % (n, flow) for flow, n in sorted(counts.items())))
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as fp:
+            write_csv(xrefs, fp)
+        logger.info("Successfully wrote %s", args.csv)
+    else:
+        write_csv(xrefs, sys.stdout)
+    if args.idc:
+        with open(args.idc, "w") as fp:
+            write_idc(xrefs, fp)
+        logger.info("Successfully wrote %s", args.idc)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,56 @@
 #!/usr/bin/env python3
+import argparse
 import sys
 import logging
 import pathlib
 
-logging.basicConfig(level=logging.INFO)
+import metrics
+import words
+
 logger = logging.getLogger(__name__)
 
 """
 Convert big endian to little endian for 24bit files.
+
+When the output path equals the input path, the file is
+converted in place (chunk by chunk, without loading it into memory).
 """
 
-if len(sys.argv) != 3:
-    logger.info("Usage: python3 %s <input_binary> <output_binary>", sys.argv[0])
-    sys.exit(-1)
-
-# Make sure the input file exists
-src = pathlib.Path(sys.argv[1])
-if not src.exists():
-    logger.error("Input file %s does not exist!", src)
-    sys.exit(-1)
-
-file_size = src.stat().st_size
-if file_size % 3 != 0:
-    logger.error("Expected a multiple of 24-bit words, size=%d", file_size)
-    sys.exit(-1)
-
-# Convert into little endian
-file_path = sys.argv[2]
-with open(file_path, "wb") as output:
-    with open(sys.argv[1], "rb") as fp:
-        for i in range(0, file_size // 3):
-            word = int.from_bytes(fp.read(3), 'big')
-            output.write(word.to_bytes(3, 'little'))
-
-logger.info("Successfully wrote %s", file_path)
+
+def be2le(src: pathlib.Path, dst: pathlib.Path, stats: metrics.Metrics = None):
+    stats = stats or metrics.Metrics()
+    with stats.stage('swap') as stage:
+        words.swap_file(src, dst)
+        stage.add(dst.stat().st_size)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Convert a big endian 24-bit file to little endian.")
+    parser.add_argument("input", help="input binary")
+    parser.add_argument("output", help="output binary, may be the input to convert in place")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    # Make sure the input file exists
+    src = pathlib.Path(args.input)
+    if not src.exists():
+        logger.error("Input file %s does not exist!", src)
+        sys.exit(-1)
+
+    file_size = src.stat().st_size
+    if not words.is_aligned(file_size):
+        logger.error("Expected a multiple of 24-bit words, size=%d", file_size)
+        sys.exit(-1)
+
+    # Convert into little endian
+    file_path = args.output
+    with metrics.session(args) as stats:
+        be2le(src, pathlib.Path(file_path), stats)
+
+    logger.info("Successfully wrote %s", file_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
+import argparse
+import os
+import re
+import stat
 import sys
 import logging
 import pathlib
+from typing import BinaryIO, Iterator, Tuple
+
+import metrics
+import words
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 """
@@ -13,44 +20,128 @@ by the DSP56k simulator to provide peripheral input.
 An optional argument `repeat` allows you to repeat
 each value multiple times.
 
+Runs of equal words are written as a single value with
+the `#<count>` repeat suffix the simulator supports. Use
+`--no-rle` to write one line per word instead.
+
+With `--fifo`, the output is created as a named pipe (if it
+does not exist yet) and the stream is written while the
+simulator reads it, instead of writing a (large) file first.
+
 Example for simulator:
  load program.lod
  input x:$FFFFC6 stream.io
 """
 
-if len(sys.argv) < 3:
-    logger.info("Usage: python3 %s <input_binary> <output_io> [repeat]", sys.argv[0])
-    sys.exit(-1)
-
-# Make sure the input file exists
-src = pathlib.Path(sys.argv[1])
-if not src.exists():
-    logger.error("Input file %s does not exist!", src)
-    sys.exit(-1)
-
-# Check if repeat argument is a valid number
-repeat = 1
-if len(sys.argv) > 3:
-    repeat = int(sys.argv[3], 10)
-
-file_size = src.stat().st_size
-if file_size % 3 != 0:
-    logger.error("Expected a multiple of 24-bit words, size=%d", file_size)
-    sys.exit(-1)
-
-# Convert into IO
-file_path = sys.argv[2]
-with open(file_path, "wb") as lod:
-    with open(sys.argv[1], "rb") as fp:
-        for i in range(0, file_size // 3):
-            w = int.from_bytes(fp.read(3), 'big')
-
-            # Simulator supports #<number> suffix to repeat a value
-            repeat_suffix = b""
-            if repeat > 1:
-                repeat_suffix = b"#%d" % repeat
-
-            # Write the word
-            lod.write(b'$%06x%s\n' % (w, repeat_suffix))
-
-logger.info("Successfully wrote %s", file_path)
+ZERO_WORDS = re.compile(b'\\x00{%d,}' % words.WORD_SIZE)
+CHUNK_WORDS = words.DEFAULT_CHUNK_SIZE // words.WORD_SIZE
+
+
+def _xor(a: bytes, b: bytes) -> bytes:
+    return (int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')).to_bytes(len(a), 'big')
+
+
+def iter_runs(data: words.Buffer) -> Iterator[Tuple[int, int]]:
+    """
+    Yield (start, end) word ranges of runs of at least two equal words.
+
+    Each chunk of words is XOR-ed with the same chunk shifted by one
+    word; the zero words in the result mark equal neighbours.
+    """
+    word_count = len(data) // words.WORD_SIZE
+    run_start = run_end = None  # run of equal pairs, carried over between chunks
+    for first in range(0, word_count - 1, CHUNK_WORDS):
+        last = min(first + CHUNK_WORDS, word_count - 1)
+        diff = _xor(data[first * words.WORD_SIZE:last * words.WORD_SIZE],
+                    data[(first + 1) * words.WORD_SIZE:(last + 1) * words.WORD_SIZE])
+        for match in ZERO_WORDS.finditer(diff):
+            # Only whole words are equal words, pair i compares word i and i + 1
+            start = first - (-match.start() // words.WORD_SIZE)
+            end = first + match.end() // words.WORD_SIZE
+            if start >= end:
+                continue
+            if start == run_end:
+                run_end = end
+                continue
+            if run_start is not None:
+                yield run_start, run_end + 1
+            run_start, run_end = start, end
+    if run_start is not None:
+        yield run_start, run_end + 1
+
+
+def iter_lines(data: words.Buffer, repeat: int = 1, rle: bool = True) -> Iterator[bytes]:
+    """ Yield blocks of `$<word>[#<count>]` lines. """
+    # Simulator supports #<number> suffix to repeat a value
+    suffix = b"#%d" % repeat if repeat > 1 else b""
+    line_end = suffix + b"\n"
+
+    def words_to_lines(start: int, end: int) -> Iterator[bytes]:
+        for pos in range(start, end, CHUNK_WORDS):
+            block = data[pos * words.WORD_SIZE:min(pos + CHUNK_WORDS, end) * words.WORD_SIZE]
+            yield b"$%s%s" % (words.format_hex(block, (line_end + b"$").decode()).encode(), line_end)
+
+    pos = 0
+    word_count = len(data) // words.WORD_SIZE
+    if rle:
+        for start, end in iter_runs(data):
+            if start > pos:
+                yield from words_to_lines(pos, start)
+            word = data[start * words.WORD_SIZE:(start + 1) * words.WORD_SIZE]
+            yield b"$%s#%d\n" % (word.hex().encode(), (end - start) * repeat)
+            pos = end
+    yield from words_to_lines(pos, word_count)
+
+
+def bin2io(src: pathlib.Path, output: BinaryIO, repeat: int = 1, rle: bool = True, stats: metrics.Metrics = None):
+    stats = stats or metrics.Metrics()
+    with stats.stage('format') as stage, words.map_file(src) as view:
+        for lines in iter_lines(view, repeat, rle):
+            output.write(lines)
+            output.flush()
+        stage.add(len(view))
+
+
+def open_fifo(file_path: pathlib.Path) -> BinaryIO:
+    """ Create a named pipe (unless it exists) and open it, this blocks until a reader opens it. """
+    if not file_path.exists():
+        os.mkfifo(file_path)
+    elif not stat.S_ISFIFO(file_path.stat().st_mode):
+        raise ValueError("%s exists and is not a named pipe" % file_path)
+    logger.info("Waiting for a reader on %s", file_path)
+    return open(file_path, "wb")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Convert a binary image to a simulator I/O stream.")
+    parser.add_argument("input", help="input binary")
+    parser.add_argument("output", help="output I/O stream")
+    parser.add_argument("repeat", nargs="?", type=int, default=1, help="repeat each value (default: 1)")
+    parser.add_argument("--no-rle", action="store_true", help="do not combine runs of equal words")
+    parser.add_argument("--fifo", action="store_true", help="stream to a named pipe")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    # Make sure the input file exists
+    src = pathlib.Path(args.input)
+    if not src.exists():
+        logger.error("Input file %s does not exist!", src)
+        sys.exit(-1)
+
+    file_size = src.stat().st_size
+    if not words.is_aligned(file_size):
+        logger.error("Expected a multiple of 24-bit words, size=%d", file_size)
+        sys.exit(-1)
+
+    # Convert into IO
+    file_path = pathlib.Path(args.output)
+    with metrics.session(args) as stats, (open_fifo(file_path) if args.fifo else open(file_path, "wb")) as output:
+        bin2io(src, output, args.repeat, not args.no_rle, stats)
+
+    logger.info("Successfully wrote %s", file_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,47 +1,132 @@
 #!/usr/bin/env python3
+import argparse
 import sys
 import logging
 import pathlib
+import re
+from typing import BinaryIO, Iterator, List, Tuple
+
+import metrics
+import words
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 """
-Convert binary image to an OMF file that can be loaded
+Convert binary images to an OMF file that can be loaded
 by the DSP56k simulator as source binary.
+
+Usage:
+ python3 bin2lod.py <input_binary> <output_lod> [hex_offset]
+ python3 bin2lod.py <output_lod> --data <region> <hex_offset> <input_binary> [--data ...]
+
+The first form writes a single P memory image. The second form combines
+several images (e.g. the P, X and Y images from `dump_dsp_memory.py`)
+into one OMF file.
+
+Runs of at least `--min-zero-run` zero words (default 16) are not
+written, the image is split into separate _DATA records around them.
 """
 
-if len(sys.argv) < 3:
-    logger.info("Usage: python3 %s <input_binary> <output_lod> [hex_offset]", sys.argv[0])
-    sys.exit(-1)
-
-# Make sure the input file exists
-src = pathlib.Path(sys.argv[1])
-if not src.exists():
-    logger.error("Input file %s does not exist!", src)
-    sys.exit(-1)
-
-# Check the offset
-offset = 0
-if len(sys.argv) > 3:
-    offset = int(sys.argv[3], 16)
-
-file_size = src.stat().st_size
-if file_size % 3 != 0:
-    logger.error("Expected a multiple of 24-bit words, size=%d", file_size)
-    sys.exit(-1)
-
-# Convert into OMF
-file_path = sys.argv[2]
-with open(file_path, "wb") as lod:
-    lod.write(b'_DATA P %06x\n' % offset)
-    with open(sys.argv[1], "rb") as fp:
-        for i in range(0, file_size // 3):
-            w = int.from_bytes(fp.read(3), 'big')
-            lod.write(b'%06x ' % w)
-            if (i + 1) % 8 == 0:
-                lod.write(b'\n')
-        lod.write(b'\n\n')
-    lod.write(b'_END 000000\n')
-
-logger.info("Successfully wrote %s", file_path)
+WORDS_PER_LINE = 8
+BLOCK_SIZE = WORDS_PER_LINE * words.WORD_SIZE << 14  # bytes formatted at once, a multiple of the line size
+DEFAULT_MIN_ZERO_RUN = 16
+
+
+def iter_sections(data: words.Buffer, min_zero_run: int) -> Iterator[Tuple[int, int]]:
+    """ Yield (start, end) word ranges of the data, leaving out runs of at least `min_zero_run` zero words. """
+    word_count = len(data) // words.WORD_SIZE
+    if min_zero_run <= 0:
+        if word_count:
+            yield 0, word_count
+        return
+
+    start = 0
+    pattern = re.compile(b'\\x00{%d,}' % (min_zero_run * words.WORD_SIZE))
+    for match in pattern.finditer(data):
+        # Only whole words are zero words
+        zero_start = -(-match.start() // words.WORD_SIZE)
+        zero_end = match.end() // words.WORD_SIZE
+        if zero_end - zero_start < min_zero_run:
+            continue
+        if zero_start > start:
+            yield start, zero_start
+        start = zero_end
+    if start < word_count:
+        yield start, word_count
+
+
+def format_lines(data: words.Buffer) -> bytes:
+    """ Format words as hex, 8 words per line. """
+    line_size = WORDS_PER_LINE * words.WORD_SIZE
+    return b''.join(b'%s \n' % words.format_hex(data[i:i + line_size]).encode()
+                    for i in range(0, len(data), line_size))
+
+
+def write_data(lod: BinaryIO, region: str, offset: int, data: words.Buffer, min_zero_run: int) -> int:
+    """ Write the data as one or more _DATA records, returns the number of records. """
+    count = 0
+    for start, end in iter_sections(data, min_zero_run):
+        lod.write(b'_DATA %s %06x\n' % (region.encode(), offset + start))
+        for pos in range(start * words.WORD_SIZE, end * words.WORD_SIZE, BLOCK_SIZE):
+            lod.write(format_lines(data[pos:min(pos + BLOCK_SIZE, end * words.WORD_SIZE)]))
+        lod.write(b'\n')
+        count += 1
+    return count
+
+
+def bin2lod(inputs: List[Tuple[str, int, pathlib.Path]], file_path: pathlib.Path,
+            min_zero_run: int = DEFAULT_MIN_ZERO_RUN, entry: int = 0, stats: metrics.Metrics = None):
+    """ Write (region, offset, file) inputs to a single OMF file. """
+    stats = stats or metrics.Metrics()
+    with open(file_path, "wb") as lod:
+        for region, offset, src in inputs:
+            with stats.stage('format') as stage, words.map_file(src) as view:
+                count = write_data(lod, region, offset, view, min_zero_run)
+                stage.add(len(view))
+            logger.info("Wrote %s to %d %s sections", src, count, region)
+        lod.write(b'_END %06x\n' % entry)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Convert binary images to an OMF file.")
+    parser.add_argument("files", nargs="+", help="<input_binary> <output_lod> [hex_offset], or <output_lod> with --data")
+    parser.add_argument("--data", nargs=3, action="append", metavar=("REGION", "HEX_OFFSET", "FILE"),
+                        help="add an image for the given region and offset")
+    parser.add_argument("--min-zero-run", type=int, default=DEFAULT_MIN_ZERO_RUN,
+                        help="skip runs of at least this many zero words, 0 to disable (default: %(default)s)")
+    parser.add_argument("--entry", default="0", help="entry address for the _END record (hex)")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.data:
+        if len(args.files) != 1:
+            parser.error("expected only <output_lod> when using --data")
+        inputs = [(region.upper(), int(offset, 16), pathlib.Path(src)) for region, offset, src in args.data]
+        file_path = args.files[0]
+    else:
+        if not 2 <= len(args.files) <= 3:
+            parser.error("expected <input_binary> <output_lod> [hex_offset]")
+        offset = int(args.files[2], 16) if len(args.files) > 2 else 0
+        inputs = [('P', offset, pathlib.Path(args.files[0]))]
+        file_path = args.files[1]
+
+    for _, _, src in inputs:
+        # Make sure the input file exists
+        if not src.exists():
+            logger.error("Input file %s does not exist!", src)
+            sys.exit(-1)
+
+        file_size = src.stat().st_size
+        if not words.is_aligned(file_size):
+            logger.error("Expected a multiple of 24-bit words, size=%d", file_size)
+            sys.exit(-1)
+
+    with metrics.session(args) as stats:
+        bin2lod(inputs, pathlib.Path(file_path), args.min_zero_run, int(args.entry, 16), stats)
+    logger.info("Successfully wrote %s", file_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+import argparse
+import hashlib
+import logging
+import mmap
+import pathlib
+import re
+import struct
+import sys
+from dataclasses import dataclass
+from typing import BinaryIO, Iterable, Iterator, List, Sequence, Tuple
+
+import metrics
+import words
+
+logger = logging.getLogger(__name__)
+
+"""
+Single file container for extracted DSP memory.
+
+Usage:
+ python3 container.py info <container_file>
+ python3 container.py unpack <container_file> <output_file_prefix> [--byteorder big|little|both]
+ python3 container.py pack <input_file_prefix> <container_file> [--regions NAME ...]
+
+A container holds any number of segments of named regions (p, x, y and
+the bootrom, bootrom_stream and command_stream artifacts) in one file:
+
+ header:         magic "DSPC", version (u16), reserved (u16), segment count (u32)
+ segment table:  per segment, 72 bytes: region name (16 bytes, NUL padded),
+                 start word address (u32), length in words (u32), payload
+                 offset in bytes (u64), byte order (u8, 0 = big, 1 = little),
+                 7 reserved bytes and the SHA-256 of the payload (32 bytes)
+ payloads:       the words of each segment, at offsets that are a multiple
+                 of the word size
+
+All integers are little endian. Unwritten memory is not stored, so there
+is no padding between segments. `Container` maps the file and returns
+views of the payloads, reading an address range does not copy the data.
+
+`unpack` writes the `<prefix>.<region>.be.bin` (and/or `.le.bin`) files of
+`dump_bootstrap.py` and `dump_dsp_memory.py`, `pack` does the opposite
+(runs of zero words of at least `--min-gap` words are left out, except at
+the end). Use
+`pipeline.py --artifacts container` to write a container directly.
+
+Note: This command will overwrite existing output files.
+"""
+
+MAGIC = b"DSPC"
+VERSION = 1
+HEADER = struct.Struct("<4sHHI")
+SEGMENT = struct.Struct("<16sIIQB7x32s")
+BYTEORDERS = ['big', 'little']
+REGION_ORDER = ['p', 'x', 'y', 'bootrom', 'bootrom_stream', 'command_stream']
+DEFAULT_MIN_GAP = 64  # words
+
+
+@dataclass
+class Segment:
+    region: str
+    start: int  # word address
+    length: int  # words
+    offset: int  # payload offset in the file
+    byteorder: str
+    sha256: bytes
+
+    @property
+    def end(self) -> int:
+        return self.start + self.length
+
+
+def _align(offset: int) -> int:
+    return -(-offset // words.WORD_SIZE) * words.WORD_SIZE
+
+
+def write_container(fp: BinaryIO, segments: Iterable[Tuple[str, int, words.Buffer]], byteorder: str = 'big',
+                    stats: metrics.Metrics = None) -> List[Segment]:
+    """
+    Write (region, start address, big endian data) segments to a container, converting
+    the payloads to the given byte order. Returns the segment table.
+    """
+    stats = stats or metrics.Metrics()
+    if byteorder not in BYTEORDERS:
+        raise ValueError("byteorder must be either 'big' or 'little'")
+    segments = [(region, start, data) for region, start, data in segments if len(data)]
+    for region, _, data in segments:
+        if len(region.encode()) > 16:
+            raise ValueError("Region name %r is longer than 16 bytes" % region)
+        if not words.is_aligned(len(data)):
+            raise ValueError("Expected a multiple of 24-bit words in region %s" % region)
+
+    table = []
+    payloads = []
+    offset = _align(HEADER.size + SEGMENT.size * len(segments))
+    with stats.stage('encode') as stage:
+        for region, start, data in segments:
+            payload = bytes(data) if byteorder == 'big' else bytes(words.swap(data))
+            table.append(Segment(region, start, len(payload) // words.WORD_SIZE, offset, byteorder,
+                                 hashlib.sha256(payload).digest()))
+            payloads.append(payload)
+            offset = _align(offset + len(payload))
+            stage.add(len(payload))
+
+    with stats.stage('write') as stage:
+        fp.write(HEADER.pack(MAGIC, VERSION, 0, len(table)))
+        for seg in table:
+            fp.write(SEGMENT.pack(seg.region.encode(), seg.start, seg.length, seg.offset,
+                                  BYTEORDERS.index(seg.byteorder), seg.sha256))
+        for seg, payload in zip(table, payloads):
+            fp.write(bytes(seg.offset - fp.tell()))
+            fp.write(payload)
+            stage.add(len(payload))
+    return table
+
+
+class Container:
+    """
+    Memory mapped container, the segment payloads are views of the mapping.
+
+    Release the views (and word buffers) returned by `payload` and `read`
+    before closing the container.
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = pathlib.Path(path)
+        with open(self.path, "rb") as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        self.segments = self._read_table()
+
+    def _read_table(self) -> List[Segment]:
+        if len(self._map) < HEADER.size:
+            raise ValueError("%s is too small to be a container" % self.path)
+        magic, version, _, count = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise ValueError("%s is not a container (magic %r)" % (self.path, magic))
+        if version != VERSION:
+            raise ValueError("Unsupported container version %d in %s" % (version, self.path))
+
+        segments = []
+        for i in range(count):
+            name, start, length, offset, byteorder, sha256 = SEGMENT.unpack_from(self._map,
+                                                                                 HEADER.size + i * SEGMENT.size)
+            if offset + length * words.WORD_SIZE > len(self._map) or byteorder >= len(BYTEORDERS):
+                raise ValueError("Invalid segment %d in %s" % (i, self.path))
+            segments.append(Segment(name.rstrip(b'\0').decode(), start, length, offset, BYTEORDERS[byteorder], sha256))
+        return segments
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def regions(self) -> List[str]:
+        return list(dict.fromkeys(seg.region for seg in self.segments))
+
+    def region_segments(self, region: str) -> List[Segment]:
+        return sorted((seg for seg in self.segments if seg.region == region), key=lambda s: s.start)
+
+    def region_size(self, region: str) -> int:
+        """ Size of the region in words, up to the end of its last segment. """
+        return max((seg.end for seg in self.segments if seg.region == region), default=0)
+
+    def payload(self, segment: Segment) -> memoryview:
+        return self._view[segment.offset:segment.offset + segment.length * words.WORD_SIZE]
+
+    def read(self, region: str, addr: int, count: int) -> words.WordBuffer:
+        """
+        Words `addr` to `addr + count` of a region as views of the payloads; only
+        unwritten words in between segments are allocated (as zeroes).
+        """
+        segments = self.region_segments(region)
+        byteorders = {seg.byteorder for seg in segments}
+        if len(byteorders) > 1:
+            raise ValueError("Region %s mixes byte orders" % region)
+
+        parts = []
+        pos, end = addr, addr + count
+        for seg in segments:
+            if seg.end <= pos or seg.start >= end:
+                continue
+            if seg.start > pos:
+                parts.append(bytes((seg.start - pos) * words.WORD_SIZE))
+                pos = seg.start
+            stop = min(seg.end, end)
+            parts.append(self.payload(seg)[(pos - seg.start) * words.WORD_SIZE:(stop - seg.start) * words.WORD_SIZE])
+            pos = stop
+        if pos < end:
+            parts.append(bytes((end - pos) * words.WORD_SIZE))
+        return words.WordBuffer(parts, byteorders.pop() if byteorders else 'big')
+
+    def verify(self) -> List[Segment]:
+        """ The segments whose payload does not match its hash. """
+        return [seg for seg in self.segments if hashlib.sha256(self.payload(seg)).digest() != seg.sha256]
+
+    def tofile(self, region: str, file_path: str, byteorder: str = 'big'):
+        """ Write a region as a flat image, like `dump_dsp_memory.py`, seeking over unwritten words. """
+        with open(file_path, "wb") as fp:
+            for seg in self.region_segments(region):
+                fp.seek(seg.start * words.WORD_SIZE)
+                data = self.payload(seg)
+                fp.write(data if seg.byteorder == byteorder else words.swap(data))
+            fp.truncate(self.region_size(region) * words.WORD_SIZE)
+
+
+def iter_segments(data: words.Buffer, min_gap: int = DEFAULT_MIN_GAP) -> Iterator[Tuple[int, memoryview]]:
+    """ Split a flat image into (start address, data) segments at runs of at least `min_gap` zero words. """
+    view = memoryview(data).cast('B')
+    gaps = re.compile(b'\\x00{%d,}' % (min_gap * words.WORD_SIZE))
+    pos = 0
+    for match in gaps.finditer(view):
+        if match.end() == len(view):
+            break  # keep trailing zeroes, they decide the size of the unpacked file
+        start = _align(match.start())
+        end = match.end() // words.WORD_SIZE * words.WORD_SIZE
+        if end - start < min_gap * words.WORD_SIZE:
+            continue
+        if start > pos:
+            yield pos // words.WORD_SIZE, view[pos:start]
+        pos = end
+    if pos < len(view):
+        yield pos // words.WORD_SIZE, view[pos:]
+
+
+def pack(prefix: str, container_path: str, regions: Sequence[str] = REGION_ORDER, min_gap: int = DEFAULT_MIN_GAP,
+         stats: metrics.Metrics = None) -> List[Segment]:
+    """ Pack the existing `<prefix>.<region>.be.bin` files into a container. """
+    stats = stats or metrics.Metrics()
+    segments = []
+    for region in regions:
+        path = pathlib.Path("%s.%s.be.bin" % (prefix, region))
+        if not path.exists():
+            continue
+        with stats.stage('read') as stage:
+            data = path.read_bytes()
+            stage.add(len(data))
+        segments.extend((region, start, data) for start, data in iter_segments(data, min_gap))
+    with open(container_path, "wb") as out:
+        return write_container(out, segments, stats=stats)
+
+
+def unpack(container_path: str, prefix: str, byteorders: Sequence[str] = ('big',),
+           stats: metrics.Metrics = None) -> List[str]:
+    """ Write the regions of a container to `<prefix>.<region>.be.bin` / `.le.bin`, returning the written paths. """
+    stats = stats or metrics.Metrics()
+    written = []
+    with Container(container_path) as container:
+        for region in container.regions:
+            for byteorder in byteorders:
+                file_path = "%s.%s.%s.bin" % (prefix, region, 'be' if byteorder == 'big' else 'le')
+                with stats.stage('write') as stage:
+                    container.tofile(region, file_path, byteorder)
+                    stage.add(sum(seg.length for seg in container.region_segments(region)) * words.WORD_SIZE)
+                written.append(file_path)
+    return written
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Pack, unpack and inspect DSP memory containers.")
+    instrumentation = argparse.ArgumentParser(add_help=False)
+    metrics.add_arguments(instrumentation)
+    commands = parser.add_subparsers(dest="command", required=True)
+    info = commands.add_parser("info", parents=[instrumentation], help="list the segments and verify their hashes")
+    info.add_argument("container")
+    unpack_parser = commands.add_parser("unpack", parents=[instrumentation], help="write .be.bin/.le.bin files")
+    unpack_parser.add_argument("container")
+    unpack_parser.add_argument("output", help="output file prefix")
+    unpack_parser.add_argument("--byteorder", choices=["big", "little", "both"], default="big")
+    pack_parser = commands.add_parser("pack", parents=[instrumentation], help="pack .be.bin files in a container")
+    pack_parser.add_argument("input", help="input file prefix")
+    pack_parser.add_argument("container")
+    pack_parser.add_argument("--regions", nargs="+", default=REGION_ORDER, help="regions to pack (default: all)")
+    pack_parser.add_argument("--min-gap", type=int, default=DEFAULT_MIN_GAP,
+                             help="leave out runs of at least this many zero words (default: %(default)s)")
+    args = parser.parse_args()
+
+    try:
+        with metrics.session(args) as stats:
+            if args.command == "info":
+                with Container(args.container) as container:
+                    corrupt = container.verify()
+                    for seg in container.segments:
+                        print("%-14s 0x%06x-0x%06x %6d words %-6s %s%s" % (
+                            seg.region, seg.start, seg.end, seg.length, seg.byteorder, seg.sha256.hex()[:16],
+                            " CORRUPT" if seg in corrupt else ""))
+                if corrupt:
+                    logger.error("%d segments do not match their hash", len(corrupt))
+                    sys.exit(-1)
+            elif args.command == "unpack":
+                byteorders = ['big', 'little'] if args.byteorder == 'both' else [args.byteorder]
+                for file_path in unpack(args.container, args.output, byteorders, stats):
+                    logger.info("Successfully wrote %s", file_path)
+            else:
+                table = pack(args.input, args.container, args.regions, args.min_gap, stats)
+                logger.info("Successfully wrote %d segments to %s", len(table), args.container)
+    except (ValueError, OSError) as e:
+        logger.error("%s", e)
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+"""
+Table driven instruction length and control flow decoder for the DSP56300.
+
+The decoder does not disassemble: it only determines the length of each
+instruction (one word, or two with an extension word) and, for program
+control instructions, the kind of control flow and the full 24-bit target.
+
+The encodings (from the DSP56300 Family Manual, appendix A) are listed in
+RULES, most specific first, as bit patterns of the opcode word. At import,
+they are compiled into a table indexed by the upper 16 bits of the opcode
+(the parallel move field, or the operation and effective address of other
+instructions). Most entries resolve to a plain instruction length; the
+rest hold an Op for a control flow instruction, or a short list of
+(mask, value, result) checks on the low byte.
+
+`sweep` decodes a P memory image linearly and yields a cross-reference
+for every jump, branch, call and loop with a known target.
+"""
+import array
+from dataclasses import dataclass
+from typing import Iterator, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import words
+
+# Kinds of control flow
+JUMP = 'jump'
+JUMP_IF = 'jump_if'  # conditional jump or branch (Jcc, JCLR, BRSET, ...)
+CALL = 'call'
+CALL_IF = 'call_if'  # conditional subroutine call (JScc, JSCLR, BSSET, ...)
+LOOP = 'loop'  # DO / DOR, the target is the last address of the loop
+RETURN = 'return'
+
+# Target encodings
+ABS12 = 'abs12'  # 12-bit absolute address in the opcode
+ABS = 'abs'  # absolute address in the extension word
+REL9 = 'rel9'  # 9-bit signed displacement in the opcode
+REL = 'rel'  # 24-bit signed displacement in the extension word
+EA = 'ea'  # effective address: absolute when it has an extension word, register indirect otherwise
+REG = 'reg'  # PC relative by an address register, unknown
+
+EA_EXTENSIONS = (0b110000, 0b110100)  # MMMRRR of the absolute address and immediate data modes
+
+
+class Op(NamedTuple):
+    name: str
+    length: int
+    flow: str
+    target: Optional[str]  # None when the target is not known statically
+
+
+@dataclass
+class Rule:
+    pattern: str  # 24 bits, most significant first, 'x' for any bit (spaces are ignored)
+    name: str
+    length: Union[int, str]  # or EA, for an extension word with an absolute or immediate effective address
+    flow: Optional[str] = None
+    target: Optional[str] = None
+
+    def __post_init__(self):
+        bits = self.pattern.replace(' ', '')
+        assert len(bits) == 24, self.pattern
+        self.mask = int(''.join('0' if b == 'x' else '1' for b in bits), 2)
+        self.value = int(bits.replace('x', '0'), 2)
+
+
+RULES = [
+    # Parallel move instructions: the upper 16 bits are the move, the low byte the ALU operation
+    Rule("1xxx xxxx xxxx xxxx xxxx xxxx", "xy move", 1),
+    Rule("01xx xxxx x1xx xxxx xxxx xxxx", "x/y/l move ea", EA),
+    Rule("01xx xxxx xxxx xxxx xxxx xxxx", "x/y/l move aa", 1),
+    Rule("0001 xxxx xxxx xxxx xxxx xxxx", "x:r/r:y move", EA),
+    Rule("001x xxxx xxxx xxxx xxxx xxxx", "i/r/u move", 1),
+    Rule("0000 100x x0xx xxxx xxxx xxxx", "x:r/r:y move class II", EA),
+    Rule("0000 100x x1xx xxxx 00xx xxxx", "movep reg", 1),
+    Rule("0000 100x x1xx xxxx xxxx xxxx", "movep ea", EA),
+
+    Rule("0000 0000 0000 0000 0000 0100", "rti", 1, RETURN),
+    Rule("0000 0000 0000 0000 0000 1100", "rts", 1, RETURN),
+    Rule("0000 0000 0000 0010 0000 0011", "do forever", 2, LOOP, ABS),
+    Rule("0000 0000 0000 0010 0000 0010", "dor forever", 2, LOOP, REL),
+    Rule("0000 0000 0000 0000 0000 111x", "plockr/punlockr", 2),
+
+    Rule("0000 0001 0100 0000 11xx xxxx", "alu #xxxx", 2),
+    Rule("0000 0001 10xx xxxx 1xxx xxxx", "jclr/jset qq", 2, JUMP_IF, ABS),
+    Rule("0000 0001 11xx xxxx 1xxx xxxx", "jsclr/jsset qq", 2, CALL_IF, ABS),
+
+    Rule("0000 0100 0100 0000 010x xxxx", "lra xxxx", 2),
+    Rule("0000 0100 10xx xxxx 0xxx xxxx", "brclr/brset qq", 2, JUMP_IF, REL),
+    Rule("0000 0100 10xx xxxx 1xxx xxxx", "bsclr/bsset qq", 2, CALL_IF, REL),
+
+    Rule("0000 0101 0000 11xx xx0x xxxx", "bra", 1, JUMP, REL9),
+    Rule("0000 0101 0000 10xx xx0x xxxx", "bsr", 1, CALL, REL9),
+    Rule("0000 0101 xxxx 01xx xx0x xxxx", "bcc", 1, JUMP_IF, REL9),
+    Rule("0000 0101 xxxx 00xx xx0x xxxx", "bscc", 1, CALL_IF, REL9),
+    Rule("0000 0101 x1xx xxxx 0xxx xxxx", "movec ea", EA),
+
+    Rule("0000 0110 xxxx xxxx xx00 xxxx", "do", 2, LOOP, ABS),
+    Rule("0000 0110 xxxx xxxx xx01 xxxx", "dor", 2, LOOP, REL),
+
+    Rule("0000 0111 x0xx xxxx 00xx xxxx", "movem aa", 1),
+    Rule("0000 0111 xxxx xxxx xxxx xxxx", "movem/movep ea", EA),
+
+    Rule("0000 1010 0111 0xxx 1xxx xxxx", "move x:(rn+xxxx)", 2),
+    Rule("0000 1010 0xxx xxxx 1xxx xxxx", "jclr/jset ea/aa", 2, JUMP_IF, ABS),
+    Rule("0000 1010 10xx xxxx 1xxx xxxx", "jclr/jset pp", 2, JUMP_IF, ABS),
+    Rule("0000 1010 11xx xxxx 00xx xxxx", "jclr/jset reg", 2, JUMP_IF, ABS),
+    Rule("0000 1010 11xx xxxx 1000 0000", "jmp ea", EA, JUMP, EA),
+    Rule("0000 1010 11xx xxxx 1010 xxxx", "jcc ea", EA, JUMP_IF, EA),
+    Rule("0000 1010 11xx xxxx 01xx xxxx", "bclr/bset reg", 1),
+    Rule("0000 1010 x1xx xxxx xxxx xxxx", "bclr/bset ea", EA),
+
+    Rule("0000 1011 0111 0xxx 1xxx xxxx", "move y:(rn+xxxx)", 2),
+    Rule("0000 1011 0xxx xxxx 1xxx xxxx", "jsclr/jsset ea/aa", 2, CALL_IF, ABS),
+    Rule("0000 1011 10xx xxxx 1xxx xxxx", "jsclr/jsset pp", 2, CALL_IF, ABS),
+    Rule("0000 1011 11xx xxxx 00xx xxxx", "jsclr/jsset reg", 2, CALL_IF, ABS),
+    Rule("0000 1011 11xx xxxx 1000 0000", "jsr ea", EA, CALL, EA),
+    Rule("0000 1011 11xx xxxx 1010 xxxx", "jscc ea", EA, CALL_IF, EA),
+    Rule("0000 1011 11xx xxxx 01xx xxxx", "bchg/btst reg", 1),
+    Rule("0000 1011 x1xx xxxx xxxx xxxx", "bchg/btst ea", EA),
+
+    Rule("0000 1100 0000 xxxx xxxx xxxx", "jmp", 1, JUMP, ABS12),
+    Rule("0000 1100 0001 100x xxxx xxxx", "extract/insert #co", 2),
+    Rule("0000 1100 1xxx xxxx xxxx xxxx", "brclr/brset", 2, JUMP_IF, REL),
+
+    Rule("0000 1101 0000 xxxx xxxx xxxx", "jsr", 1, CALL, ABS12),
+    Rule("0000 1101 0001 0000 1100 0000", "bra", 2, JUMP, REL),
+    Rule("0000 1101 0001 0000 1000 0000", "bsr", 2, CALL, REL),
+    Rule("0000 1101 0001 0000 0100 xxxx", "bcc", 2, JUMP_IF, REL),
+    Rule("0000 1101 0001 0000 0000 xxxx", "bscc", 2, CALL_IF, REL),
+    Rule("0000 1101 0001 1xxx 1100 0000", "bra rn", 1, JUMP, REG),
+    Rule("0000 1101 0001 1xxx 1000 0000", "bsr rn", 1, CALL, REG),
+    Rule("0000 1101 0001 1xxx 0100 xxxx", "bcc rn", 1, JUMP_IF, REG),
+    Rule("0000 1101 0001 1xxx 0000 xxxx", "bscc rn", 1, CALL_IF, REG),
+    Rule("0000 1101 1xxx xxxx xxxx xxxx", "bsclr/bsset", 2, CALL_IF, REL),
+
+    Rule("0000 1110 xxxx xxxx xxxx xxxx", "jcc", 1, JUMP_IF, ABS12),
+    Rule("0000 1111 xxxx xxxx xxxx xxxx", "jscc", 1, CALL_IF, ABS12),
+]
+
+# Anything else is a single word
+DEFAULT_LENGTH = 1
+
+HIGH_MASK = 0xFFFF00
+LOW_MASK = 0x0000FF
+
+Entry = Union[int, Op, List[Tuple[int, int, Union[int, Op]]]]
+
+
+def _resolve(rule: Rule, high: int) -> Union[int, Op]:
+    """ Length, or Op, of a rule for an opcode with the given upper 16 bits. """
+    length = rule.length
+    target = rule.target
+    if length == EA:
+        has_extension = (high >> 8) & 0x3F in EA_EXTENSIONS
+        length = 2 if has_extension else 1
+        if target == EA:
+            target = ABS if has_extension else None
+    if target == REG:
+        target = None
+    return Op(rule.name, length, rule.flow, target) if rule.flow else length
+
+
+def _entry(high: int, rules: Sequence[Rule]) -> Entry:
+    """ The table entry for an opcode with the given upper 16 bits. """
+    checks = []
+    for rule in rules:
+        if (high ^ rule.value) & rule.mask & HIGH_MASK:
+            continue
+        result = _resolve(rule, high)
+        if not rule.mask & LOW_MASK:
+            if not checks:
+                return result
+            checks.append((0, 0, result))
+            return checks
+        checks.append((rule.mask & LOW_MASK, rule.value & LOW_MASK, result))
+    if not checks:
+        return DEFAULT_LENGTH
+    checks.append((0, 0, DEFAULT_LENGTH))
+    return checks
+
+
+def build_table(rules: Sequence[Rule] = RULES) -> List[Entry]:
+    # Most rules fix the upper byte, only check those that can match it
+    by_byte = [[r for r in rules if not (b << 16 ^ r.value) & r.mask & 0xFF0000] for b in range(256)]
+    return [_entry(high << 8, by_byte[high >> 8]) for high in range(1 << 16)]
+
+
+TABLE = build_table()
+
+
+@dataclass
+class Xref:
+    source: int  # address of the instruction
+    target: Optional[int]  # full 24-bit target address, None for a return
+    flow: str
+    name: str
+
+
+def _sign_extend(value: int, bits: int) -> int:
+    return value - (1 << bits) if value & (1 << (bits - 1)) else value
+
+
+def decode(word: int) -> Union[int, Op]:
+    """ The length of the instruction with this opcode, or its Op for a control flow instruction. """
+    entry = TABLE[word >> 8]
+    if entry.__class__ is list:
+        for mask, value, result in entry:
+            if word & mask == value:
+                return result
+    return entry
+
+
+def instruction_length(word: int) -> int:
+    entry = decode(word)
+    return entry if entry.__class__ is int else entry.length
+
+
+def target_address(op: Op, addr: int, word: int, extension: int) -> Optional[int]:
+    """ The full 24-bit target of a control flow instruction at `addr`. """
+    if op.target == ABS12:
+        return word & 0xFFF
+    if op.target == ABS:
+        return extension
+    if op.target == REL9:
+        displacement = (word >> 1) & 0x1E0 | word & 0x1F
+        return (addr + _sign_extend(displacement, 9)) & words.WORD_MASK
+    if op.target == REL:
+        return (addr + _sign_extend(extension, 24)) & words.WORD_MASK
+    return None
+
+
+def sweep(code: Sequence[int], start: int = 0, end: int = None, base: int = 0,
+          returns: bool = False) -> Iterator[Xref]:
+    """
+    Decode the words from `start` to `end` linearly, yielding a cross-reference for every
+    control flow instruction with a known target (and every return when `returns` is set).
+
+    `code` is a sequence of words (e.g. from `words.decode`) at address `base`.
+    """
+    end = len(code) if end is None else end
+    table = TABLE
+    pc = start
+    while pc < end:
+        word = code[pc]
+        entry = table[word >> 8]
+        if entry.__class__ is int:
+            pc += entry
+            continue
+        if entry.__class__ is list:
+            for mask, value, result in entry:
+                if word & mask == value:
+                    entry = result
+                    break
+            if entry.__class__ is int:
+                pc += entry
+                continue
+
+        addr = base + pc
+        extension = code[pc + 1] if entry.length == 2 and pc + 1 < len(code) else 0
+        target = target_address(entry, addr, word, extension)
+        if target is not None or (returns and entry.flow == RETURN):
+            yield Xref(addr, target, entry.flow, entry.name)
+        pc += entry.length
+
+
+def sweep_image(data: words.Buffer, entry: int = 0) -> Tuple[List[Xref], int]:
+    """
+    Sweep a big endian P memory image, starting at the entry point (which decides how
+    instructions are aligned) up to the end, and then from the start up to the entry
+    point. Returns the cross-references in address order and the number of words decoded.
+    """
+    code = words.decode(data) if not isinstance(data, array.array) else data
+    entry = min(entry, len(code))
+    xrefs = list(sweep(code, entry)) + list(sweep(code, 0, entry))
+    xrefs.sort(key=lambda x: x.source)
+    return xrefs, len(code)
@@ -1,78 +1,234 @@
 #!/usr/bin/env python3
+import argparse
 import sys
 import logging
 import pathlib
 from dataclasses import dataclass
-from typing import List
+from typing import BinaryIO, Dict, Iterator, List, Optional, Union
 
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+import metrics
+import words
 
-PAD_CHAR = b'\0'  # padding used between non-consecutive sections in one region
+logger = logging.getLogger(__name__)
 
 """
 Convert an OMF file into a binary image that can be loaded
 into a disassembler.
 
 Will create files for each region that exists in the OMF.
+Unwritten words between sections are skipped with seeks, so
+they read as zeroes (and become holes on file systems that
+support them).
+
+Supported records: _START, _DATA, _BLOCKDATA, _SYMBOL, _COMMENT
+and _END. When the OMF contains symbols, they are exported to
+`<output_prefix>.symbols.txt` as `region name type value` lines.
 """
 
-if len(sys.argv) != 3:
-    logger.info("Usage: python3 %s <input_lod> <output_prefix>", sys.argv[0])
-    sys.exit(-1)
+FLUSH_SIZE = 1 << 20  # bytes of section data to collect before writing
+
+
+@dataclass
+class Data:
+    region: str
+    addr: int
+    data: bytes  # big endian 24-bit words
 
 
 @dataclass
-class Section:
+class BlockData:
+    region: str
+    addr: int
+    count: int
+    value: int
+
+
+@dataclass
+class Symbol:
+    region: str
     name: str
-    offset: int
-    data: List[int]
+    type: str
+    value: str
+
+
+@dataclass
+class Start:
+    fields: List[str]
+
+
+@dataclass
+class End:
+    addr: Optional[int]
+
+
+Record = Union[Data, BlockData, Symbol, Start, End]
+
+
+def parse_words(line: bytes) -> bytes:
+    """ Convert a line of hex words into big endian 24-bit words. """
+    tokens = line.split()
+    joined = b''.join(tokens)
+    if len(joined) == len(tokens) * 2 * words.WORD_SIZE:
+        return bytes.fromhex(joined.decode('ascii'))  # all words have 6 digits, convert at once
+
+    for token in tokens:
+        assert 0 < len(token) <= 6
+    return b''.join(int(token, 16).to_bytes(words.WORD_SIZE, 'big') for token in tokens)
+
 
+def iter_records(fp: BinaryIO) -> Iterator[Record]:
+    """
+    Parse an OMF file line by line.
 
-# Make sure the input file exists
-src = pathlib.Path(sys.argv[1])
-if not src.exists():
-    logger.error("Input file %s does not exist!", src)
-    sys.exit(-1)
+    The words of a _DATA record are yielded in parts of at most
+    FLUSH_SIZE bytes, so memory use does not depend on the file size.
+    """
+    record = None
+    region = None
+    addr = 0
+    pending: List[bytes] = []
+    pending_size = 0
 
-# Parse all the sections
-sections = []
-with open(sys.argv[1], "rb") as fp:
-    lines = fp.read().decode().split("\n")
+    def flush() -> Optional[Data]:
+        nonlocal addr, pending, pending_size
+        if not pending:
+            return None
+        data = Data(region, addr, b''.join(pending))
+        addr += pending_size // words.WORD_SIZE
+        pending, pending_size = [], 0
+        return data
 
-    section = None
-    for line in lines:
+    for line in fp:
         line = line.strip()
         if not line:
             continue  # skip empty lines
 
-        if line.startswith("_"):
-            if section:
-                # Flush previous section
-                sections.append(section)
-
-            # Section start
-            if line.startswith("_DATA"):
-                _, name, offset = line.split(" ")
-                section = Section(name, int(offset, 16), [])
-        else:
-            words = line.split(" ")
-            for word in words:
-                assert 0 < len(word) <= 6
-                section.data.append(int(word, 16))
-
-# Get unique section names
-section_names = set([s.name for s in sections])
-for name in section_names:
-    subsections = sorted([s for s in sections if s.name == name], key=lambda s: s.offset)
-
-    file_path = "%s.%s.bin" % (sys.argv[2], name)
-    with open(file_path, "wb") as fp:
-        for section in subsections:
-            logger.info("Section %s, offset=0x%x, size=0x%x", section.name, section.offset, len(section.data))
-            fp.write(PAD_CHAR * ((section.offset * 3) - fp.tell()))  # write padding
-            print('0x%x' % fp.tell())
-            for word in section.data:
-                fp.write(word.to_bytes(3, 'big'))
-
-    logger.info("Successfully wrote %s", file_path)
+        if line.startswith(b"_"):
+            # Flush previous section
+            data = flush()
+            if data:
+                yield data
+
+            fields = line.decode().split()
+            record = fields[0]
+            if record == "_DATA":
+                _, region, offset = fields
+                addr = int(offset, 16)
+            elif record == "_BLOCKDATA":
+                _, block_region, offset, count, value = fields
+                yield BlockData(block_region, int(offset, 16), int(count, 16), int(value, 16))
+            elif record == "_SYMBOL":
+                region = fields[1]
+            elif record == "_START":
+                yield Start(fields[1:])
+            elif record == "_END":
+                yield End(int(fields[1], 16) if len(fields) > 1 else None)
+            elif record != "_COMMENT":
+                logger.warning("Skipping unsupported record %s", record)
+            continue
+
+        if record == "_DATA":
+            data = parse_words(line)
+            pending.append(data)
+            pending_size += len(data)
+            if pending_size >= FLUSH_SIZE:
+                yield flush()
+        elif record == "_SYMBOL":
+            name, symbol_type, value = line.decode().split()[:3]
+            yield Symbol(region, name, symbol_type, value)
+
+    # Flush the last section, also when no record follows it
+    data = flush()
+    if data:
+        yield data
+
+
+class RegionWriter:
+    """ Write words to one binary file per region, seeking to each address. """
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self.files: Dict[str, BinaryIO] = {}
+
+    def _file(self, region: str) -> BinaryIO:
+        if region not in self.files:
+            self.files[region] = open("%s.%s.bin" % (self.prefix, region), "wb")
+        return self.files[region]
+
+    def write(self, region: str, addr: int, data: bytes):
+        fp = self._file(region)
+        fp.seek(addr * words.WORD_SIZE)
+        fp.write(data)
+
+    def fill(self, region: str, addr: int, count: int, value: int):
+        word = value.to_bytes(words.WORD_SIZE, 'big')
+        block = FLUSH_SIZE // words.WORD_SIZE
+        for start in range(0, count, block):
+            self.write(region, addr + start, word * min(block, count - start))
+
+    def close(self):
+        for fp in self.files.values():
+            fp.close()
+
+
+def lod2bin(src: pathlib.Path, prefix: str, stats: metrics.Metrics = None) -> List[Symbol]:
+    """ Convert an OMF file into binary files per region, returning the symbols. """
+    stats = stats or metrics.Metrics()
+    symbols = []
+    writer = RegionWriter(prefix)
+    try:
+        with stats.stage('parse') as stage, open(src, "rb") as fp:
+            for record in iter_records(fp):
+                if isinstance(record, Data):
+                    stage.add(len(record.data))
+                    logger.debug("Section %s, offset=0x%x, size=0x%x", record.region, record.addr,
+                                 len(record.data) // words.WORD_SIZE)
+                    writer.write(record.region, record.addr, record.data)
+                elif isinstance(record, BlockData):
+                    logger.debug("Block %s, offset=0x%x, count=0x%x", record.region, record.addr, record.count)
+                    writer.fill(record.region, record.addr, record.count, record.value)
+                elif isinstance(record, Symbol):
+                    symbols.append(record)
+                elif isinstance(record, Start):
+                    logger.info("Module %s", " ".join(record.fields))
+                elif isinstance(record, End) and record.addr is not None:
+                    logger.info("Entrypoint @ 0x%x", record.addr)
+    finally:
+        writer.close()
+
+    for region in writer.files:
+        logger.info("Successfully wrote %s.%s.bin", prefix, region)
+    return symbols
+
+
+def write_symbols(symbols: List[Symbol], file_path: str):
+    with open(file_path, "w") as fp:
+        for symbol in symbols:
+            fp.write("%s %s %s %s\n" % (symbol.region, symbol.name, symbol.type, symbol.value))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Convert an OMF file into binary images per region.")
+    parser.add_argument("input", help="input OMF file")
+    parser.add_argument("output", help="output file prefix")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    # Make sure the input file exists
+    src = pathlib.Path(args.input)
+    if not src.exists():
+        logger.error("Input file %s does not exist!", src)
+        sys.exit(-1)
+
+    with metrics.session(args) as stats:
+        symbols = lod2bin(src, args.output, stats)
+    if symbols:
+        file_path = "%s.symbols.txt" % args.output
+        write_symbols(symbols, file_path)
+        logger.info("Successfully wrote %d symbols to %s", len(symbols), file_path)
+
+
+if __name__ == "__main__":
+    main()
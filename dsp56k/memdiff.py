@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+import argparse
+import bisect
+import itertools
+import json
+import logging
+import pathlib
+import sys
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import metrics
+import words
+
+logger = logging.getLogger(__name__)
+
+"""
+Block level diff of DSP memory images (24-bit words, big endian).
+
+Usage:
+ python3 memdiff.py <old> <new> [--all] [--json <file>]
+ python3 memdiff.py --pairwise <image> <image> ...
+
+The arguments are either image files, or output prefixes of
+`dump_dsp_memory.py`, in which case the P, X and Y images
+(`<prefix>.<region>.be.bin`) are compared.
+
+The old image is indexed in blocks of `--block-size` words, by a rolling
+checksum of each block. The new image is scanned word by word, updating
+the checksum of the block at each offset: a block found in the old image
+(first at the same distance as the previous match, then anywhere) is
+extended word by word in both directions. Matches that keep
+the order of the old image are reported as equal (the address may have
+shifted), other matches as moved. The ranges in between are reported as
+modified, inserted or deleted. All ranges are word addresses, with an
+exclusive end.
+
+With `--pairwise`, all images are compared with each other and a table
+with the fraction of words of each image found in the other one is
+printed. Each image is indexed once.
+"""
+
+DEFAULT_BLOCK_WORDS = 16
+REGIONS = ['p', 'x', 'y']
+
+
+@dataclass
+class Match:
+    old: int  # word address in the old image
+    new: int  # word address in the new image
+    size: int  # words
+
+    @property
+    def old_end(self) -> int:
+        return self.old + self.size
+
+    @property
+    def new_end(self) -> int:
+        return self.new + self.size
+
+
+@dataclass
+class Change:
+    kind: str  # equal, moved, modified, inserted or deleted
+    old_start: Optional[int]
+    old_end: Optional[int]
+    new_start: Optional[int]
+    new_end: Optional[int]
+
+    @property
+    def old_size(self) -> int:
+        return self.old_end - self.old_start if self.old_start is not None else 0
+
+    @property
+    def new_size(self) -> int:
+        return self.new_end - self.new_start if self.new_start is not None else 0
+
+    def format(self) -> str:
+        old = "%06x-%06x" % (self.old_start, self.old_end) if self.old_start is not None else "-" * 13
+        new = "%06x-%06x" % (self.new_start, self.new_end) if self.new_start is not None else "-" * 13
+        return "%-8s old %s new %s (%d -> %d words)" % (self.kind, old, new, self.old_size, self.new_size)
+
+
+def _checksum(block: Sequence[int]) -> Tuple[int, int]:
+    """ The rolling checksum of a block: the sum of its words, and the sum of its prefix sums. """
+    return sum(block), sum(itertools.accumulate(block))
+
+
+class BlockIndex:
+    """
+    The blocks of an image at block-aligned word offsets, mapped to the first offset they occur at.
+
+    Blocks are keyed by a rolling checksum (as in rsync), so the blocks of
+    another image can be looked up at every word offset by updating the
+    checksum word by word. A checksum hit is confirmed with a hash of the
+    block (blocks with the same checksum) and compared with the image
+    before it is used.
+    """
+
+    def __init__(self, data: bytes, block_words: int = DEFAULT_BLOCK_WORDS):
+        self.data = bytes(data)
+        self.block_words = block_words
+        self.word_count = len(data) // words.WORD_SIZE
+        values = words.decode(self.data)
+        size = block_words * words.WORD_SIZE
+        self.blocks: Dict[int, int] = {}
+        self.hashes: Dict[int, int] = {}
+        for offset in range(0, self.word_count - block_words + 1, block_words):
+            self.blocks.setdefault(self.key(*_checksum(values[offset:offset + block_words])), offset)
+            self.hashes.setdefault(hash(self.data[offset * words.WORD_SIZE:offset * words.WORD_SIZE + size]), offset)
+
+    def key(self, a: int, b: int) -> int:
+        """ Combine both sums of a checksum into one key, `a` is less than `block_words` 24-bit words. """
+        return b * (self.block_words << 24) + a
+
+    def lookup(self, a: int, b: int, window: bytes) -> Optional[int]:
+        """ The offset of a block equal to the window with the given checksum, if any. """
+        offset = self.blocks.get(self.key(a, b))
+        if offset is None:
+            return None
+        if self.block(offset) != window:
+            offset = self.hashes.get(hash(window))
+            if offset is None or self.block(offset) != window:
+                return None
+        return offset
+
+    def block(self, offset: int) -> bytes:
+        size = self.block_words * words.WORD_SIZE
+        return self.data[offset * words.WORD_SIZE:offset * words.WORD_SIZE + size]
+
+
+def _equal_words(a: bytes, a_pos: int, b: bytes, b_pos: int, count: int, backward: bool = False) -> int:
+    """ Number of equal words (up to `count`) after, or before when `backward`, the given word positions. """
+    size = words.WORD_SIZE
+    equal, step = 0, 16
+    while equal < count and step:
+        end = min(count, equal + step)
+        if backward:
+            same = a[(a_pos - end) * size:(a_pos - equal) * size] == b[(b_pos - end) * size:(b_pos - equal) * size]
+        else:
+            same = a[(a_pos + equal) * size:(a_pos + end) * size] == b[(b_pos + equal) * size:(b_pos + end) * size]
+        if same:
+            equal = end
+            step *= 2
+        else:
+            step = (end - equal) // 2  # narrow down on the first different word
+    return equal
+
+
+def find_matches(old: BlockIndex, new: bytes) -> List[Match]:
+    """ Find the ranges of the new image that also occur in the old image, in new address order. """
+    new = bytes(new)
+    values = words.decode(new)
+    block = old.block_words
+    size = block * words.WORD_SIZE
+    new_count = len(new) // words.WORD_SIZE
+
+    matches = []
+    pos = last_end = delta = 0
+    a = b = None  # rolling checksum of the block at pos
+    while pos + block <= new_count:
+        window = new[pos * words.WORD_SIZE:pos * words.WORD_SIZE + size]
+        expected = pos - delta  # continue at the same distance as the previous match, once per block
+        if (pos - last_end) % block == 0 and 0 <= expected <= old.word_count - block and \
+                old.block(expected) == window:
+            old_pos = expected
+        else:
+            if a is None:
+                a, b = _checksum(values[pos:pos + block])
+            old_pos = old.lookup(a, b, window)
+            if old_pos is None:
+                if pos + block < new_count:
+                    a += values[pos + block] - values[pos]
+                    b += a - block * values[pos]
+                pos += 1
+                continue
+
+        back = _equal_words(old.data, old_pos, new, pos, min(pos - last_end, old_pos), backward=True)
+        forward = _equal_words(old.data, old_pos, new, pos, min(old.word_count - old_pos, new_count - pos))
+        match = Match(old_pos - back, pos - back, back + forward)
+        matches.append(match)
+        pos = last_end = match.new_end
+        delta = match.new - match.old
+        a = b = None
+    return matches
+
+
+def _in_order(matches: Sequence[Match]) -> List[int]:
+    """ Indexes of the longest chain of matches that is ordered in both images. """
+    tails: List[int] = []  # old address of the last match of the best chain of each length
+    tail_idx: List[int] = []
+    previous = [-1] * len(matches)
+    for i, match in enumerate(matches):
+        n = bisect.bisect_left(tails, match.old)
+        if n == len(tails):
+            tails.append(match.old)
+            tail_idx.append(i)
+        else:
+            tails[n] = match.old
+            tail_idx[n] = i
+        previous[i] = tail_idx[n - 1] if n else -1
+
+    chain = []
+    i = tail_idx[-1] if tail_idx else -1
+    while i != -1:
+        chain.append(i)
+        i = previous[i]
+    return chain[::-1]
+
+
+def _subtract(start: int, end: int, ranges: List[range]) -> List[range]:
+    """ The parts of [start, end) not covered by the (sorted) ranges. """
+    parts = []
+    for r in ranges:
+        if r.start >= end:
+            break
+        if r.start > start:
+            parts.append(range(start, min(r.start, end)))
+        start = max(start, r.stop)
+    if start < end:
+        parts.append(range(start, end))
+    return [p for p in parts if p]
+
+
+def diff(old: BlockIndex, new: bytes) -> List[Change]:
+    """ Compare a new image against an indexed old image. """
+    matches = find_matches(old, new)
+    chain = set(_in_order(matches))
+    ordered = [m for i, m in enumerate(matches) if i in chain]
+    moved = [m for i, m in enumerate(matches) if i not in chain]
+    moved_old = sorted((range(m.old, m.old_end) for m in moved), key=lambda r: r.start)
+    moved_new = [range(m.new, m.new_end) for m in moved]  # matches are in new address order
+
+    # Sorted by new address, a deleted range sorts at the new address it was deleted from
+    changes = [(m.new, Change('moved', m.old, m.old_end, m.new, m.new_end)) for m in moved]
+    old_end = new_end = 0
+    end = Match(old.word_count, len(new) // words.WORD_SIZE, 0)
+    for match in ordered + [end]:
+        # Ranges in between two ordered matches that are not part of a moved block
+        old_gap = _subtract(old_end, max(old_end, match.old), moved_old)
+        new_gap = _subtract(new_end, match.new, moved_new)
+        if old_gap or new_gap:
+            old_start, old_stop = (old_gap[0].start, old_gap[-1].stop) if old_gap else (None, None)
+            new_start, new_stop = (new_gap[0].start, new_gap[-1].stop) if new_gap else (None, None)
+            kind = 'modified' if old_gap and new_gap else 'inserted' if new_gap else 'deleted'
+            changes.append((new_start if new_gap else new_end, Change(kind, old_start, old_stop, new_start, new_stop)))
+        if match.size:
+            changes.append((match.new, Change('equal', match.old, match.old_end, match.new, match.new_end)))
+        old_end, new_end = max(old_end, match.old_end), match.new_end
+
+    return [change for _, change in sorted(changes, key=lambda c: c[0])]
+
+
+def similarity(changes: List[Change], new_size: int) -> float:
+    """ Fraction of the words of the new image that were found in the old image. """
+    found = sum(c.new_size for c in changes if c.kind in ('equal', 'moved'))
+    return found / new_size if new_size else 1.0
+
+
+def read_images(path: str) -> Dict[str, bytes]:
+    """
+    Read an image file, or the P, X and Y images of a `dump_dsp_memory.py` output prefix.
+
+    Region images that do not exist are left out (with a warning).
+    """
+    if pathlib.Path(path).is_file():
+        paths = {'image': pathlib.Path(path)}
+    else:
+        paths = {r: pathlib.Path("%s.%s.be.bin" % (path, r)) for r in REGIONS}
+        if not any(p.exists() for p in paths.values()):
+            raise ValueError("No image %s or region images %s.<region>.be.bin found" % (path, path))
+
+    images = {}
+    for region, file_path in paths.items():
+        if not file_path.exists():
+            logger.warning("Region image %s does not exist, skipping region %s", file_path, region)
+            continue
+        with words.map_file(file_path) as view:
+            if not words.is_aligned(len(view)):
+                raise ValueError("Expected a multiple of 24-bit words in %s" % file_path)
+            images[region] = bytes(view)
+    return images
+
+
+def diff_images(old: Dict[str, bytes], new: Dict[str, bytes], block_words: int = DEFAULT_BLOCK_WORDS,
+                stats: metrics.Metrics = None) -> Dict[str, List[Change]]:
+    """ Compare the regions of two versions, regions that only exist in one of them are skipped. """
+    stats = stats or metrics.Metrics()
+    changes = {}
+    for region in old:
+        if region not in new:
+            logger.warning("Region %s only exists in the old version, skipping it", region)
+            continue
+        with stats.stage('index') as stage:
+            index = BlockIndex(old[region], block_words)
+            stage.add(len(old[region]))
+        with stats.stage('diff') as stage:
+            changes[region] = diff(index, new[region])
+            stage.add(len(new[region]))
+    for region in new:
+        if region not in old:
+            logger.warning("Region %s only exists in the new version, skipping it", region)
+    return changes
+
+
+def pairwise(names: Sequence[str], images: Sequence[Dict[str, bytes]], block_words: int = DEFAULT_BLOCK_WORDS,
+             stats: metrics.Metrics = None) -> List[List[float]]:
+    """ Fraction of the words of each image (column) found in every other image (row), over the regions of both. """
+    stats = stats or metrics.Metrics()
+    with stats.stage('index') as stage:
+        indexes = [{region: BlockIndex(data, block_words) for region, data in image.items()} for image in images]
+        stage.add(sum(len(data) for image in images for data in image.values()))
+
+    table = [[1.0] * len(names) for _ in names]
+    with stats.stage('diff') as stage:
+        for i, j in itertools.permutations(range(len(names)), 2):
+            found = total = 0
+            for region, data in images[j].items():
+                index = indexes[i].get(region)
+                if index is None:
+                    continue
+                word_count = len(data) // words.WORD_SIZE
+                found += similarity(diff(index, data), word_count) * word_count
+                total += word_count
+                stage.add(len(data))
+            table[i][j] = found / total if total else 1.0
+    return table
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Compare DSP memory images of two (or more) firmware versions.")
+    parser.add_argument("images", nargs="+", help="image files or dump_dsp_memory.py output prefixes")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_WORDS,
+                        help="block size in words (default: %(default)s)")
+    parser.add_argument("--pairwise", action="store_true", help="compare all images with each other")
+    parser.add_argument("--all", action="store_true", help="also report equal ranges")
+    parser.add_argument("--json", help="write the changes as JSON to this file")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    if not args.pairwise and len(args.images) != 2:
+        parser.error("expected <old> <new>, or --pairwise with any number of images")
+
+    try:
+        images = [read_images(path) for path in args.images]
+    except ValueError as e:
+        logger.error("%s", e)
+        sys.exit(-1)
+
+    with metrics.session(args) as stats:
+        if args.pairwise:
+            table = pairwise(args.images, images, args.block_size, stats)
+            width = max(len(name) for name in args.images)
+            print(" " * width + "".join(" %7d" % j for j in range(len(args.images))))
+            for i, name in enumerate(args.images):
+                print(name.ljust(width) + "".join(" %6.1f%%" % (100 * v) for v in table[i]))
+            return
+
+        old, new = images
+        changes = diff_images(old, new, args.block_size, stats)
+
+    for region, region_changes in changes.items():
+        shown = [c for c in region_changes if args.all or c.kind != 'equal']
+        changed = sum(c.new_size for c in region_changes if c.kind in ('modified', 'inserted'))
+        logger.info("Region %s: %d changes, %d new words changed, %.1f%% found in the old image", region,
+                    sum(1 for c in region_changes if c.kind != 'equal'), changed,
+                    100 * similarity(region_changes, len(new[region]) // words.WORD_SIZE))
+        for change in shown:
+            print("%s %s" % (region, change.format()))
+
+    if args.json:
+        with open(args.json, "w") as fp:
+            json.dump({r: [asdict(c) for c in cs] for r, cs in changes.items()}, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
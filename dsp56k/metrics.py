@@ -0,0 +1,166 @@
+"""
+Stage instrumentation shared by the tools.
+
+Each tool splits its work in stages (bank reading, chunk splitting,
+command parsing, region rendering, endian conversion, file writes) and
+records the wall time, the number of bytes and words processed and the
+peak memory of each stage:
+
+    with stats.stage('swap') as stage:
+        data = words.swap(data)
+        stage.add(len(data))
+
+The command line options added by `add_arguments` print the stages
+as JSON or text (`--metrics json`), and can run the tool under cProfile
+(`--profile <file>`) or trace Python memory allocations with tracemalloc
+(`--trace-memory`) to get the peak allocation per stage.
+"""
+import argparse
+import contextlib
+import cProfile
+import json
+import logging
+import sys
+import time
+import tracemalloc
+from dataclasses import asdict, dataclass
+from typing import Dict, Iterator, Optional
+
+import words
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+def peak_rss_kb() -> Optional[int]:
+    """
+    Peak RSS of this process in kilobytes.
+
+    On Linux, `ru_maxrss` includes the RSS of the parent at the time it
+    forked, so the high water mark of the process' own memory is used.
+    """
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    # ru_maxrss is in kilobytes on Linux, but in bytes on macOS
+    return usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+
+
+@dataclass
+class Stage:
+    name: str
+    calls: int = 0
+    seconds: float = 0.0
+    bytes: int = 0
+    words: int = 0
+    peak_rss_kb: Optional[int] = None  # process high water mark at the end of the stage
+    peak_traced_kb: Optional[int] = None  # peak of the Python allocations during the stage (tracemalloc)
+
+    def add(self, size: int, word_count: Optional[int] = None):
+        """ Count processed bytes, and words (derived from the bytes unless given). """
+        self.bytes += size
+        self.words += size // words.WORD_SIZE if word_count is None else word_count
+
+    @property
+    def words_per_second(self) -> float:
+        return self.words / self.seconds if self.seconds else 0.0
+
+    def report(self) -> dict:
+        report = asdict(self)
+        report['seconds'] = round(self.seconds, 6)
+        report['words_per_second'] = round(self.words_per_second)
+        return report
+
+
+class Metrics:
+    """ Records the stages of a run, a stage that runs more than once is accumulated. """
+
+    def __init__(self):
+        self.stages: Dict[str, Stage] = {}
+        self.started = time.perf_counter()
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[Stage]:
+        stage = self.stages.setdefault(name, Stage(name))
+        tracing = tracemalloc.is_tracing()
+        if tracing and hasattr(tracemalloc, 'reset_peak'):  # python 3.9+
+            tracemalloc.reset_peak()
+        started = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.seconds += time.perf_counter() - started
+            stage.calls += 1
+            stage.peak_rss_kb = peak_rss_kb()
+            if tracing:
+                peak = tracemalloc.get_traced_memory()[1] // 1024
+                stage.peak_traced_kb = max(stage.peak_traced_kb or 0, peak)
+
+    def timings(self) -> Dict[str, float]:
+        return {name: round(stage.seconds, 6) for name, stage in self.stages.items()}
+
+    def report(self) -> dict:
+        return {
+            'elapsed': round(time.perf_counter() - self.started, 6),
+            'peak_rss_kb': peak_rss_kb(),
+            'stages': [stage.report() for stage in self.stages.values()],
+        }
+
+    def format_text(self) -> str:
+        lines = ["%-16s %6s %10s %12s %14s %10s" % ("stage", "calls", "seconds", "words", "words/s", "peak KB")]
+        for stage in self.stages.values():
+            peak = stage.peak_traced_kb if stage.peak_traced_kb is not None else stage.peak_rss_kb
+            lines.append("%-16s %6d %10.4f %12d %14d %10s" % (stage.name, stage.calls, stage.seconds, stage.words,
+                                                              stage.words_per_second, peak))
+        return "\n".join(lines) + "\n"
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    group = parser.add_argument_group("instrumentation")
+    group.add_argument("--metrics", choices=["json", "text"], help="report time, throughput and memory per stage")
+    group.add_argument("--metrics-file", help="write the metrics to this file (default: stderr)")
+    group.add_argument("--profile", metavar="FILE", help="run under cProfile and write the stats to this file")
+    group.add_argument("--trace-memory", action="store_true",
+                       help="trace Python allocations to report the peak memory of each stage")
+
+
+@contextlib.contextmanager
+def session(args: argparse.Namespace) -> Iterator[Metrics]:
+    """ Record metrics for the duration of a run, as configured by the options from `add_arguments`. """
+    stats = Metrics()
+    profiler = cProfile.Profile() if args.profile else None
+    if args.trace_memory:
+        tracemalloc.start()
+    if profiler:
+        profiler.enable()
+    try:
+        yield stats
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logger.info("Wrote profile to %s", args.profile)
+        if args.trace_memory:
+            tracemalloc.stop()
+        if args.metrics:
+            write_report(stats, args.metrics, args.metrics_file)
+
+
+def write_report(stats: Metrics, fmt: str, file_path: Optional[str] = None):
+    text = json.dumps(stats.report(), indent=2) + "\n" if fmt == "json" else stats.format_text()
+    if file_path:
+        with open(file_path, "w") as fp:
+            fp.write(text)
+    else:
+        sys.stderr.write(text)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import pathlib
+import re
+import sys
+from collections import Counter
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import metrics
+import words
+
+logger = logging.getLogger(__name__)
+
+"""
+Rule based binary patch utility for DSP56k binary files.
+
+Usage: python3 patch.py <rule_file> <binary_file> <output_file> [--report <report_file>]
+
+The rule file is a JSON file with a list of rules. Each rule matches a
+sequence of words (with optional masks, so operands can be wildcards)
+at word-aligned positions, and transforms one word of each match:
+
+{
+  "rules": [
+    {
+      "name": "omr",               // name used in the report
+      "pattern": ["05f43a"],       // words to match (hex)
+      "mask": ["ffffff"],          // optional, bits that have to match
+      "target": 1,                 // optional, word to patch relative to the
+                                   // match (default: the word after the pattern)
+      "and": "ffbfff",             // optional transforms of the target word,
+      "or": "000000",              // applied as ((word & and) | or) ^ xor
+      "xor": "000000",
+      "range": ["000000", "010000"] // optional, word addresses [start, end)
+    }
+  ]
+}
+
+All rules are matched in a single pass over the file. When several
+rules match at the same position, the first rule (in file order) of
+which the range includes the position is applied. When matches
+overlap, they are processed in address order and a match that starts
+inside the words of a previous match is skipped. The report lists the
+address, rule, and old and new value of every patched word, matches
+that leave the word unchanged are not reported.
+"""
+
+
+@dataclass
+class PatchRule:
+    name: str
+    pattern: List[int]
+    mask: List[int]
+    target: int
+    and_mask: int = words.WORD_MASK
+    or_mask: int = 0
+    xor_mask: int = 0
+    start: int = 0
+    end: Optional[int] = None
+
+    @classmethod
+    def from_dict(cls, rule: dict) -> 'PatchRule':
+        pattern = [int(w, 16) for w in rule['pattern']]
+        mask = [int(w, 16) for w in rule.get('mask', [])] or [words.WORD_MASK] * len(pattern)
+        if len(mask) != len(pattern):
+            raise ValueError("Rule %s: pattern and mask should have the same length" % rule['name'])
+        start, end = rule.get('range', (None, None))
+        return cls(
+            name=rule['name'],
+            pattern=pattern,
+            mask=mask,
+            target=rule.get('target', len(pattern)),
+            and_mask=int(rule.get('and', '%06x' % words.WORD_MASK), 16),
+            or_mask=int(rule.get('or', '0'), 16),
+            xor_mask=int(rule.get('xor', '0'), 16),
+            start=int(start, 16) if start else 0,
+            end=int(end, 16) if end else None,
+        )
+
+    @property
+    def span(self) -> int:
+        """ Number of words covered by a match, including the target word. """
+        return max(len(self.pattern), self.target + 1)
+
+    def in_range(self, addr: int) -> bool:
+        return self.start <= addr and (self.end is None or addr < self.end)
+
+    def transform(self, word: int) -> int:
+        return ((word & self.and_mask) | self.or_mask) ^ self.xor_mask
+
+
+@dataclass
+class PatchHit:
+    addr: int  # address of the patched word
+    rule: str
+    old: int
+    new: int
+
+
+def load_rules(path: pathlib.Path) -> List[PatchRule]:
+    with open(path) as fp:
+        return [PatchRule.from_dict(r) for r in json.load(fp)['rules']]
+
+
+def compile_rules(rules: Sequence[PatchRule], byteorder: str = 'big') -> re.Pattern:
+    """
+    Combine the patterns of all rules in one expression, matching at every position.
+
+    The expression only matches where at least one rule matches, and then
+    captures every rule that matches there (group `r<index>`).
+    """
+    patterns = [words.pattern_regex(r.pattern, r.mask, byteorder) for r in rules]
+    any_rule = b'(?=' + b'|'.join(patterns) + b')'
+    each_rule = b''.join(b'(?:(?=(?P<r%d>%s)))?' % (i, p) for i, p in enumerate(patterns))
+    return re.compile(any_rule + each_rule, re.DOTALL)
+
+
+def find_matches(data: words.Buffer, rules: Sequence[PatchRule], base: int = 0,
+                 byteorder: str = 'big') -> Iterator[Tuple[int, PatchRule]]:
+    """
+    Yield the word index and rule of every word-aligned match within the range of its rule.
+
+    When several rules match at a position, the first one (in rule order) that applies there is used.
+    """
+    word_count = len(data) // words.WORD_SIZE
+    next_idx = 0
+    for match in compile_rules(rules, byteorder).finditer(data):
+        pos = match.start()
+        if pos % words.WORD_SIZE:
+            continue
+        idx = pos // words.WORD_SIZE
+        if idx < next_idx:
+            continue
+        matched = (rules[int(name[1:])] for name, value in match.groupdict().items() if value is not None)
+        rule = next((r for r in matched if r.in_range(base + idx) and idx + r.target < word_count), None)
+        if rule is None:
+            continue
+        yield idx, rule
+        next_idx = idx + rule.span
+
+
+def apply_rules(data: bytearray, rules: Sequence[PatchRule], base: int = 0, byteorder: str = 'big') -> List[PatchHit]:
+    """ Patch the data in place, returning a hit for every changed word. """
+    hits = []
+    for idx, rule in list(find_matches(data, rules, base, byteorder)):
+        pos = (idx + rule.target) * words.WORD_SIZE
+        old = int.from_bytes(data[pos:pos + words.WORD_SIZE], byteorder)
+        new = rule.transform(old) & words.WORD_MASK
+        if new == old:
+            continue  # already patched
+        data[pos:pos + words.WORD_SIZE] = new.to_bytes(words.WORD_SIZE, byteorder)
+        logger.debug("Patched %s at 0x%06x from 0x%06x to 0x%06x", rule.name, base + idx + rule.target, old, new)
+        hits.append(PatchHit(base + idx + rule.target, rule.name, old, new))
+    return hits
+
+
+def patch_file(src: pathlib.Path, dst: pathlib.Path, rules: Sequence[PatchRule], base: int = 0,
+               byteorder: str = 'big', stats: metrics.Metrics = None) -> List[PatchHit]:
+    """ Apply the rules to a binary file, writing the patched file to `dst`. """
+    stats = stats or metrics.Metrics()
+    with stats.stage('read') as stage, words.map_file(src) as view:
+        data = bytearray(view)
+        stage.add(len(data))
+    with stats.stage('patch') as stage:
+        hits = apply_rules(data, rules, base, byteorder)
+        stage.add(len(data))
+    with stats.stage('write') as stage, open(dst, "wb") as output:
+        output.write(data)
+        stage.add(len(data))
+
+    for name, count in Counter(h.rule for h in hits).items():
+        logger.info("Rule %s patched %d words", name, count)
+    return hits
+
+
+def write_report(hits: Sequence[PatchHit], path: pathlib.Path):
+    """ Write one `address rule old new` line per patched word. """
+    with open(path, "w") as fp:
+        for hit in hits:
+            fp.write("%06x %s %06x %06x\n" % (hit.addr, hit.rule, hit.old, hit.new))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Patch DSP56k binary files using a rule file.")
+    parser.add_argument("rules", help="JSON rule file")
+    parser.add_argument("input", help="input binary")
+    parser.add_argument("output", help="output binary")
+    parser.add_argument("--report", help="write a patch report to this file")
+    parser.add_argument("--base", default="0", help="address of the first word (hex, default: 0)")
+    parser.add_argument("--little-endian", action="store_true", help="input contains little endian words")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    src = pathlib.Path(args.input)
+    if not src.exists():
+        logger.error("Input file %s does not exist!", src)
+        sys.exit(-1)
+
+    file_size = src.stat().st_size
+    if not words.is_aligned(file_size):
+        logger.error("Expected a multiple of 24-bit words, size=%d", file_size)
+        sys.exit(-1)
+
+    rules = load_rules(pathlib.Path(args.rules))
+    byteorder = 'little' if args.little_endian else 'big'
+    with metrics.session(args) as stats:
+        hits = patch_file(src, pathlib.Path(args.output), rules, int(args.base, 16), byteorder, stats)
+    if args.report:
+        write_report(hits, pathlib.Path(args.report))
+        logger.info("Wrote patch report to %s", args.report)
+
+    logger.info("Successfully wrote %s", args.output)
+
+
+if __name__ == "__main__":
+    main()
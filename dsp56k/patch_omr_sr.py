@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
+import argparse
 import logging
 import pathlib
 import sys
+from typing import List
+
+import metrics
+import patch
+import words
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 OMR_MASK = 0xffffff ^ 0x4000  # disable address priority
@@ -18,48 +23,51 @@ properly.
 
 Usage: python3 patch_omr_sr.py <binary_file> <output_file>
 
+Uses the rule based patch engine (`patch.py`) with the two rules
+below, `omr_sr.json` contains the same rules as a rule file.
 """
 
-if len(sys.argv) != 3:
-    logger.info("Usage: python3 %s <binary_file> <output_file>", sys.argv[0])
-    sys.exit(-1)
-
-# Make sure the input file exists
-src = pathlib.Path(sys.argv[1])
-if not src.exists():
-    logger.error("Input file %s does not exist!", src)
-    sys.exit(-1)
-
-file_size = src.stat().st_size
-if file_size % 3 != 0:
-    logger.error("Expected a multiple of 24-bit words, size=%d", file_size)
-    sys.exit(-1)
-
-# Instruction mapping
-OMR = b"\x05\xf4\x3a"  # move OP,omr
-SR = b"\x05\xf4\x39"   # move OP,sr
-
-file_path = pathlib.Path(sys.argv[2])
-with open(file_path, "wb") as output:
-    with open(src, "rb") as fp:
-        while fp.tell() < file_size:
-            word = fp.read(3)
-            if word == OMR:
-                # Patch OMR
-                operand = int.from_bytes(fp.read(3), 'big')
-                patch = operand & OMR_MASK
-                output.write(word)
-                output.write(patch.to_bytes(3, 'big'))
-                logger.info("Patched OMR from 0x%06x to 0x%06x", operand, patch)
-            elif word == SR:
-                # Patch SR
-                operand = int.from_bytes(fp.read(3), 'big')
-                patch = operand & SR_MASK
-                output.write(word)
-                output.write(patch.to_bytes(3, 'big'))
-                logger.info("Patched SR from 0x%06x to 0x%06x", operand, patch)
-            else:
-                # Nothing to do, just forward the input data
-                output.write(word)
-
-logger.info("Successfully wrote %s", file_path)
+# Instruction mapping, the operand is stored in the next word
+RULES = [
+    patch.PatchRule(name='OMR', pattern=[0x05f43a], mask=[0xffffff], target=1, and_mask=OMR_MASK),  # move OP,omr
+    patch.PatchRule(name='SR', pattern=[0x05f439], mask=[0xffffff], target=1, and_mask=SR_MASK),  # move OP,sr
+]
+
+
+def patch_omr_sr(src: pathlib.Path, dst: pathlib.Path, stats: metrics.Metrics = None) -> List[patch.PatchHit]:
+    """ Patch the OMR and SR instructions of a binary file, writing the patched file to `dst`. """
+    hits = patch.patch_file(src, dst, RULES, stats=stats)
+    for hit in hits:
+        logger.info("Patched %s from 0x%06x to 0x%06x", hit.rule, hit.old, hit.new)
+    return hits
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Patch the OMR and SR instructions for the simulator.")
+    parser.add_argument("input", help="input binary")
+    parser.add_argument("output", help="output binary")
+    metrics.add_arguments(parser)
+    args = parser.parse_args()
+
+    # Make sure the input file exists
+    src = pathlib.Path(args.input)
+    if not src.exists():
+        logger.error("Input file %s does not exist!", src)
+        sys.exit(-1)
+
+    file_size = src.stat().st_size
+    if not words.is_aligned(file_size):
+        logger.error("Expected a multiple of 24-bit words, size=%d", file_size)
+        sys.exit(-1)
+
+    file_path = pathlib.Path(args.output)
+    with metrics.session(args) as stats:
+        patch_omr_sr(src, file_path, stats)
+
+    logger.info("Successfully wrote %s", file_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+import argparse
+import array
+import hashlib
+import itertools
+import logging
+import pathlib
+import re
+import sqlite3
+import sys
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import metrics
+import words
+
+logger = logging.getLogger(__name__)
+
+"""
+On-disk index of word patterns over a corpus of DSP memory images.
+
+Usage:
+ python3 wordindex.py <index_file> add <path> ...
+ python3 wordindex.py <index_file> query "<pattern>" [--region p] [--limit N]
+ python3 wordindex.py <index_file> list
+ python3 wordindex.py <index_file> remove <firmware> ...
+
+`add` indexes region images (`<firmware>.<region>.be.bin`, as written by
+`dump_dsp_memory.py` and `extract_corpus.py`), or all region images in a
+directory. Other files are indexed with region "image". Images that are
+already indexed with the same contents are skipped, changed images are
+re-indexed; the rest of the index is left as is.
+
+A pattern is a list of words separated by spaces:
+
+ 05f43a          exact word (hex)
+ 05f4??          word with wildcard hex digits
+ 05f43a/ffff00   word with a mask, only the bits set in the mask have to match
+ *               any word, *3 any three words
+ *2-8            a gap of 2 to 8 words
+
+Each word position is indexed by the pair of words starting there (a
+48-bit key in an SQLite table). A query looks up the least frequent pair
+of exact words in the pattern (or a single word, exact or with wildcards in
+the low digits only), and matches the full pattern with
+`words.pattern_regex` at the candidate addresses only. Patterns without
+such words, or with only very frequent ones (like fill words), are matched
+against all images.
+
+Hits are printed as <firmware> <region> <address>.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    firmware TEXT NOT NULL,
+    region TEXT NOT NULL,
+    path TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    words INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    UNIQUE (firmware, region)
+);
+CREATE TABLE IF NOT EXISTS grams (
+    gram INTEGER NOT NULL,  -- word at addr << 24 | word at addr + 1 (0 after the last word)
+    image INTEGER NOT NULL,
+    addr INTEGER NOT NULL,
+    PRIMARY KEY (gram, image, addr)
+) WITHOUT ROWID;
+"""
+
+IMAGE_NAME = re.compile(r"^(?P<firmware>.+)\.(?P<region>[pxy])\.be\.bin$")
+GAP = re.compile(r"^\*(?P<min>\d+)?(?:-(?P<max>\d+))?$")
+CANDIDATE_LIMIT = 10000  # scan the images instead when all keys of a query occur more often than this
+
+
+@dataclass
+class Segment:
+    """ Words of a pattern at fixed offsets, preceded by a gap of min_gap to max_gap words. """
+    min_gap: int
+    max_gap: int
+    pattern: List[int]
+    mask: List[int]
+
+
+@dataclass(frozen=True)
+class Hit:
+    firmware: str
+    region: str
+    addr: int
+
+
+def parse_word(token: str) -> Tuple[int, int]:
+    """ Parse a word as hex value, optionally with ?-wildcard digits or a /mask. """
+    value, _, mask = token.partition('/')
+    if len(value) != 6 or (mask and len(mask) != 6):
+        raise ValueError("Expected 6 hex digits in %r" % token)
+    try:
+        if mask:
+            return int(value, 16), int(mask, 16)
+        digit_mask = ''.join('0' if c == '?' else 'f' for c in value)
+        return int(value.replace('?', '0'), 16), int(digit_mask, 16)
+    except ValueError:
+        raise ValueError("Invalid word %r" % token) from None
+
+
+def parse_query(text: str) -> List[Segment]:
+    segments = [Segment(0, 0, [], [])]
+    for token in text.split():
+        gap = GAP.match(token)
+        if not gap:
+            value, mask = parse_word(token)
+            segments[-1].pattern.append(value)
+            segments[-1].mask.append(mask)
+            continue
+        if not segments[-1].pattern:
+            raise ValueError("A pattern should start and end with a word")
+        low = int(gap['min'] or 1)
+        high = int(gap['max'] or low)
+        if high < low:
+            raise ValueError("Invalid gap %r" % token)
+        if low == high:  # a fixed gap is matched by words with an empty mask
+            segments[-1].pattern.extend([0] * low)
+            segments[-1].mask.extend([0] * low)
+        else:
+            segments.append(Segment(low, high, [], []))
+    if not segments[-1].pattern:
+        raise ValueError("A pattern should start and end with a word")
+    return segments
+
+
+def query_regex(segments: Sequence[Segment], byteorder: str = 'big') -> bytes:
+    parts = []
+    for segment in segments:
+        if segment.max_gap:
+            parts.append(b'(?:.{%d}){%d,%d}' % (words.WORD_SIZE, segment.min_gap, segment.max_gap))
+        parts.append(words.pattern_regex(segment.pattern, segment.mask, byteorder))
+    return b''.join(parts)
+
+
+def iter_keys(segments: Sequence[Segment]) -> Iterator[Tuple[int, int, int, int]]:
+    """
+    Yield the index keys of a pattern as (low, high, min_offset, max_offset): the
+    range of keys to look up, and the offsets of the key from the start of a match.
+    """
+    min_offset = max_offset = 0
+    for segment in segments:
+        min_offset += segment.min_gap
+        max_offset += segment.max_gap
+        exact = [m == words.WORD_MASK for m in segment.mask]
+        for i, (value, mask) in enumerate(zip(segment.pattern, segment.mask)):
+            wildcard = ~mask & words.WORD_MASK
+            if exact[i] and i + 1 < len(segment.pattern) and exact[i + 1]:
+                key = value << 24 | segment.pattern[i + 1]
+                yield key, key, min_offset + i, max_offset + i
+            elif mask and wildcard & (wildcard + 1) == 0:
+                # Only the low bits are wildcards (e.g. 05f4??): the words of the match form a range of keys
+                low = value & mask
+                yield low << 24, (low | wildcard) << 24 | words.WORD_MASK, min_offset + i, max_offset + i
+        min_offset += len(segment.pattern)
+        max_offset += len(segment.pattern)
+
+
+def word_pairs(data: bytes) -> array.array:
+    """ The index key of every word position: the word and the next word as one 48-bit integer. """
+    count = len(data) // words.WORD_SIZE
+    padded = bytes(data) + bytes(words.WORD_SIZE)
+    buf = bytearray(count * 8)  # big endian 64-bit integers
+    for k in range(2 * words.WORD_SIZE):
+        buf[2 + k::8] = padded[k:k + count * words.WORD_SIZE:words.WORD_SIZE]
+    keys = array.array('Q', buf)
+    if sys.byteorder == 'little':
+        keys.byteswap()
+    return keys
+
+
+def image_name(path: pathlib.Path) -> Tuple[str, str]:
+    """ Firmware and region of an image file. """
+    match = IMAGE_NAME.match(path.name)
+    return (match['firmware'], match['region']) if match else (path.stem, 'image')
+
+
+class WordIndex:
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.execute("PRAGMA synchronous = NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add_image(self, firmware: str, region: str, data: bytes, path: str = "",
+                  stats: metrics.Metrics = None) -> bool:
+        """ Index an image, replacing an earlier version. Returns False when it is indexed already. """
+        stats = stats or metrics.Metrics()
+        if not words.is_aligned(len(data)):
+            raise ValueError("Expected a multiple of 24-bit words in %s" % (path or firmware))
+        digest = hashlib.sha256(data).hexdigest()
+        row = self.db.execute("SELECT id, sha256 FROM images WHERE firmware = ? AND region = ?",
+                              (firmware, region)).fetchone()
+        if row and row[1] == digest:
+            return False
+
+        with stats.stage('index') as stage, self.db:
+            if row:
+                self.db.execute("DELETE FROM grams WHERE image = ?", (row[0],))
+                self.db.execute("DELETE FROM images WHERE id = ?", (row[0],))
+            image_id = self.db.execute(
+                "INSERT INTO images (firmware, region, path, sha256, words, data) VALUES (?, ?, ?, ?, ?, ?)",
+                (firmware, region, path, digest, len(data) // words.WORD_SIZE, data)).lastrowid
+            # Insert in key order, which is much faster than random inserts into the key index
+            keys = word_pairs(data)
+            self.db.executemany("INSERT INTO grams VALUES (?, ?, ?)",
+                                sorted(zip(keys, itertools.repeat(image_id), range(len(keys)))))
+            stage.add(len(data))
+        return True
+
+    def add_file(self, path: pathlib.Path, stats: metrics.Metrics = None) -> bool:
+        firmware, region = image_name(path)
+        with words.map_file(path) as view:
+            return self.add_image(firmware, region, bytes(view), str(path), stats)
+
+    def remove(self, firmware: str) -> int:
+        with self.db:
+            ids = [row[0] for row in self.db.execute("SELECT id FROM images WHERE firmware = ?", (firmware,))]
+            for image_id in ids:
+                self.db.execute("DELETE FROM grams WHERE image = ?", (image_id,))
+                self.db.execute("DELETE FROM images WHERE id = ?", (image_id,))
+        return len(ids)
+
+    def images(self) -> List[Tuple[str, str, int, str]]:
+        return self.db.execute("SELECT firmware, region, words, path FROM images ORDER BY firmware, region").fetchall()
+
+    def _count(self, low: int, high: int) -> int:
+        return self.db.execute("SELECT count(*) FROM (SELECT 1 FROM grams WHERE gram BETWEEN ? AND ? LIMIT ?)",
+                               (low, high, CANDIDATE_LIMIT)).fetchone()[0]
+
+    def query(self, text: str, regions: Sequence[str] = None, stats: metrics.Metrics = None) -> List[Hit]:
+        """ Find all word-aligned matches of a pattern, in firmware, region and address order. """
+        stats = stats or metrics.Metrics()
+        segments = parse_query(text)
+        regex = re.compile(query_regex(segments), re.DOTALL)
+        keys = sorted((self._count(low, high), low, high, min_offset, max_offset)
+                      for low, high, min_offset, max_offset in iter_keys(segments))
+
+        images: Dict[int, Tuple[str, str, bytes]] = {}
+
+        def image(image_id: int) -> Optional[Tuple[str, str, bytes]]:
+            if image_id not in images:
+                images[image_id] = self.db.execute("SELECT firmware, region, data FROM images WHERE id = ?",
+                                                   (image_id,)).fetchone()
+            return images[image_id]
+
+        hits = set()
+        with stats.stage('query') as stage:
+            if keys and keys[0][0] < CANDIDATE_LIMIT:
+                _, low, high, min_offset, max_offset = keys[0]
+                for image_id, addr in self.db.execute("SELECT image, addr FROM grams WHERE gram BETWEEN ? AND ?",
+                                                      (low, high)):
+                    firmware, region, data = image(image_id)
+                    if regions and region not in regions:
+                        continue
+                    for start in range(max(0, addr - max_offset), addr - min_offset + 1):
+                        if regex.match(data, start * words.WORD_SIZE):
+                            hits.add(Hit(firmware, region, start))
+                    stage.add(0, 1)
+            else:
+                # Nothing to look up, or too many candidates: match against every image
+                scan = re.compile(b'(?=' + regex.pattern + b')', re.DOTALL)
+                for image_id, in self.db.execute("SELECT id FROM images").fetchall():
+                    firmware, region, data = image(image_id)
+                    if regions and region not in regions:
+                        continue
+                    for match in scan.finditer(data):
+                        if match.start() % words.WORD_SIZE == 0:
+                            hits.add(Hit(firmware, region, match.start() // words.WORD_SIZE))
+                    stage.add(len(data))
+        return sorted(hits, key=lambda h: (h.firmware, h.region, h.addr))
+
+
+def find_images(paths: Sequence[str]) -> List[pathlib.Path]:
+    """ Expand directories to the region images they contain. """
+    files = []
+    for path in map(pathlib.Path, paths):
+        if path.is_dir():
+            files.extend(sorted(p for p in path.iterdir() if IMAGE_NAME.match(p.name)))
+        else:
+            files.append(path)
+    return files
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Index DSP memory images and search them for word patterns.")
+    parser.add_argument("index", help="index file (SQLite), created if missing")
+    instrumentation = argparse.ArgumentParser(add_help=False)
+    metrics.add_arguments(instrumentation)
+    commands = parser.add_subparsers(dest="command", required=True)
+    add = commands.add_parser("add", parents=[instrumentation],
+                              help="index region images, or directories of region images")
+    add.add_argument("paths", nargs="+")
+    query = commands.add_parser("query", parents=[instrumentation], help="search for a word pattern")
+    query.add_argument("pattern", help='e.g. "05f43a *1-4 0afa??"')
+    query.add_argument("--region", nargs="+", help="only search these regions")
+    query.add_argument("--limit", type=int, help="print at most this many hits")
+    commands.add_parser("list", parents=[instrumentation], help="list the indexed images")
+    remove = commands.add_parser("remove", parents=[instrumentation], help="remove all images of a firmware")
+    remove.add_argument("firmware", nargs="+")
+    args = parser.parse_args()
+
+    try:
+        with metrics.session(args) as stats, WordIndex(args.index) as index:
+            if args.command == "add":
+                for path in find_images(args.paths):
+                    if index.add_file(path, stats):
+                        logger.info("Indexed %s", path)
+                    else:
+                        logger.info("Skipped %s, already indexed", path)
+            elif args.command == "query":
+                hits = index.query(args.pattern, args.region, stats)
+                for hit in hits[:args.limit]:
+                    print("%s %s 0x%06x" % (hit.firmware, hit.region, hit.addr))
+                logger.info("%d hits", len(hits))
+            elif args.command == "list":
+                for firmware, region, word_count, path in index.images():
+                    print("%s %s %d words %s" % (firmware, region, word_count, path))
+            else:
+                for firmware in args.firmware:
+                    logger.info("Removed %d images of %s", index.remove(firmware), firmware)
+    except (ValueError, OSError) as e:
+        logger.error("%s", e)
+        sys.exit(-1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+Codec for buffers of 24-bit DSP563xx words.
+
+All functions operate on whole buffers at once (using extended slice
+assignment, which runs in C) instead of converting one word at a time.
+Words are decoded into an `array('I')` of native 32-bit integers.
+"""
+import array
+import bisect
+import contextlib
+import mmap
+import pathlib
+import re
+import sys
+from typing import Iterable, Iterator, List, Optional, Sequence, Union
+
+WORD_SIZE = 3  # bytes per 24-bit word
+WORD_MASK = 0xFFFFFF
+
+DEFAULT_CHUNK_SIZE = WORD_SIZE << 20  # 3MB, always a multiple of WORD_SIZE
+
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+
+assert array.array('I').itemsize == 4, "Expected 32-bit unsigned int arrays"
+
+
+def _positions(byteorder: str):
+    """ Map each byte of a 24-bit word to its position in a native 32-bit integer. """
+    if byteorder not in ('big', 'little'):
+        raise ValueError("byteorder must be either 'big' or 'little'")
+    for k in range(WORD_SIZE):
+        significance = WORD_SIZE - 1 - k if byteorder == 'big' else k
+        yield k, significance if sys.byteorder == 'little' else 3 - significance
+
+
+def is_aligned(size: int) -> bool:
+    """ Check whether a buffer or file size is a multiple of 24-bit words. """
+    return size % WORD_SIZE == 0
+
+
+def _view(data: Buffer) -> memoryview:
+    view = memoryview(data).cast('B')
+    if not is_aligned(len(view)):
+        raise ValueError("Expected a multiple of 24-bit words, size=%d" % len(view))
+    return view
+
+
+def decode(data: Buffer, byteorder: str = 'big') -> array.array:
+    """ Decode a buffer of 24-bit words into an array of integers. """
+    view = _view(data)
+    buf = bytearray(len(view) // WORD_SIZE * 4)
+    for k, pos in _positions(byteorder):
+        buf[pos::4] = view[k::WORD_SIZE]
+    return array.array('I', buf)
+
+
+def encode(words: Iterable[int], byteorder: str = 'big') -> bytes:
+    """ Encode integers into a buffer of 24-bit words, bits above 24 are dropped. """
+    if isinstance(words, WordBuffer):
+        return words.tobytes(byteorder)
+    if not isinstance(words, array.array) or words.typecode != 'I':
+        words = array.array('I', words)
+    buf = memoryview(words).cast('B')
+    out = bytearray(len(words) * WORD_SIZE)
+    for k, pos in _positions(byteorder):
+        out[k::WORD_SIZE] = buf[pos::4]
+    return bytes(out)
+
+
+def format_hex(data: Buffer, sep: str = ' ') -> str:
+    """ Format a buffer of 24-bit words as 6-digit hex values separated by `sep`. """
+    text = _view(data).hex(' ', WORD_SIZE)
+    return text if sep == ' ' else text.replace(' ', sep)
+
+
+def _byte_regex(value: int, mask: int) -> bytes:
+    if mask == 0xFF:
+        return re.escape(bytes([value]))
+    if mask == 0:
+        return b'.'
+    matches = bytes(b for b in range(256) if b & mask == value & mask)
+    return b'[' + b''.join(re.escape(bytes([b])) for b in matches) + b']'
+
+
+def pattern_regex(pattern: Sequence[int], mask: Optional[Sequence[int]] = None, byteorder: str = 'big') -> bytes:
+    """
+    Build a regular expression (for use with re.DOTALL) matching a sequence of masked words.
+
+    Only the bits set in the mask of a word have to match, a mask of zero matches any word.
+    """
+    mask = mask or [WORD_MASK] * len(pattern)
+    parts = []
+    for value, word_mask in zip(pattern, mask):
+        value_bytes = value.to_bytes(WORD_SIZE, byteorder)
+        mask_bytes = word_mask.to_bytes(WORD_SIZE, byteorder)
+        parts.extend(_byte_regex(v, m) for v, m in zip(value_bytes, mask_bytes))
+    return b''.join(parts)
+
+
+def swap(data: Buffer) -> bytearray:
+    """ Swap the byte order of each 24-bit word, returning a new buffer. """
+    view = _view(data)
+    out = bytearray(len(view))
+    out[0::WORD_SIZE] = view[2::WORD_SIZE]
+    out[1::WORD_SIZE] = view[1::WORD_SIZE]
+    out[2::WORD_SIZE] = view[0::WORD_SIZE]
+    return out
+
+
+def swap_inplace(data: Buffer):
+    """ Swap the byte order of each 24-bit word in a writable buffer. """
+    view = _view(data)
+    high = bytes(view[0::WORD_SIZE])
+    view[0::WORD_SIZE] = view[2::WORD_SIZE]
+    view[2::WORD_SIZE] = high
+
+
+def _file_size(fp) -> int:
+    size = pathlib.Path(fp.name).stat().st_size
+    if not is_aligned(size):
+        raise ValueError("Expected a multiple of 24-bit words, size=%d" % size)
+    return size
+
+
+def swap_file(src: pathlib.Path, dst: pathlib.Path, chunk_size: int = DEFAULT_CHUNK_SIZE):
+    """
+    Swap the byte order of all 24-bit words in a file, chunk by chunk.
+
+    When `src` and `dst` refer to the same file, the words are swapped
+    in place using a writable memory map.
+    """
+    if not is_aligned(chunk_size):
+        raise ValueError("Chunk size must be a multiple of 24-bit words")
+
+    src, dst = pathlib.Path(src), pathlib.Path(dst)
+    if dst.exists() and src.samefile(dst):
+        with open(src, "r+b") as fp:
+            size = _file_size(fp)
+            if not size:
+                return
+            with mmap.mmap(fp.fileno(), 0) as mm, memoryview(mm) as view:
+                for offset in range(0, size, chunk_size):
+                    swap_inplace(view[offset:offset + chunk_size])
+        return
+
+    with open(src, "rb") as fp, open(dst, "wb") as output:
+        _file_size(fp)
+        while chunk := fp.read(chunk_size):
+            output.write(swap(chunk))
+
+
+@contextlib.contextmanager
+def map_file(path: pathlib.Path) -> Iterator[Buffer]:
+    """
+    Memory-map a file of 24-bit words read-only.
+
+    Slicing the map returns a copy of the requested range only, so large
+    files can be processed chunk by chunk.
+    """
+    with open(path, "rb") as fp:
+        if not _file_size(fp):
+            yield b''
+            return
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield mm
+
+
+def read_words(path: pathlib.Path, byteorder: str = 'big') -> array.array:
+    """ Read and decode all 24-bit words of a file. """
+    with map_file(path) as view:
+        return decode(view, byteorder)
+
+
+def map_words(path: pathlib.Path, byteorder: str = 'big') -> 'WordBuffer':
+    """
+    Memory-map a file of 24-bit words as a WordBuffer.
+
+    The map stays open for as long as the buffer (or a slice of it) is referenced.
+    """
+    with open(path, "rb") as fp:
+        if not _file_size(fp):
+            return WordBuffer(byteorder=byteorder)
+        return WordBuffer([mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)], byteorder)
+
+
+def find_word(data: Buffer, word: int, byteorder: str = 'big', start: int = 0) -> Iterator[int]:
+    """ Yield the index of every word-aligned occurrence of `word`, starting at word index `start`. """
+    needle = word.to_bytes(WORD_SIZE, byteorder)
+    haystack = data if isinstance(data, (bytes, bytearray, mmap.mmap)) else bytes(data)
+    pos = haystack.find(needle, start * WORD_SIZE)
+    while pos != -1:
+        if pos % WORD_SIZE == 0:
+            yield pos // WORD_SIZE
+            pos = haystack.find(needle, pos + WORD_SIZE)
+        else:
+            pos = haystack.find(needle, pos + 1)
+
+
+class WordBuffer(Sequence[int]):
+    """
+    Read-only sequence of 24-bit words backed by one or more byte buffers.
+
+    The buffers are referenced, not copied: slicing returns another
+    WordBuffer over views of the same memory (e.g. an mmap of a flash
+    image), and words are only decoded when they are accessed.
+    """
+
+    def __init__(self, segments: Iterable[Buffer] = (), byteorder: str = 'big'):
+        self.byteorder = byteorder
+        self._segments: List[memoryview] = []
+        self._starts: List[int] = []  # word index at which each segment starts
+        self._length = 0
+        for segment in segments:
+            view = _view(segment)
+            if view:
+                self._segments.append(view)
+                self._starts.append(self._length)
+                self._length += len(view) // WORD_SIZE
+
+    @property
+    def segments(self) -> List[memoryview]:
+        """ The underlying byte views, in order. """
+        return list(self._segments)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __repr__(self) -> str:
+        return "WordBuffer(words=%d, segments=%d)" % (self._length, len(self._segments))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._length)
+            if step != 1:
+                raise ValueError("WordBuffer slices do not support a step")
+            return WordBuffer(self._slice_views(start, stop), self.byteorder)
+
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError("word index out of range")
+        seg = bisect.bisect_right(self._starts, index) - 1
+        pos = (index - self._starts[seg]) * WORD_SIZE
+        return int.from_bytes(self._segments[seg][pos:pos + WORD_SIZE], self.byteorder)
+
+    def _slice_views(self, start: int, stop: int) -> Iterator[memoryview]:
+        if start >= stop:
+            return
+        seg = bisect.bisect_right(self._starts, start) - 1
+        while seg < len(self._segments) and self._starts[seg] < stop:
+            first = self._starts[seg]
+            view = self._segments[seg]
+            lo = max(start - first, 0) * WORD_SIZE
+            hi = min(stop - first, len(view) // WORD_SIZE) * WORD_SIZE
+            yield view[lo:hi]
+            seg += 1
+
+    def __iter__(self) -> Iterator[int]:
+        for view in self._segments:
+            yield from decode(view, self.byteorder)
+
+    def tobytes(self, byteorder: Optional[str] = None) -> bytes:
+        """ Concatenate all words into a single buffer, in the requested byte order. """
+        data = b''.join(self._segments)
+        if byteorder and byteorder != self.byteorder:
+            return bytes(swap(data))
+        return data
+
+    def toarray(self) -> array.array:
+        """ Decode all words into an array of integers. """
+        return decode(self.tobytes(), self.byteorder)
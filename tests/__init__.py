@@ -0,0 +1,13 @@
+"""
+Tests for the DSP56k and Access Virus tools.
+
+Run with `python3 -m unittest` (or `python3 -m pytest`) from the root of the
+repository. The tool folders are not packages, they are put on the path
+here, like the Access Virus tools do for `dsp56k` in `lib`.
+"""
+import pathlib
+import sys
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+for folder in ("dsp56k", "access_virus", "access_virus/virus_ti"):
+    sys.path.append(str(ROOT / folder))
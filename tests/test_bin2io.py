@@ -0,0 +1,72 @@
+import io
+import pathlib
+import random
+import tempfile
+import unittest
+
+import bin2io
+import words
+
+
+def naive_lines(values, repeat: int = 1, rle: bool = True) -> bytes:
+    """ One line per word, or per run of at least two equal words. """
+    lines = []
+    i = 0
+    while i < len(values):
+        end = i + 1
+        while rle and end < len(values) and values[end] == values[i]:
+            end += 1
+        count = (end - i) * repeat
+        if end - i > 1:
+            lines.append(b"$%06x#%d\n" % (values[i], count))
+        else:
+            lines.append(b"$%06x%s\n" % (values[i], b"#%d" % repeat if repeat > 1 else b""))
+        i = end
+    return b''.join(lines)
+
+
+class Bin2IOTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.values = []
+        while len(self.values) < 2000:
+            # Random words with runs of equal words, including zero words
+            value = rng.choice([0, 0xffffff, rng.getrandbits(24)])
+            self.values.extend([value] * rng.choice([1, 1, 2, 3, 50]))
+        self.data = words.encode(self.values)
+
+    def convert(self, repeat: int = 1, rle: bool = True) -> bytes:
+        with tempfile.TemporaryDirectory() as tmp:
+            src = pathlib.Path(tmp) / "input.bin"
+            src.write_bytes(self.data)
+            output = io.BytesIO()
+            bin2io.bin2io(src, output, repeat, rle)
+            return output.getvalue()
+
+    def test_rle(self):
+        for repeat in (1, 3):
+            self.assertEqual(self.convert(repeat), naive_lines(self.values, repeat))
+
+    def test_no_rle(self):
+        for repeat in (1, 3):
+            output = self.convert(repeat, rle=False)
+            self.assertEqual(output, naive_lines(self.values, repeat, rle=False))
+            self.assertEqual(output.count(b"\n"), len(self.values))
+
+    def test_runs_across_chunks(self):
+        chunk_words = bin2io.CHUNK_WORDS
+        bin2io.CHUNK_WORDS = 7
+        try:
+            self.assertEqual(self.convert(), naive_lines(self.values))
+        finally:
+            bin2io.CHUNK_WORDS = chunk_words
+
+    def test_runs(self):
+        data = words.encode([1, 1, 2, 3, 3, 3, 4])
+        self.assertEqual(list(bin2io.iter_runs(data)), [(0, 2), (3, 6)])
+        self.assertEqual(list(bin2io.iter_runs(words.encode([5]))), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import pathlib
+import random
+import tempfile
+import unittest
+
+import container
+import words
+
+
+class ContainerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.work = pathlib.Path(self.tmp.name)
+        rng = random.Random(0)
+        gap = bytes(container.DEFAULT_MIN_GAP * 2 * words.WORD_SIZE)
+        self.images = {
+            'p': rng.randbytes(300) + gap + rng.randbytes(600) + bytes(30),  # ends with zero words
+            'x': gap + rng.randbytes(99),
+            'bootrom': rng.randbytes(30),
+        }
+        for region, data in self.images.items():
+            (self.work / ("input.%s.be.bin" % region)).write_bytes(data)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_roundtrip(self):
+        path = self.work / "output.dspc"
+        segments = container.pack(str(self.work / "input"), str(path))
+        self.assertEqual([(s.region, s.start) for s in segments],
+                         [('p', 0), ('p', 100 + container.DEFAULT_MIN_GAP * 2), ('x', container.DEFAULT_MIN_GAP * 2),
+                          ('bootrom', 0)])
+
+        written = container.unpack(str(path), str(self.work / "output"), ('big', 'little'))
+        self.assertEqual(len(written), 6)
+        for region, data in self.images.items():
+            self.assertEqual((self.work / ("output.%s.be.bin" % region)).read_bytes(), data)
+            self.assertEqual((self.work / ("output.%s.le.bin" % region)).read_bytes(), bytes(words.swap(data)))
+
+    def test_read(self):
+        path = self.work / "output.dspc"
+        container.pack(str(self.work / "input"), str(path))
+        with container.Container(path) as dspc:
+            self.assertEqual(dspc.regions, ['p', 'x', 'bootrom'])
+            self.assertEqual(dspc.verify(), [])
+            image = self.images['p']
+            size = len(image) // words.WORD_SIZE
+            for addr, count in ((0, size), (50, 200), (90, 100), (size - 5, 10)):
+                data = dspc.read('p', addr, count)
+                expected = image[addr * words.WORD_SIZE:(addr + count) * words.WORD_SIZE]
+                self.assertEqual(data.tobytes(), expected + bytes(count * words.WORD_SIZE - len(expected)))
+                del data  # release the views on the container
+
+    def test_byteorder(self):
+        path = self.work / "output.dspc"
+        with open(path, "wb") as fp:
+            container.write_container(fp, [('p', 4, self.images['bootrom'])], 'little')
+        with container.Container(path) as dspc:
+            self.assertEqual(dspc.segments[0].byteorder, 'little')
+            self.assertEqual(dspc.read('p', 4, 2).tobytes('big'), self.images['bootrom'][:6])
+            dspc.tofile('p', str(self.work / "output.p.be.bin"))
+        self.assertEqual((self.work / "output.p.be.bin").read_bytes(), bytes(12) + self.images['bootrom'])
+
+    def test_invalid(self):
+        path = self.work / "invalid.dspc"
+        path.write_bytes(b"NOPE" + bytes(16))
+        with self.assertRaises(ValueError):
+            container.Container(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+import pathlib
+import random
+import tempfile
+import unittest
+
+import bin2lod
+import lod2bin
+import words
+
+
+class LodRoundtripTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.work = pathlib.Path(self.tmp.name)
+        rng = random.Random(0)
+        # Random words with runs of zero words of different lengths, ending with a non-zero word
+        parts = []
+        for _ in range(50):
+            parts.append(rng.randbytes(rng.randint(1, 300) * words.WORD_SIZE))
+            parts.append(bytes(rng.choice([1, 10, 100, 1000]) * words.WORD_SIZE))
+        parts.append(b'\x00\x00\x01')
+        self.data = b''.join(parts)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name: str, data: bytes) -> pathlib.Path:
+        path = self.work / name
+        path.write_bytes(data)
+        return path
+
+    def test_roundtrip(self):
+        src = self.write("input.bin", self.data)
+        for min_zero_run in (0, 1, bin2lod.DEFAULT_MIN_ZERO_RUN):
+            lod = self.work / ("output_%d.lod" % min_zero_run)
+            bin2lod.bin2lod([('P', 0, src)], lod, min_zero_run)
+            lod2bin.lod2bin(lod, str(self.work / ("roundtrip_%d" % min_zero_run)))
+            self.assertEqual((self.work / ("roundtrip_%d.P.bin" % min_zero_run)).read_bytes(), self.data)
+
+    def test_regions_and_offsets(self):
+        x = self.write("x.bin", self.data[:300])
+        y = self.write("y.bin", self.data[300:900])
+        lod = self.work / "output.lod"
+        bin2lod.bin2lod([('X', 0x100, x), ('Y', 0, y)], lod, entry=0x40)
+        self.assertTrue(lod.read_bytes().endswith(b'_END 000040\n'))
+
+        lod2bin.lod2bin(lod, str(self.work / "roundtrip"))
+        self.assertEqual((self.work / "roundtrip.X.bin").read_bytes(), bytes(0x100 * words.WORD_SIZE) + x.read_bytes())
+        self.assertEqual((self.work / "roundtrip.Y.bin").read_bytes(), y.read_bytes())
+
+    def test_lod2bin_records(self):
+        lod = self.work / "input.lod"
+        lod.write_bytes(b"_START TEST 0000 0000 0000\n\n"
+                        b"_DATA P 0002\n123456 0000ab\nff\n"
+                        b"_BLOCKDATA P 0005 0002 00000c\n"
+                        b"_SYMBOL P\nstart I 000002\n"
+                        b"_END 0002\n")
+        symbols = lod2bin.lod2bin(lod, str(self.work / "output"))
+        self.assertEqual(list(words.decode((self.work / "output.P.bin").read_bytes())),
+                         [0, 0, 0x123456, 0xab, 0xff, 0xc, 0xc])
+        self.assertEqual([(s.region, s.name) for s in symbols], [('P', 'start')])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import random
+import unittest
+from typing import Dict, Iterable
+
+import lib
+import memory
+import synth_flash
+import words
+
+
+def naive_replay(commands: Iterable[lib.DSPCommandData]) -> Dict[str, Dict[int, int]]:
+    """ The words written to each region, one word at a time. """
+    regions = {region: {} for region in memory.REGIONS}
+    for command in commands:
+        if command.region is None:
+            continue
+        values = list(command.data)
+        if command.cmd == 3:
+            values = [w for value in values for w in ((value >> 12) << 12, (value & 0xFFF) << 12)]
+        for i, value in enumerate(values):
+            regions[command.region][command.addr + i] = value
+    return regions
+
+
+def image_words(image: memory.DSPMemoryImage) -> Dict[str, Dict[int, int]]:
+    return {name: {segment.start + i: value
+                   for segment in region for i, value in enumerate(words.decode(segment.data))}
+            for name, region in image.regions.items()}
+
+
+class ReplayTest(unittest.TestCase):
+
+    def test_overlapping_commands(self):
+        data = words.decode(random.Random(0).randbytes(10 * words.WORD_SIZE))
+        commands = [
+            lib.DSPCommandData(0, 0x10, 6, data[0:6]),
+            lib.DSPCommandData(0, 0x12, 2, data[6:8]),  # inside the first one
+            lib.DSPCommandData(0, 0x0e, 3, data[8:10] + data[0:1]),  # over its start
+            lib.DSPCommandData(3, 0x14, 1, data[1:2]),  # command 3 writes two words
+            lib.DSPCommandData(3, 0x15, 1, data[2:3]),
+            lib.DSPCommandData(1, 0x10, 1, data[3:4]),  # other region, same address
+            lib.DSPCommandData(lib.CMD_JUMP, 0x100, 0, None),
+        ]
+        image = memory.DSPMemoryImage().replay(commands)
+        self.assertEqual(image_words(image), naive_replay(commands))
+        self.assertEqual(image.entrypoint, 0x100)
+        self.assertEqual(image.regions['p'].read(0x0e, 8), words.encode(
+            list(data[8:10]) + [data[0], data[1], data[6], data[7], data[4], data[5]]))
+
+    def test_synthetic_streams(self):
+        for seed in range(5):
+            spec = synth_flash.FlashSpec(commands=100, overlap=0.5, max_size=0x40, spread=0x20, seed=seed)
+            commands = synth_flash.generate_commands(spec, random.Random(seed))
+            stream = words.WordBuffer([lib.encode_dsp_commands(commands)])
+            parsed = list(lib.iter_dsp_commands(stream))
+            self.assertEqual([(c.cmd, c.addr, c.size) for c in parsed],
+                             [(c.cmd, c.addr, c.size) for c in commands])
+
+            image = memory.DSPMemoryImage().replay(parsed)
+            self.assertEqual(image_words(image), naive_replay(commands), seed)
+            self.assertTrue(image.overlaps)
+
+    def test_split_12bit(self):
+        data = random.Random(0).randbytes(100 * words.WORD_SIZE)
+        split = memory.split_12bit(data)
+        self.assertEqual(list(words.decode(split)),
+                         [w for value in words.decode(data) for w in ((value >> 12) << 12, (value & 0xFFF) << 12)])
+        self.assertEqual(memory.join_12bit(split), data)
+        self.assertIsNone(memory.join_12bit(words.encode([0x000001, 0])))
+
+
+class FlashTest(unittest.TestCase):
+
+    def test_bank_data_roundtrip(self):
+        for model_type in lib.AccessVirusType:
+            spec = synth_flash.FlashSpec(model_type=model_type, commands=200, overlap=0.1)
+            stream = synth_flash.generate_stream(spec)
+            flash = synth_flash.generate_flash(spec)
+            self.assertEqual(len(flash), model_type.value.size)
+            self.assertEqual(lib.find_dsp_banks(flash), (model_type, model_type.value.dsp_offset))
+
+            bank_data = lib.get_dsp_bank_data(flash, model_type)
+            self.assertEqual(bank_data.version, spec.version)
+            self.assertEqual(bank_data.data.tobytes(), stream)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import pathlib
+import random
+import tempfile
+import unittest
+from typing import Dict
+
+import lib
+import memory
+import repack
+import synth_flash
+import words
+
+
+def read_images(flash: bytes) -> Dict[str, bytes]:
+    """ The P, X and Y images the command stream of a flash image writes. """
+    model_type, dsp_offset = lib.find_dsp_banks(flash)
+    chunk_data = lib.get_dsp_chunk_data(lib.get_dsp_bank_data(flash, model_type, dsp_offset))
+    image = memory.DSPMemoryImage().replay(lib.iter_dsp_commands(chunk_data.data))
+    return {name: region.read(0, region.size) for name, region in image.regions.items()}
+
+
+class RepackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.work = pathlib.Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def original(self, model_type: lib.AccessVirusType) -> pathlib.Path:
+        path = self.work / ("%s.bin" % model_type.name)
+        spec = synth_flash.FlashSpec(model_type=model_type, commands=100, overlap=0.1)
+        path.write_bytes(synth_flash.generate_flash(spec))
+        return path
+
+    def test_unmodified(self):
+        for model_type in lib.AccessVirusType:
+            original = self.original(model_type)
+            output = self.work / "output.bin"
+            changed = repack.repack(original, output, read_images(original.read_bytes()))
+            self.assertEqual(changed, [])
+            self.assertEqual(output.read_bytes(), original.read_bytes())
+
+    def test_modified(self):
+        original = self.original(lib.AccessVirusType.TI)
+        images = read_images(original.read_bytes())
+        p = bytearray(images['p'])
+        p[0x200 * words.WORD_SIZE:0x201 * words.WORD_SIZE] = b'\x12\x34\x56'
+        images['p'] = bytes(p)
+
+        output = self.work / "output.bin"
+        changed = repack.repack(original, output, images)
+        self.assertEqual(len(changed), 1)
+        self.assertEqual(read_images(output.read_bytes()), images)
+
+        # Repacking again does not write anything
+        self.assertEqual(repack.repack(original, output, images), [])
+
+        # Neither does the command stream of the repacked image
+        flash = output.read_bytes()
+        model_type, dsp_offset = lib.find_dsp_banks(flash)
+        chunk_data = lib.get_dsp_chunk_data(lib.get_dsp_bank_data(flash, model_type, dsp_offset))
+        self.assertEqual(repack.repack(original, output, stream=chunk_data.data.tobytes()), [])
+
+    def test_grown(self):
+        for model_type in lib.AccessVirusType:
+            original = self.original(model_type)
+            images = read_images(original.read_bytes())
+            # Words that no command wrote before, more than fit in the original dsp banks
+            images['x'] += bytes(0x1000 * words.WORD_SIZE) + random.Random(0).randbytes(
+                2 * lib.BANK_WORDS * words.WORD_SIZE)
+
+            output = self.work / ("%s.output.bin" % model_type.name)
+            with self.assertRaises(ValueError):
+                repack.repack(original, output, images)
+            self.assertFalse(output.exists())
+
+            if model_type == lib.AccessVirusType.LEGACY:
+                # The banks after the dsp banks hold the flash routines and the presets
+                with self.assertRaises(ValueError):
+                    repack.repack(original, output, images, allow_grow=True)
+                continue
+            changed = repack.repack(original, output, images, allow_grow=True)
+            self.assertEqual(read_images(output.read_bytes()), images)
+            last_bank = list(lib.iter_dsp_banks(original.read_bytes(), model_type))[-1][0] // lib.BANK_SIZE
+            self.assertGreater(max(changed), last_bank)
+
+    def test_read_words(self):
+        image = words.encode([1, 2, 3])
+        self.assertEqual(repack.read_words(image, 1, 5), words.encode([2, 3, 0, 0]))
+
+    def test_intervals(self):
+        intervals = repack.Intervals()
+        intervals.add(10, 20)
+        intervals.add(30, 40)
+        self.assertEqual(list(intervals.gaps(0, 50)), [(0, 10), (20, 30), (40, 50)])
+        intervals.add(15, 35)
+        self.assertEqual(list(intervals.gaps(0, 50)), [(0, 10), (40, 50)])
+        self.assertEqual(list(intervals.gaps(12, 38)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
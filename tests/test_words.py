@@ -0,0 +1,91 @@
+import random
+import unittest
+
+import words
+
+
+def random_words(rng: random.Random, count: int) -> bytes:
+    return rng.randbytes(count * words.WORD_SIZE)
+
+
+class CodecTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(0)
+
+    def test_roundtrip(self):
+        for count in (0, 1, 2, 1000):
+            data = random_words(self.rng, count)
+            for byteorder in ('big', 'little'):
+                values = words.decode(data, byteorder)
+                self.assertEqual(len(values), count)
+                self.assertEqual(words.encode(values, byteorder), data)
+
+    def test_decode(self):
+        self.assertEqual(list(words.decode(b'\x12\x34\x56\xff\x00\x01')), [0x123456, 0xff0001])
+        self.assertEqual(list(words.decode(b'\x12\x34\x56', 'little')), [0x563412])
+
+    def test_encode_drops_high_bits(self):
+        self.assertEqual(words.encode([0x1123456]), b'\x12\x34\x56')
+
+    def test_unaligned(self):
+        with self.assertRaises(ValueError):
+            words.decode(b'\x00' * 4)
+
+    def test_swap(self):
+        data = random_words(self.rng, 1000)
+        swapped = words.swap(data)
+        self.assertEqual(bytes(swapped), words.encode(words.decode(data), 'little'))
+        self.assertEqual(bytes(words.swap(swapped)), data)
+
+        inplace = bytearray(data)
+        words.swap_inplace(inplace)
+        self.assertEqual(inplace, swapped)
+
+
+class WordBufferTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        # Segments of different sizes, including an empty one
+        self.segments = [random_words(rng, count) for count in (5, 0, 1, 17, 3)]
+        self.values = [w for segment in self.segments for w in words.decode(segment)]
+        self.buffer = words.WordBuffer(self.segments)
+
+    def test_index(self):
+        self.assertEqual(len(self.buffer), len(self.values))
+        self.assertEqual(list(self.buffer), self.values)
+        for i in range(-len(self.values), len(self.values)):
+            self.assertEqual(self.buffer[i], self.values[i])
+        with self.assertRaises(IndexError):
+            self.buffer[len(self.values)]
+
+    def test_slice_across_segments(self):
+        for start in range(len(self.values) + 1):
+            for stop in range(start, len(self.values) + 2):
+                part = self.buffer[start:stop]
+                self.assertEqual(list(part), self.values[start:stop], (start, stop))
+                self.assertEqual(len(part), len(self.values[start:stop]))
+        self.assertEqual(list(self.buffer[-4:]), self.values[-4:])
+        self.assertEqual(list(self.buffer[3:20][2:10]), self.values[5:13])
+
+    def test_slice_references_segments(self):
+        data = bytearray(random_words(random.Random(1), 4))
+        part = words.WordBuffer([data])[1:3]
+        data[3:6] = b'\x00\x00\x01'
+        self.assertEqual(part[0], 1)
+
+    def test_slice_step(self):
+        with self.assertRaises(ValueError):
+            self.buffer[::2]
+
+    def test_tobytes(self):
+        data = b''.join(self.segments)
+        self.assertEqual(self.buffer.tobytes(), data)
+        self.assertEqual(self.buffer.tobytes('little'), bytes(words.swap(data)))
+        self.assertEqual(list(self.buffer.toarray()), self.values)
+        self.assertEqual(words.encode(self.buffer[2:9]), words.encode(self.values[2:9]))
+
+
+if __name__ == "__main__":
+    unittest.main()